@@ -12,6 +12,9 @@ It adds the following commandline arguments:
 -test             Perform a testrun against an old log
 -close            Close and add result to the nominations
 -info             Just print the vote count info about the current nominations
+-stats            Print statistics about all archived nominations (needs numpy)
+-reindex          Bring the index of the files listed on the featured media pages up to date,
+                  delistings find the pages to remove a file from in it
 -park             Park closed and verified candidates
 -auto             Do not ask before commiting edits to articles
 -dry              Do not submit any edits, just print them
@@ -20,12 +23,23 @@ It adds the following commandline arguments:
 -delist           Handle the delisting candidates (if neither -fmc or -delist is used all candidates are handled)
 -notime           Avoid displaying timestamps in log output
 -match pattern    Only operate on candidates matching this pattern
+-nocache          Do not use the persistent page cache shared between runs
+-daemon           Keep running and repeat -info, -close, -park and -reindex on an internal schedule
+-every seconds    Seconds between the daemon cycles of each action (default depends on action)
+-feed             In daemon mode close candidates as soon as they are edited (uses EventStreams)
+-shard k/n        Only handle the k:th (0 based) of n shards of the candidates, for running several workers
+-showdiff         Show the diffs also in -auto mode (they are skipped by default there)
+-pipeline         In interactive mode compute the next edits in the background while asking about the current ones
+-plan file        Do not edit, write all the edits -close/-park would make to a plan file for review
+-apply file       Make the edits of a reviewed plan file without asking again, checking that the pages did not change since
+-writebehind      Queue the accepted edits in a local database and save them in the background,
+                  queued edits left by an interrupted run are saved by the next run using it
 """
 
-import pywikibot, re, sys, signal
+import pywikibot, re, sys, signal, os, sqlite3, hashlib, socket, functools, json, difflib, calendar, weakref
 
 # Imports needed for threading
-import threading, time
+import threading, time, queue, urllib.parse
 from pywikibot import config
 
 # Import for single process check
@@ -33,13 +47,23 @@ from pywikibot import config
 # from tendo import singleton
 
 from datetime import datetime, timedelta
-today = datetime.utcnow()
+
 
 class NotImplementedException(Exception):
 
     """Not implemented."""
 
 
+class PathologicalPage(Exception):
+
+    """A page that takes too much CPU time to parse."""
+
+
+class StaleEdit(Exception):
+
+    """An edit of a page that was changed since the edit was made."""
+
+
 class ThreadCheckCandidate(threading.Thread):
     def __init__(self, candidate, check):
         threading.Thread.__init__(self)
@@ -47,7 +71,528 @@ class ThreadCheckCandidate(threading.Thread):
         self.check = check
 
     def run(self):
-        self.check(self.candidate)
+        try:
+            self.check(self.candidate)
+        except PathologicalPage as error:
+            self.candidate.skipPathological(error)
+        finally:
+            self.candidate.release()
+
+
+class RunContext:
+    """
+    The state of one bot run
+
+    The site, the options, the clock and the abort flag of a run are
+    kept here and handed to the candidates and the helpers instead of
+    living in module globals, such that several runs, like the fmc and
+    the delist candidates or two different wikis, can be made at the
+    same time in one process, see startRun(). Runs on the same site
+    share the login session of the pywikibot site and the stores below
+    the pywikibot base directory, see sharedStore().
+    """
+
+    def __init__(
+        self,
+        site=None,
+        auto=False,
+        dry=False,
+        threads=False,
+        match="",
+        noTime=False,
+        noCache=False,
+        showDiff=False,
+        shard=0,
+        shardCount=1,
+        every=0,
+        plan=False,
+        pipeline=False,
+        writeBehind=False,
+    ):
+        self.site = site or pywikibot.Site()
+        # Auto reply yes to all questions
+        self.auto = auto
+        # Auto answer no
+        self.dry = dry
+        # Use threads
+        self.threads = threads
+        # Only operate on candidates matching this pattern
+        self.match = match
+        # Avoid timestamps in output
+        self.noTime = noTime
+        # Do not use the persistent page cache
+        self.noCache = noCache
+        # Show diffs also in automatic mode
+        self.showDiff = showDiff
+        # Shard handled by this worker, and the number of shards
+        self.shard = shard
+        self.shardCount = shardCount
+        # Seconds between daemon cycles, 0 means the default of each action
+        self.every = every
+        # The edits planned with -plan, None when not planning
+        self.editPlan = EditPlan() if plan else None
+        # Compute the next edits while asking about the current ones
+        self.pipeline = pipeline
+        # Queue the accepted edits for the background writer instead of saving them
+        self.writeBehind = writeBehind
+        # Set to True if CTRL-C was pressed
+        self.abort = False
+        self.today = datetime.utcnow()
+        # The seconds each candidate took, only collected when set to a list
+        self.latencies = None
+        # The MOTD slot reservations of this run, created on first use
+        self._motdScheduler = None
+        # The [gallery, file] promotions to add to the featured list at the end of the run
+        self._featuredListPromotions = []
+        # User talk page -> [(AppendText, file, step)] of the notifications to post at the end of the run
+        self._notifications = {}
+        self._lock = threading.Lock()
+        # The candidate lease held by the current thread
+        self._lease = threading.local()
+        # (title, target) -> whether the page already uses target, see prefetch()
+        self._uses = {}
+        # Title -> (revision id, text) of the last text of the page read by getText()
+        self._read = {}
+        _contexts.add(self)
+
+    def refreshClock(self):
+        """
+        Set today to the current time and forget the MOTD reservations
+        and the texts read, the daemon does this every cycle.
+        """
+        self.today = datetime.utcnow()
+        self._motdScheduler = None
+        with self._lock:
+            self._read.clear()
+
+    def Page(self, title):
+        """Return the page with the title on the site of this run."""
+        return pywikibot.Page(self.site, title)
+
+    def planningContext(self):
+        """
+        A context like this one that plans the edits of a candidate
+        without asking, sharing the MOTD reservations, see ReviewPipeline.
+        """
+        ctx = RunContext(
+            self.site,
+            auto=True,
+            match=self.match,
+            noTime=self.noTime,
+            noCache=self.noCache,
+            plan=True,
+        )
+        ctx.today = self.today
+        ctx._motdScheduler = self.motdScheduler()
+        return ctx
+
+    def login(self):
+        """Log in to the site unless already done, possibly by another run."""
+        with _loginLock:
+            if not self.site.logged_in():
+                self.site.login()
+
+    def pageCache(self):
+        """Return the page cache of the site, it is opened on first use."""
+        return sharedStore(
+            self.site, "fmc-pagecache", lambda path: PageCache(path, self.site)
+        )
+
+    def journal(self):
+        """Return the journal of appended texts, it is opened on first use."""
+        return sharedStore(self.site, "fmc-journal", Journal)
+
+    def categoryRegistry(self):
+        """Return the registry of user categories, it is opened on first use."""
+        return sharedStore(
+            self.site, "fmc-categories", lambda path: CategoryRegistry(path, self.site)
+        )
+
+    def candidateIndex(self):
+        """Return the candidate index, it is opened on first use."""
+        return sharedStore(self.site, "fmc-candidates", CandidateIndex)
+
+    def leaseStore(self):
+        """Return the lease store, it is opened on first use."""
+        return sharedStore(self.site, "fmc-leases", LeaseStore)
+
+    def writeQueue(self):
+        """Return the queue of the edits of -writebehind, it is opened on first use."""
+        return sharedStore(self.site, "fmc-writequeue", lambda path: WriteQueue(path, self))
+
+    def featuredIndex(self):
+        """Return the index of the featured files, it is opened on first use."""
+        return sharedStore(self.site, "fmc-featuredindex", FeaturedIndex)
+
+    def motdScheduler(self):
+        """Return the MOTD scheduler of this run, it is created on first use."""
+        with self._lock:
+            if self._motdScheduler is None:
+                self._motdScheduler = MotdScheduler(self.site, self.today)
+        return self._motdScheduler
+
+    def getText(self, page):
+        """
+        Return the text of a page, following redirects.
+
+        Unless -nocache is used the text comes from the persistent
+        page cache when the page has not changed since it was stored.
+        With -plan the text includes the edits planned so far.
+        """
+        if self.editPlan is not None:
+            text = self.editPlan.text(page)
+            if text is not None:
+                return text
+        if self.noCache:
+            text = page.get(get_redirect=True)
+            revid = page.latest_revision_id
+        else:
+            text, revid = self.pageCache().read(page)
+        self._setRead(page, revid, text)
+        return text
+
+    def _setRead(self, page, revid, text):
+        """Remember the revision the text of the page is of, and index it if it is a featured media page."""
+        with self._lock:
+            self._read[page.title()] = (revid, text)
+        if isFeaturedPage(page.title()):
+            self.featuredIndex().update(page.title(), revid, text)
+
+    def baseRevid(self, page, text):
+        """
+        The revision id of text if it is the last text of the page read
+        by getText(), which is the revision edits of the text are based
+        on. None if the text was read some other way.
+        """
+        with self._lock:
+            revid, read = self._read.get(page.title(), (None, None))
+        return revid if read == text else None
+
+    def listsFile(self, page, file):
+        """
+        Whether the featured media page lists the file, without reading
+        the page. Only known if the latest revision of the page was
+        looked up by prefetch() and it is the one that was indexed.
+        """
+        revid = None if self.noCache else self.pageCache().revid(page)
+        return bool(revid) and self.featuredIndex().contains(page.title(), file, revid)
+
+    def exists(self, page):
+        """Whether the page exists, without a request if it was looked up by prefetch()."""
+        if not self.noCache:
+            exists = self.pageCache().exists(page)
+            if exists is not None:
+                return exists
+        return page.exists()
+
+    def prefetch(self, titles, appends=()):
+        """
+        Load what the next steps are going to read with a few batched
+        queries instead of one request after the other.
+
+        The texts of the pages with the titles are loaded into the page
+        cache, or that they do not exist. For the (title, target) pairs
+        of appends it is only looked up whether the page exists and
+        already uses target, for commitAppend(). Nothing is loaded with
+        -nocache.
+        """
+        if self.noCache:
+            return
+        pages = [self.Page(title) for title in dict.fromkeys(titles)]
+        appends = [(self.Page(title).title(), target) for title, target in appends]
+        # One query for the revisions of all pages, then one for the changed texts
+        self.pageCache().validate(pages + [self.Page(title) for title, target in appends])
+        self.pageCache().preload(pages)
+        existing = [pair for pair in appends if self.exists(self.Page(pair[0]))]
+        used = pagesUsing(self.site, existing)
+        with self._lock:
+            for pair in existing:
+                self._uses[pair] = pair in used
+
+    def forgetText(self, page):
+        """Make the next getText() of the page check for a newer revision."""
+        if not self.noCache:
+            self.pageCache().forget(page)
+
+    def checkLeased(self, check, candidate):
+        """Call check on the candidate while holding its lease, skip it if another worker holds it."""
+        if not self.leased(candidate.page.title(), check, candidate):
+            out('"%s" is handled by another worker, skipping' % candidate.cutTitle())
+
+    def leased(self, title, edit, *args):
+        """
+        Call edit(*args) while holding the lease on title, such that no
+        other worker edits for it meanwhile. Returns False without
+        calling edit if another worker holds the lease.
+        """
+        if not self.leaseStore().acquire(title):
+            return False
+        self._lease.title = title
+        try:
+            edit(*args)
+        finally:
+            self._lease.title = None
+            self.leaseStore().release(title)
+        return True
+
+    def checkTimed(self, check, candidate):
+        """Call check on the candidate and add the time it took to latencies."""
+        start = time.time()
+        try:
+            check(candidate)
+        finally:
+            self.latencies.append(time.time() - start)
+
+    def renewLease(self):
+        """Renew the lease held by the current thread, True if there is none."""
+        title = getattr(self._lease, "title", None)
+        return title is None or self.leaseStore().renew(title)
+
+    def commitTransformation(self, page, transformation, comment, old_text=None, create=False):
+        """
+        Apply a transformation to the text of a page and commit the result
+
+        If the page was changed after its text was read and the save
+        fails on an edit conflict, the current text is fetched and the
+        transformation applied again, instead of failing the whole step.
+
+        @param page           Page to change
+        @param transformation The Transformation to apply to the page text
+        @param comment        The edit comment
+        @param old_text       The current text of the page if it is already known
+        @param create         Start from an empty text if the page does not exist,
+                              otherwise pywikibot.NoPage is raised
+        Returns True if the page has the changes, that is if they were
+        saved or already there.
+        """
+        for attempt in range(MAX_REBASES + 1):
+            if old_text is None:
+                try:
+                    old_text = self.getText(page)
+                except pywikibot.NoPage:
+                    if not create:
+                        raise
+                    old_text = ""
+
+            new_text = transformation.apply(old_text)
+            if new_text == old_text:
+                out(
+                    "Skipping changes to '%s', already done." % page.title(),
+                    color="lightred",
+                )
+                return True
+
+            try:
+                return self.commit(old_text, new_text, page, comment, transformation)
+            except pywikibot.EditConflict:
+                out(
+                    "Edit conflict on '%s', applying the changes to the current text"
+                    % page.title(),
+                    color="lightyellow",
+                )
+                self.forgetText(page)
+                page = self.Page(page.title())
+                old_text = None
+
+        out(
+            "Giving up changes to '%s' after %d edit conflicts" % (page.title(), attempt + 1),
+            color="lightred",
+        )
+        return False
+
+    def commitAppend(self, page, append, comment, target, create=False):
+        """
+        Append a text to a page without downloading the page
+
+        Whether it was already added is decided by the journal of the
+        bot's own edits and by asking the server whether the page
+        already links to, embeds or transcludes target, instead of
+        searching the page text.
+
+        @param page    Page to append to
+        @param append  AppendText transformation with the text to append
+        @param comment The edit comment
+        @param target  The title the appended text refers to
+        @param create  Create the page if it does not exist, otherwise pywikibot.NoPage is raised
+        """
+        self.commitAppends(page, [(append, target)], comment, create)
+
+    def commitAppends(self, page, appends, comment, create=False):
+        """
+        Like commitAppend() for several (AppendText, target) pairs, the
+        texts that are not already there are appended in one edit.
+        Returns True if the texts are there, that is if they were
+        appended, queued with -writebehind or already there.
+        """
+        # Planned edits need the full text
+        if self.editPlan is not None:
+            transformation = Chain(*[append for append, target in appends])
+            if len(appends) == 1:
+                transformation = appends[0][0]
+            return self.commitTransformation(page, transformation, comment, create=create)
+
+        exists = self.exists(page)
+        if not exists and not create:
+            raise pywikibot.NoPage(page)
+
+        pending = []
+        for append, target in appends:
+            with self._lock:
+                used = self._uses.pop((page.title(), target), None)
+            if not (
+                self.journal().contains(page.title(), target)
+                or (exists and (used if used is not None else pageUses(self.site, page, target)))
+            ):
+                pending.append((append, target))
+        if not pending:
+            out(
+                "Skipping changes to '%s', already done." % page.title(),
+                color="lightred",
+            )
+            return True
+
+        appended = "".join(append.args[0] for append, target in pending)
+        out("\n About to append to: '%s'" % page.title())
+        if not self.auto or self.showDiff:
+            pywikibot.showDiff("", appended)
+
+        if self.confirm(page, comment):
+            if self.writeBehind:
+                self.writeQueue().add(
+                    page,
+                    {"appends": [[append.args[0], target] for append, target in pending], "create": create},
+                    comment,
+                )
+                return True
+            self.site.editpage(page, summary=comment, minor=False, appendtext=appended)
+            self.forgetText(page)
+            for append, target in pending:
+                self.journal().add(page.title(), target)
+            return True
+        return False
+
+    def confirm(self, page, comment):
+        """
+        Ask whether the changes to the page should be saved, unless
+        running in dry or automatic mode.
+
+        Returns True if they should be saved.
+        """
+        if self.dry:
+            choice = "n"
+        elif self.auto:
+            choice = "y"
+        else:
+            choice = pywikibot.bot.input_choice(
+                "Do you want to accept these changes to '%s' with comment '%s' ?"
+                % (page.title(), comment),
+                [('yes', 'y'), ('no', 'n'), ('quit', 'q')],
+            )
+
+        if choice == "q":
+            out("Aborting.")
+            sys.exit(0)
+        elif choice != "y":
+            out("Changes to '%s' ignored" % page.title())
+            return False
+
+        if not self.renewLease():
+            out(
+                "Lease lost to another worker, skipping changes to '%s'" % page.title(),
+                color="lightred",
+            )
+            return False
+        return True
+
+    def commit(self, old_text, new_text, page, comment, transformation=None):
+        """
+        This will commit new_text to the page
+        and unless running in automatic mode it
+        will show you the diff and ask you to accept it.
+        With -plan the edit is only added to the plan.
+
+        @param old_text Used to show the diff
+        @param new_text Text to be submitted as the new page
+        @param page Page to submit the new text to
+        @param comment The edit comment
+        @param transformation The Transformation that made new_text, if any
+        Returns True if the changes were saved.
+        """
+
+        if self.editPlan is not None:
+            self.editPlan.add(page, old_text, new_text, comment, transformation)
+            out("Planned changes to '%s'" % page.title())
+            return False
+
+        out("\n About to commit changes to: '%s'" % page.title())
+
+        # Show the diff, nobody reads it in automatic mode
+        if not self.auto or self.showDiff:
+            showDiff(old_text, new_text)
+
+        if not self.confirm(page, comment):
+            return False
+        self.save(page, old_text, new_text, comment, transformation)
+        return True
+
+    def save(self, page, old_text, new_text, comment, transformation=None):
+        """
+        Save new_text to the page as an edit of old_text, without asking
+
+        If old_text was read by getText() the edit is based on the
+        revision it was read at, also when that revision came from the
+        page cache, such that changes saved since are an edit conflict
+        instead of being overwritten. Raises pywikibot.EditConflict.
+        With -writebehind the edit is queued instead, as the
+        transformation that made new_text if there is one.
+        """
+        if self.writeBehind:
+            if transformation is None:
+                transformation = SetText(old_text, new_text)
+            self.writeQueue().add(
+                page, {"transformation": transformation.toDict(), "create": not old_text}, comment
+            )
+            return
+        revid = self.baseRevid(page, old_text)
+        if revid:
+            page.put(new_text, comment=comment, watchArticle=True, minorEdit=False, baserevid=revid)
+        else:
+            page.put(new_text, comment=comment, watchArticle=True, minorEdit=False)
+        if not self.noCache:
+            revid = self.pageCache().store(page, new_text)
+        else:
+            revid = page.latest_revision_id
+        self._setRead(page, revid, new_text)
+
+
+# The contexts of the runs in this process, such that CTRL-C aborts all of them
+_contexts = weakref.WeakSet()
+_loginLock = threading.Lock()
+
+
+def storePath(site, name):
+    """The path below the pywikibot base directory of a store of the site."""
+    return os.path.join(
+        config.base_dir, "%s-%s-%s" % (name, site.family.name, site.code)
+    )
+
+
+def sharedStore(site, name, factory):
+    """
+    Return the store of the site with the name, it is opened on first
+    use by calling factory with its path and then shared by all runs
+    on the site in this process.
+    """
+    key = (name, site.family.name, site.code)
+    with _storesLock:
+        if key not in _stores:
+            _stores[key] = factory(storePath(site, name) + ".sqlite")
+    return _stores[key]
+
+
+# The stores opened by sharedStore(), by name and site
+_stores = {}
+_storesLock = threading.Lock()
 
 
 class Candidate:
@@ -60,29 +605,25 @@ class Candidate:
     def __init__(
         self,
         page,
+        ctx,
         ProR,
         ConR,
         NeuR,
         ProString,
         ConString,
-        ReviewedR,
-        CountedR,
-        VerifiedR,
     ):
-        """Page is a pywikibot.Page object ."""
+        """Page is a pywikibot.Page object, ctx the RunContext of the run."""
         # Later perhaps this can be cleaned up by letting the subclasses keep the variables
         self.page = page
+        self.ctx = ctx
         self._pro = 0
         self._con = 0
         self._neu = 0
-        self._proR = ProR  # Regexp for positive votes
-        self._conR = ConR  # Regexp for negative votes
-        self._neuR = NeuR  # Regexp for neutral  votes
+        self._proR = ProR  # Regexp for the names of positive votes
+        self._conR = ConR  # Regexp for the names of negative votes
+        self._neuR = NeuR  # Regexp for the names of neutral  votes
         self._proString = ProString
         self._conString = ConString
-        self._ReviewedR = ReviewedR
-        self._CountedR = CountedR
-        self._VerifiedR = VerifiedR
         self._votesCounted = False
         self._daysOld = -1
         self._daysSinceLastEdit = -1
@@ -91,6 +632,21 @@ class Candidate:
         self._fileName = None
         self._alternative = None
         self._listPageName = None
+        self._nominator = None
+        self._lastRevid = None
+        self._lastEdit = None
+        self._document = None
+        self._motdSlot = None
+
+    def document(self):
+        """
+        The NominationDocument of the current text of the page, it is
+        parsed again only when the text has changed.
+        """
+        text = self.page.get(get_redirect=True)
+        if self._document is None or self._document.text is not text:
+            self._document = NominationDocument(text)
+        return self._document
 
     def printAllInfo(self):
         """
@@ -118,11 +674,13 @@ class Candidate:
 
     def nominator(self, link=True):
         """Return the link to the user that nominated this candidate."""
-        history = self.page.revisions(reverse=True, total=1)
-        for data in history:
-            username = (data.user)
-        if not history:
-            return "Unknown"
+        if self._nominator is None:
+            history = self.page.revisions(reverse=True, total=1)
+            for data in history:
+                self._nominator = (data.user)
+            if not history:
+                return "Unknown"
+        username = self._nominator
         if link:
             return "[[User:%s|%s]]" % (username, username)
         else:
@@ -137,28 +695,11 @@ class Candidate:
     
     def setFiles(self):
         """Try to return list of all files in a set, files in the last gallery in the nomination page."""
-        m = re.search(r"<gallery([^\]]*)</gallery>", self.page.get(get_redirect=True))
-        text_inside_gallery = m.group(1)
-        filesList = []
-        for line in text_inside_gallery.splitlines():
-            if line.startswith('File:'):
-                files = re.sub(r"\|.*", "", line)
-                filesList.append(files)
-        return filesList
+        return list(self.document().setFiles)
 
     def findGalleryOfFile(self):
         """Try to find Gallery in the nomination page to make closing users life easier."""
-        text = self.page.get(get_redirect=True)
-        RegexGallery = re.compile(r'(?:.*)Gallery(?:.*)(?:\s.*)\[\[Commons\:Featured[_ ]media\/([^\]]{1,180})')
-        matches = RegexGallery.finditer(text)
-        for m in matches:
-            Gallery = (m.group(1))
-        try:
-            Gallery
-        except:
-            Gallery = ""
-
-        return Gallery
+        return self.document().gallery
 
     def countVotes(self):
         """
@@ -169,13 +710,11 @@ class Candidate:
         if self._votesCounted:
             return
 
-        text = self.page.get(get_redirect=True)
-        if text:
-            text = filter_content(text)
-
-            self._pro = len(re.findall(self._proR, text))
-            self._con = len(re.findall(self._conR, text))
-            self._neu = len(re.findall(self._neuR, text))
+        document = self.document()
+        if document.text:
+            self._pro = document.countTemplates(self._proR)
+            self._con = document.countTemplates(self._conR)
+            self._neu = document.countTemplates(self._neuR)
         else:
             out("Warning - %s has no content" % self.page, color="lightred")
 
@@ -183,14 +722,11 @@ class Candidate:
 
     def isWithdrawn(self):
         """Withdrawn nominations should not be counted."""
-        text = self.page.get(get_redirect=True)
-        text = filter_content(text)
-        withdrawn = len(re.findall(WithdrawnR, text))
-        return withdrawn > 0
+        return self.document().countTemplates(WithdrawnNameR) > 0
 
     def isFMX(self):
         """Page marked with FMX template."""
-        return len(re.findall(FmxR, self.page.get(get_redirect=True)))
+        return self.document().countTemplates(FmxNameR, filtered=False)
 
     def rulesOfNinthDay(self):
         """Check if any of the rules of the ninth day can be applied"""
@@ -234,6 +770,8 @@ class Candidate:
             )
 
             if not oldEnough:
+                if self._lastEdit:
+                    self.waitUntil(self._lastEdit + timedelta(days=1))
                 return False
 
             self.moveToLog(why)
@@ -244,6 +782,10 @@ class Candidate:
 
         if not ninthDay and not self.isDone():
             out('"%s" is still active, ignoring' % self.cutTitle())
+            ninthDayPossible = self.daysOld() < 9 and self.mediaCount() <= 1
+            self.waitUntil(
+                self.creationTime() + timedelta(days=9 if ninthDayPossible else 27)
+            )
             return False
 
         old_text = self.page.get(get_redirect=True)
@@ -251,66 +793,96 @@ class Candidate:
             out("Warning - %s has no content" % self.page, color="lightred")
             return False
 
-        if re.search(r"{{\s*FMC-closed-ignored.*}}", old_text):
+        document = self.document()
+        if document.hasTemplate("FMC-closed-ignored"):
             out('"%s" is marked as ignored, so ignoring' % self.cutTitle())
+            self.waitUntil(None)
             return False
 
-        if re.search(self._CountedR, old_text):
+        if document.hasTemplate(self.countedTemplate):
             out('"%s" needs review, ignoring' % self.cutTitle())
+            self.waitUntil(None)
             return False
 
-        if re.search(self._ReviewedR, old_text):
+        if document.hasTemplate(self.reviewedTemplate):
             out('"%s" already closed and reviewed, ignoring' % self.cutTitle())
+            self.waitUntil(None)
             return False
 
         if self.mediaCount() <= 1:
             self.countVotes()
 
-        result = self.getResultString()
-
-        new_text = old_text + result
+        # Append the result unless someone else closed it in the meantime
+        transformations = [
+            AppendUnlessCalled(
+                self.getResultString(), self.countedTemplate, self.reviewedTemplate
+            )
+        ]
 
         # Add the featured status to the header
         if self.mediaCount() <= 1:
-            new_text = self.fixHeader(new_text)
+            transformations.append(
+                FixHeader(self.headerStatus(), self._proString, self._conString)
+            )
 
-        self.commit(
-            old_text,
-            new_text,
+        self.ctx.commitTransformation(
             self.page,
+            Chain(*transformations),
             self.getCloseCommitComment()
             + (" (ninthDay=%s)" % ("yes" if ninthDay else "no")),
+            old_text=old_text,
         )
 
         return True
 
+    def release(self):
+        """
+        Forget the text of the page and its parse state once the check
+        of the candidate is done, such that long runs keep little in memory.
+        """
+        self.page = self.ctx.Page(self.page.title())
+        self._document = None
+
+    def skipPathological(self, error):
+        """Flag a page that is too slow to parse, it is skipped until it is edited."""
+        out('"%s" skipped, the page %s' % (self.cutTitle(), error), color="lightred")
+        self.waitUntil(None)
+
+    def waitUntil(self, due):
+        """
+        Remember in the candidate index that there is nothing to close
+        until the datetime due, or until the candidate is edited.
+        With due None only an edit can make it closable again.
+        Needs the latest revision found by loadMetadata().
+        """
+        if self._lastRevid:
+            self.ctx.candidateIndex().setDeadline(self.page.title(), self._lastRevid, due)
+
     def fixHeader(self, text, value=None):
         """
         Will append the featured status to the header of the candidate
         Will return the new text
         @param value If specified ("yes" or "no" string will be based on it, otherwise isPassed() is used)
         """
+        return FixHeader(
+            self.headerStatus(value), self._proString, self._conString
+        ).apply(text)
 
-        # Check if they are alredy there
-        if re.match(r"===.*(%s|%s)===" % (self._proString, self._conString), text):
-            return text
-
-        status = ""
-
-        if value:
-            if value == "yes":
-                status = ", %s" % self._proString
-            elif value == "no":
-                status = ", %s" % self._conString
-
-        if len(status) < 1:
-            status = (
-                ", %s" % self._proString
-                if self.isPassed()
-                else ", %s" % self._conString
-            )
+    def headerStatus(self, value=None):
+        """
+        The status to append to the header of the candidate
+        @param value If specified ("yes" or "no" string will be based on it, otherwise isPassed() is used)
+        """
+        if value == "yes":
+            return ", %s" % self._proString
+        elif value == "no":
+            return ", %s" % self._conString
 
-        return re.sub(r"(===.*)(===)", r"\1%s\2" % status, text, 1)
+        return (
+            ", %s" % self._proString
+            if self.isPassed()
+            else ", %s" % self._conString
+        )
 
     def getResultString(self):
         """Must be implemented by the subclasses (Text to add to closed pages)."""
@@ -337,7 +909,7 @@ class Candidate:
                 "Could not retrieve history for '%s', returning utcnow()"
                 % self.page.title()
             )
-            return today
+            return self.ctx.today
 
         for data in history:
             self._creationTime = (data['timestamp'])
@@ -359,7 +931,7 @@ class Candidate:
         if self._daysOld != -1:
             return self._daysOld
 
-        delta = today - self.creationTime()
+        delta = self.ctx.today - self.creationTime()
         self._daysOld = delta.days
         return self._daysOld
 
@@ -379,7 +951,7 @@ class Candidate:
         except:
             return -1
 
-        delta = today - lastEdit
+        delta = self.ctx.today - lastEdit
         self._daysSinceLastEdit = delta.days
         return self._daysSinceLastEdit
 
@@ -410,8 +982,7 @@ class Candidate:
 
     def sectionCount(self):
         """Count the number of sections in this candidate."""
-        text = self.page.get(get_redirect=True)
-        return len(re.findall(SectionR, text))
+        return self.document().sections
 
     def mediaCount(self):
         """
@@ -424,25 +995,7 @@ class Candidate:
         if self._imgCount:
             return self._imgCount
 
-        text = self.page.get(get_redirect=True)
-
-        matches = []
-        for m in re.finditer(FilesR, text):
-            matches.append(m)
-
-        count = len(matches)
-
-        if count >= 2:
-            # We have several medias, check if they are too small to be counted
-            for img in matches:
-
-                if re.search(FilesThumbR, img.group(0)):
-                    count -= 1
-                else:
-                    s = re.search(FilesSizeR, img.group(0))
-                    if s and (int(s.group(1)) <= 150):
-                        count -= 1
-
+        count = self.document().mediaCount()
         self._imgCount = count
         return count
 
@@ -456,8 +1009,22 @@ class Candidate:
         contains four values:
         support,oppose,neutral,(featured|not featured)
         """
-        text = self.page.get(get_redirect=True)
-        return re.findall(PreviousResultR, text)
+        return self.document().matches(PreviousResultR, "'''result:'''")
+
+    def verifiedResults(self):
+        """
+        The verified results of this nomination, for every reviewed results
+        template the tuple of the values of the resultKeys, "" if missing.
+        Templates without vote counts or status are left out. Several
+        templates on one line are several results, park() ignores such
+        candidates.
+        """
+        results = []
+        for parameters in self.document().parameters(self.reviewedTemplate):
+            values = tuple(parameters.get(key, "") for key in self.resultKeys)
+            if all(votes.isdigit() for votes in values[:3]) and re.match(r"\w+$", values[3]):
+                results.append(values)
+        return results
 
     def compareResultToCount(self):
         """
@@ -556,13 +1123,13 @@ class Candidate:
             "(%s.*?)([Ff]ile|[Ii]mage)" % candPrefix, r"\2", self.page.title()
         )
 
-        if not pywikibot.Page(SITE, self._fileName).exists():
-            match = re.search(FilesR, self.page.get(get_redirect=True))
-            if match:
-                self._fileName = match.group(1)
+        if not self.ctx.Page(self._fileName).exists():
+            files = self.document().files
+            if files:
+                self._fileName = files[0][0]
 
         #Check if file was moved after nomination
-        page = pywikibot.Page(SITE, self._fileName)
+        page = self.ctx.Page(self._fileName)
         if page.isRedirectPage():
             self._fileName = page.getRedirectTarget().title()
 
@@ -573,6 +1140,8 @@ class Candidate:
         Will add this page to the list of featured medias.
         This uses just the base of the gallery, like 'Animals'.
         Should only be called on closed and verified candidates
+        The list is updated by flushFeaturedList() after all
+        candidates of the run are parked.
 
         This is ==STEP 1== of the parking procedure
 
@@ -583,35 +1152,8 @@ class Candidate:
         else:
             file = self.fileName()
 
-        listpage = "Commons:Featured media, list"
-        page = pywikibot.Page(SITE, listpage)
-        old_text = page.get(get_redirect=True)
-
-        # First check if we are already on the page,
-        # in that case skip. Can happen if the process
-        # have been previously interrupted.
-        if re.search(wikipattern(file), old_text):
-            out(
-                "Skipping addToFeaturedList for '%s', page already listed."
-                % self.cleanTitle(),
-                color="lightred",
-            )
-            return
-
-        # This function first needs to find the gallery
-        # then inside the gallery tags remove the last line and
-        # add this candidate to the top
-        # Thanks KODOS for a nice regexp gui
-        # This adds ourself first in the list of length 4 and removes the last
-        # all in the chosen gallery
-        out("Looking for gallery: '%s'" % wikipattern(gallery))
-        ListPageR = re.compile(
-            r"(^==\s*{{{\s*\d+\s*\|%s\s*}}}\s*==\s*<gallery.*>\s*)(.*\s*)(.*\s*.*\s*)(.*\s*)(</gallery>)"
-            % wikipattern(gallery),
-            re.MULTILINE,
-        )
-        new_text = re.sub(ListPageR, r"\1%s\n\2\3\5" % file, old_text)
-        self.commit(old_text, new_text, page, "Added [[%s]]" % file)
+        # All the promotions of the run are added in one edit at the end
+        addToFeaturedListLater(self.ctx, gallery, file)
 
     def addToCategorizedFeaturedList(self, gallery):
         """
@@ -630,67 +1172,23 @@ class Candidate:
         else:
             files = []
             files.append(self.fileName())
-        for file in files:
-            gallery_full_path = "Commons:Featured media/" + re.sub(r"#.*", "", gallery)
-            page = pywikibot.Page(SITE, gallery_full_path)
-            old_text = page.get(get_redirect=True)
-            section_regex = r"#(.*)"
-            search_section = re.search(section_regex, gallery)
-            try:
-                section = search_section.group(1)
-            except AttributeError:
-                section = None
-
-            if section != None:
-
-                # Trying to generate a regex for finding the section in a gallery if specified in nomination
-                # First we are escaping all parentheses, as they are used in regex
-                # Replacement of all uunderscore with \s , some users just copy the url
-                # Replacing all \s with \s(?:\s*|)\s, user have linked the section to categories. Why ? To make our lives harder
-
-                section = section.replace(")","\)").replace("(","\(").replace("_"," ").replace(" ", " (?:\[{2}|\]{2}|) ")
-                regex_for_searching_sections = (section  +  r"(?:(?:[^\{\}]|\n)*?)(</gallery>)").replace(" ", "(?:\s*|)")
-                search_for_section = re.search(regex_for_searching_sections, old_text)
-                try:
-                    section_text_search = search_for_section.group()
-                except AttributeError:
-                    section = None
-
-            # First check if we are already on the page,
-            # in that case skip. Can happen if the process
-            # have been previously interrupted.
-
-            if re.search(wikipattern(file), old_text):
-                out(
-                    "Skipping addToCategorizedFeaturedList for '%s', page already listed."
-                    % self.cleanTitle(),
-                    color="lightred",
-                )
-                return
-
-            # If we found a section, we try to add the media in the section else add to the bottom most gallery (unsorted)
 
-            if section != None:
-                line_above_the_closing_gallery_tag = section_text_search.splitlines()[-2]
-                candidate_text = "%s" % file
-                append_candidate_text_in_line_above_closing_gallery_tag = line_above_the_closing_gallery_tag + "\n" + candidate_text
-                new_text = old_text.replace(line_above_the_closing_gallery_tag, append_candidate_text_in_line_above_closing_gallery_tag,1)
-            else:
-                # We just need to append to the bottom of the gallery with an added title
-                # The regexp uses negative lookahead such that we place the candidate in the
-                # last gallery on the page.
-                new_text = re.sub(
-                    "(?s)</gallery>(?!.*</gallery>)",
-                    "%s\n</gallery>" % (file),
-                    old_text,
-                    1,
-                )
+        gallery_full_path = "Commons:Featured media/" + re.sub(r"#.*", "", gallery)
+        search_section = re.search(r"#(.*)", gallery)
+        section = search_section.group(1) if search_section else None
 
-            self.commit(old_text, new_text, page, "Added [[%s]]" % file)
+        for file in files:
+            page = self.ctx.Page(gallery_full_path)
+            if self.ctx.listsFile(page, file):
+                out("Skipping changes to '%s', already done." % page.title(), color="lightred")
+                continue
+            self.ctx.commitTransformation(
+                page, InsertIntoGallery(file, section), "Added [[%s]]" % file
+            )
 
     def getFilePage(self):
         """Get the media page itself."""
-        return pywikibot.Page(SITE, self.fileName())
+        return self.ctx.Page(self.fileName())
 
     def makecategoryuploader(self):
         """
@@ -698,29 +1196,23 @@ class Candidate:
         """
 
         why = "to have a propper count, and update list at  [[Category:Featured media uploaded by user name]]"
-        upuser = uploader(self.fileName(),link=False)
+        upuser = uploader(self.ctx, self.fileName(),link=False)
         upcatpage = "Category:Featured media by %s" % upuser
-        cat_page = pywikibot.Page(SITE, upcatpage)
-        try:
-            cat_text = cat_page.get(get_redirect=True)
-        except pywikibot.NoPage:
-            cat_text = ""
-
-        if re.search(r"{{\s*FMcatUploader.*}}", cat_text):
-            out(
-                "Skipping adding template '%s', page present there"
-                % uploader(self.fileName(),link=False),
-                color="lightred",
-            )
-
-        else:
-            new_cat_text = cat_text + "\n{{FMcatUploader|username=%s}}\n__HIDDENCAT__" % uploader(self.fileName(),link=False)
-            self.commit(
-                cat_text,
-                new_cat_text,
-                cat_page,
-                "Creating category for [[User:%s]] %s" % (uploader(self.fileName(), link=False), why),
-            )
+        if self.ctx.categoryRegistry().contains(upcatpage):
+            out("Skipping '%s', category already there" % upcatpage, color="lightred")
+            return
+        cat_page = self.ctx.Page(upcatpage)
+        if self.ctx.commitTransformation(
+            cat_page,
+            AppendText(
+                "\n{{FMcatUploader|username=%s}}\n__HIDDENCAT__" % upuser,
+                r"{{\s*FMcatUploader.*}}",
+            ),
+            "Creating category for [[User:%s]] %s" % (upuser, why),
+            create=True,
+        ) and not self.ctx.writeBehind:
+            # A queued edit is not saved yet, resolve() finds the category once it is
+            self.ctx.categoryRegistry().add(upcatpage)
 
     def makecategorynominator(self):
         """
@@ -729,26 +1221,21 @@ class Candidate:
         why = "to have a propper count, and update list at [[Category:Featured media nominated by user name]]   "
         nomuser = self.nominator(link=False)
         nomcatpage = "Category:Featured media nominated by %s" % nomuser
-        cat_page = pywikibot.Page(SITE, nomcatpage)
-        try:
-            cat_text = cat_page.get(get_redirect=True)
-        except pywikibot.NoPage:
-            cat_text = ""
-
-        if re.search(r"{{\s*FMcatNominator.*}}", cat_text):
-            out(
-                "Skipping adding template '%s', page present there"
-                % self.nominator(link=False),
-                color="lightred",
-            )
-        else:
-            new_cat_text = cat_text + "\n{{FMcatNominator|username=%s}}\n__HIDDENCAT__" % self.nominator(link=False)
-            self.commit(
-                cat_text,
-                new_cat_text,
-                cat_page,
-                "Creating category for [[User:%s]] %s" % (self.nominator(link=False), why),
-            )
+        if self.ctx.categoryRegistry().contains(nomcatpage):
+            out("Skipping '%s', category already there" % nomcatpage, color="lightred")
+            return
+        cat_page = self.ctx.Page(nomcatpage)
+        if self.ctx.commitTransformation(
+            cat_page,
+            AppendText(
+                "\n{{FMcatNominator|username=%s}}\n__HIDDENCAT__" % nomuser,
+                r"{{\s*FMcatNominator.*}}",
+            ),
+            "Creating category for [[User:%s]] %s" % (nomuser, why),
+            create=True,
+        ) and not self.ctx.writeBehind:
+            # A queued edit is not saved yet, resolve() finds the category once it is
+            self.ctx.categoryRegistry().add(nomcatpage)
 
     def addAssessments(self):
         """
@@ -757,9 +1244,6 @@ class Candidate:
         This is ==STEP 3== of the parking procedure
         """
         page = self.getFilePage()
-        old_text = page.get(get_redirect=True)
-
-        AssR = re.compile(r"{{\s*FM[\s_]promoted\s*\|(.*)}}")
 
         fn_or = self.fileName(alternative=False)  # Original filename
         fn_al = self.fileName(alternative=True)  # Alternative filename
@@ -767,43 +1251,13 @@ class Candidate:
         # differs from the alternative filename.
         comnom = "|com-nom=%s" % fn_or.replace("File:", "") if fn_or != fn_al else ""
 
-        # First check if there already is an FV_promoted template on the page
-        params = re.search(AssR, old_text)
-        if params:
-            # Make sure to remove any existing com/features or subpage params
-            # TODO: 'com' will be obsolete in the future and can then be removed
-            # TODO: 'subpage' is the old name of com-nom. Can be removed later.
-            params = re.sub(r"\|\s*(?:featured|com)\s*=\s*\d+", "", params.group(1))
-            params = re.sub(r"\|\s*(?:subpage|com-nom)\s*=\s*[^{}|]+", "", params)
-            params += "|featured=1"
-            params += comnom
-            if params.find("|") != 0:
-                params = "|" + params
-            new_ass = "{{FM promoted%s}}" % params
-            nomuser = self.nominator()
-            upuser = uploader(self.fileName())
-            new_text = re.sub(AssR, new_ass, old_text)
-            if new_text == old_text:
-                out(
-                    "No change in addFVtags, '%s' already featured."
-                    % self.cleanTitle()
-                )
-                return
-        else:
-            # There is no FV_promoted template so just add it
-            end = findEndOfTemplate(old_text, "[Ii]nformation")
-            nomuser = self.nominator(link=False)
-            upuser = uploader(self.fileName(),link=False)
-            new_text = (
-                old_text[:end]
-                + "\n{{FM promoted|featured=1%s}}" % comnom
-                + old_text[end:]
-                + "\n[[Category:Featured media nominated by %s]]\n" % nomuser
-                + "[[Category:Featured media by %s]]" % upuser
-            )
-            # new_text = re.sub(r'({{\s*[Ii]nformation)',r'{{FV_promoted|featured=1}}\n\1',old_text)
-
-        self.commit(old_text, new_text, page, "FMC promotion with automatic categorization :)")
+        self.ctx.commitTransformation(
+            page,
+            AddAssessment(
+                comnom, self.nominator(link=False), uploader(self.ctx, self.fileName(), link=False)
+            ),
+            "FMC promotion with automatic categorization :)",
+        )
 
     def addToCurrentMonth(self):
         """
@@ -817,271 +1271,194 @@ class Candidate:
             files = []
             files.append(self.fileName())
         for file in files:
-            FinalVotesR = re.compile(r'FMC-results-reviewed\|support=([0-9]{0,3})\|oppose=([0-9]{0,3})\|neutral=([0-9]{0,3})\|')
-            NomPagetext = self.page.get(get_redirect=True)
-            matches = FinalVotesR.finditer(NomPagetext)
-            for m in matches:
-                if m is None:
-                    ws=wo=wn= "x"
-                else:
-                    ws = m.group(1)
-                    wo = m.group(2)
-                    wn = m.group(3)
-
-            monthpage = "Commons:Featured_media/chronological/%s %s" % (today.strftime("%B"), today.year,)
-            page = pywikibot.Page(SITE, monthpage)
-            try:
-                old_text = page.get(get_redirect=True)
-            except pywikibot.NoPage:
-                old_text = ""
-            # First check if we are already on the page,
-            # in that case skip. Can happen if the process
-            # have been previously interrupted.
-            if re.search(wikipattern(file), old_text):
-                out(
-                    "Skipping addToCurrentMonth for '%s', page already listed."
-                    % self.cleanTitle(),
-                    color="lightred",
-                )
-                return
-
-            # Find the number of lines in the gallery, if AttributeError set count as 1
-            m = re.search(r"(?ms)<gallery>(.*)</gallery>", old_text)
-            try:
-                count = m.group(0).count("\n")
-            except AttributeError:
-                count = 1
+            ws = wo = wn = "x"
+            results = self.verifiedResults()
+            if results:
+                ws, wo, wn = results[-1][:3]
+
+            month = "%s %s" % (self.ctx.today.strftime("%B"), self.ctx.today.year)
+            monthpage = "Commons:Featured_media/chronological/%s" % month
+            page = self.ctx.Page(monthpage)
+            if self.ctx.listsFile(page, file):
+                out("Skipping changes to '%s', already done." % page.title(), color="lightred")
+                continue
 
-            # We just need to append to the bottom of the gallery
-            # with an added title
             # TODO: We lack a good way to find the creator, so it is left out at the moment
 
-            if count ==1:
-                old_text = "{{subst:FMArchiveChrono}}\n== %s %s ==\n<gallery>\n</gallery>" % (today.strftime("%B"), today.year,)
-            else:pass
-
             if self.isSet():
                 file_title = "'''%s''' - a set of %s files" % ((re.search(r"/[Ss]et/(.*)", self.page.title())).group(1), str(len(self.setFiles())))
             else:
                 file_title = self.cleanTitle()
-                
 
-            new_text = re.sub(
-                "</gallery>",
-                "%s|%d '''%s''' <br> uploaded by %s, nominated by %s,<br> {{s|%s}}, {{o|%s}}, {{n|%s}} \n</gallery>"
-                % (
-                    file,
-                    count,
-                    file_title,
-                    uploader(file),
-                    self.nominator(),
-                    ws,
-                    wo,
-                    wn,
-                ),
-                old_text,
+            description = "'''%s''' <br> uploaded by %s, nominated by %s,<br> {{s|%s}}, {{o|%s}}, {{n|%s}} " % (
+                file_title,
+                uploader(self.ctx, file),
+                self.nominator(),
+                ws,
+                wo,
+                wn,
             )
 
-            self.commit(old_text, new_text, page, "Added [[%s]]" % file)
+            self.ctx.commitTransformation(
+                page,
+                AddToChronological(file, description, month),
+                "Added [[%s]]" % file,
+                create=True,
+            )
 
     def notifyNominator(self):
         """
         Add a template to the nominators talk page
 
         This is ==STEP 5== of the parking procedure
+        The notifications are posted by flushNotifications()
+        after all candidates of the run are parked.
         """
-        talk_link = "User_talk:%s" % self.nominator(link=False)
-        talk_page = pywikibot.Page(SITE, talk_link)
+        talk_link, notification, file = self.nominatorNotification()
+        notifyLater(self.ctx, talk_link, notification, file, "notifyNominator")
 
-        try:
-            old_text = talk_page.get(get_redirect=True)
-        except pywikibot.NoPage:
-            out(
-                "notifyNominator: No such page '%s' but ignoring..." % talk_link,
-                color="lightred",
-            )
-            return
+    def nominatorNotification(self):
+        """The (talk page, AppendText, file) of the notification of the nominator."""
+        talk_link = "User_talk:%s" % self.nominator(link=False)
 
         fn_or = self.fileName(alternative=False)  # Original filename
         fn_al = self.fileName(alternative=True)  # Alternative filename
 
-        # First check if we are already on the page,
-        # in that case skip. Can happen if the process
-        # have been previously interrupted.
-
         # We add the subpage parameter if the original filename
         # differs from the alternative filename.
         subpage = "|subpage=%s" % fn_or if fn_or != fn_al else ""
 
         # notification for set candidates should add a gallery to talk page and
         # it should be special compared to usual promotions.
-        
+
         if self.isSet():
-            if re.search(r"{{FMpromotionSet\|%s}}" % wikipattern(fn_al), old_text):
-                return
             files_newline_string = converttostr(self.setFiles(), '\n')
-            new_text = old_text + "\n\n== Set Promoted to FM ==\n<gallery mode=packed heights=80px>%s\n</gallery>\n{{FMpromotionSet|%s%s}} /~~~~" % (
-                files_newline_string,
-                fn_al,
-                subpage,
+            notification = AppendText(
+                "\n\n== Set Promoted to FM ==\n<gallery mode=packed heights=80px>%s\n</gallery>\n{{FMpromotionSet|%s%s}} /~~~~" % (
+                    files_newline_string,
+                    fn_al,
+                    subpage,
+                ),
+                r"{{FMpromotionSet\|%s}}" % wikipattern(fn_al),
             )
-            try:
-                self.commit(
-                    old_text, new_text, talk_page, "FMC promotion of [[%s]]" % fn_al
-                )
-            except pywikibot.LockedPage as error:
-                out(
-                    "Page is locked '%s', but ignoring since it's just the user notification."
-                    % error,
-                    color="lightyellow",
-                )
-            return
         else:
-            pass
-
-
-        if re.search(r"{{FMpromotion\|%s}}" % wikipattern(fn_or), old_text):
-            out(
-                "Skipping notifyNominator for '%s', page already listed at '%s'."
-                % (self.cleanTitle(), talk_link),
-                color="lightred",
+            notification = AppendText(
+                "\n\n== FM Promotion ==\n{{FMpromotion|%s%s}} /~~~~" % (fn_al, subpage),
+                r"{{FMpromotion\|%s}}" % wikipattern(fn_or),
             )
-            return
-
-        new_text = old_text + "\n\n== FM Promotion ==\n{{FMpromotion|%s%s}} /~~~~" % (
-            fn_al,
-            subpage,
-        )
 
-        try:
-            self.commit(
-                old_text, new_text, talk_page, "FMC promotion of [[%s]]" % fn_al
-            )
-        except pywikibot.LockedPage as error:
-            out(
-                "Page is locked '%s', but ignoring since it's just the user notification."
-                % error,
-                color="lightyellow",
-            )
+        return talk_link, notification, fn_al
 
     def notifyUploader(self):
         """
         Add a template to the uploaders talk page
         This is ==STEP 6== of the parking procedure
         """
+        for talk_link, notification, file in self.uploaderNotifications():
+            notifyLater(self.ctx, talk_link, notification, file, "notifyUploader")
+
+    def uploaderNotifications(self):
+        """
+        The (talk page, AppendText, file) of the notifications of the
+        uploaders, except the uploaders that nominated the file.
+        """
+        notifications = []
         if self.isSet():
             files = self.setFiles()
         else:
             files = []
             files.append(self.fileName())
-        
+
         for file in files:
             #Check if nominator and uploaders are same, avoiding adding a template twice
-            if self.nominator() == uploader(file, link=True):
+            if self.nominator() == uploader(self.ctx, file, link=True):
                 continue
 
-            talk_link = "User_talk:%s" % uploader(file, link=False)
-            talk_page = pywikibot.Page(SITE, talk_link)
-            try:
-                old_text = talk_page.get(get_redirect=True)
-            except pywikibot.NoPage:
-                out(
-                    "notifyUploader: No such page '%s' but ignoring..." % talk_link,
-                    color="lightred",
-                )
-                return
+            talk_link = "User_talk:%s" % uploader(self.ctx, file, link=False)
 
             fn_or = self.fileName(alternative=False)  # Original filename
             fn_al = self.fileName(alternative=True)  # Alternative filename
 
-            # First check if we are already on the page,
-            # in that case skip. Can happen if the process
-            # have been previously interrupted.
-
-            if re.search(r"{{FMpromotion\|%s}}" % wikipattern(fn_or), old_text):
-                out(
-                    "Skipping notifyUploader for '%s', page already listed at '%s'."
-                    % (self.cleanTitle(), talk_link),
-                    color="lightred",
-                )
-                return
-
             # We add the subpage parameter if the original filename
             # differs from the alternative filename.
 
             subpage = "|subpage=%s" % fn_or if fn_or != fn_al else ""
-            
+
             if self.isSet():
                 subpage = "|subpage="+(re.search(r"[Ss]et/(.*)", self.page.title())).group(0)
                 fn_al = file
 
-            new_text = old_text + "\n\n== FM Promotion ==\n{{FMpromotedUploader|%s%s}} /~~~~" % (
-                fn_al,
-                subpage,
+            notification = AppendText(
+                "\n\n== FM Promotion ==\n{{FMpromotedUploader|%s%s}} /~~~~" % (fn_al, subpage),
+                r"{{FMpromotion\|%s}}|{{FMpromotedUploader\|%s[|}]"
+                % (wikipattern(fn_or), wikipattern(fn_al)),
             )
-
-            try:
-                self.commit(
-                    old_text, new_text, talk_page, "FMC promotion of [[%s]]" % fn_al
-                )
-            except pywikibot.LockedPage as error:
-                out(
-                    "Page is locked '%s', but ignoring since it's just the user notification."
-                    % error,
-                    color="lightyellow",
-                )
-
+            notifications.append((talk_link, notification, fn_al))
+        return notifications
 
     def getMotdDesc(self):
-        cand_page = pywikibot.Page(SITE, self.page.title())
-        cand_page_text = cand_page.get()
-        result = re.search('{{Candidatedescription}}(.*)', cand_page_text)
-        return result.group(1)
+        """The description of the {{Candidatedescription}} line, or None if there is none."""
+        description = self.document().description
+        return description if description and description.strip() else None
 
     def find_empty_motd_date(self):
-        informatdate = lambda num : (datetime.now()+timedelta(num)).strftime('%Y-%m-%d')
-        for num in range(90):
-            motd_page_name = 'Template:Motd/%s' % informatdate(num)
-            if not pywikibot.Page(SITE, motd_page_name).exists():
-                empty_slot_title = motd_page_name
-                en_lang = 'Template:Motd/%s_(en)' % informatdate(num)
-                DateForTemplateTag = (datetime.now()+timedelta(num)).strftime('%Y|%m|%d')
-                break
-        return empty_slot_title, en_lang, DateForTemplateTag
-    
+        """
+        Reserve the next free MOTD date for this candidate.
+
+        Returns a tuple of the Motd page title, the English description
+        page title and the date formatted for the template, or None if
+        there is no free slot within the scheduling window.
+        """
+        return self.ctx.motdScheduler().reserve()
+
     def createMotdPage(self):
         file_name = self.fileName()
-        file_page_text = pywikibot.Page(SITE, file_name).get()
+        file_page_text = self.ctx.getText(self.ctx.Page(file_name))
+        # The slot may already be reserved by prefetchPark()
+        slot, self._motdSlot = self._motdSlot, None
         if re.search(r"{{\s*?[Mm]edia[_\s]of[_\s]the[_\s]day", file_page_text):
+            if slot:
+                self.ctx.motdScheduler().release(slot)
+            return
+        elif self.getMotdDesc() is None:
+            if slot:
+                self.ctx.motdScheduler().release(slot)
+            out(
+                "Skipping createMotdPage for '%s', the nomination has no {{Candidatedescription}}."
+                % self.cleanTitle(),
+                color="lightred",
+            )
             return
         else:
-            empty_slot_title, en_lang, DateForTemplateTag = self.find_empty_motd_date()
+            slot = slot or self.find_empty_motd_date()
+            if not slot:
+                out(
+                    "Skipping createMotdPage for '%s', no free MOTD date found."
+                    % self.cleanTitle(),
+                    color="lightred",
+                )
+                return
+            empty_slot_title, en_lang, DateForTemplateTag = slot
             why = "Adding promoted [[Commons:Featured media|Featured media]] as MOTD."
-            page = pywikibot.Page(SITE, empty_slot_title)
-            enMotdDescpage = pywikibot.Page(SITE, en_lang)
-            
+            page = self.ctx.Page(empty_slot_title)
+            enMotdDescpage = self.ctx.Page(en_lang)
+
             fileWithoutPrefix = file_name.replace('File:', '')
-            
+
             new_text = "{{Motd filename|%s|%s}}" % ( fileWithoutPrefix, DateForTemplateTag)
-            self.commit(
-                "",
-                new_text,
+            self.ctx.commitTransformation(
                 page,
+                CreatePage(new_text),
                 "Creating MOTD page for [[%s]], %s" % (file_name, why),
+                create=True,
             )
             enMotdDescnew_text = "{{Motd description|%s|en|%s}}" % ( self.getMotdDesc(), DateForTemplateTag )
-            self.commit(
-                "",
-                enMotdDescnew_text,
+            self.ctx.commitTransformation(
                 enMotdDescpage,
+                CreatePage(enMotdDescnew_text),
                 "For MOTD [[%s]], %s" % (file_name, "English description added"),
+                create=True,
             )
-                
-            
-            
-            
-            print(empty_slot_title, en_lang, DateForTemplateTag)
-
 
     def moveToLog(self, reason=None):
         """
@@ -1094,55 +1471,31 @@ class Candidate:
         why = (" (%s)" % reason) if reason else ""
 
         # Add to log
-        # (Note FIXME, we must probably create this page if it does not exist)
-
-        current_month = today.strftime("%B")
-        log_link = "Commons:Featured media candidates/Log/%s %s" % (
-            current_month,
-            today.year,
-        )
-        log_page = pywikibot.Page(SITE, log_link)
-
         # If the page does not exist we just create it ( put does that automatically )
-        try:
-            old_log_text = log_page.get(get_redirect=True)
-        except pywikibot.NoPage:
-            old_log_text = ""
 
-        if re.search(wikipattern(self.fileName()), old_log_text):
-            out(
-                "Skipping add in moveToLog for '%s', page already there"
-                % self.cleanTitle(),
-                color="lightred",
-            )
-        else:
-            new_log_text = old_log_text + "\n{{%s}}" % self.page.title()
-            self.commit(
-                old_log_text,
-                new_log_text,
-                log_page,
-                "Adding [[%s]]%s" % (self.fileName(), why),
-            )
+        log_page = self.ctx.Page(self.logTitle())
+        self.ctx.commitAppend(
+            log_page,
+            AppendText("\n{{%s}}" % self.page.title(), wikipattern(self.fileName())),
+            "Adding [[%s]]%s" % (self.fileName(), why),
+            self.page.title(),
+            create=True,
+        )
 
         # Remove from current list
-        candidate_page = pywikibot.Page(SITE, self._listPageName)
-        old_cand_text = candidate_page.get(get_redirect=True)
-        new_cand_text = re.sub(
-            r"{{\s*%s\s*}}.*?\n?" % wikipattern(self.page.title()), "", old_cand_text
+        candidate_page = self.ctx.Page(self._listPageName)
+        self.ctx.commitTransformation(
+            candidate_page,
+            RemoveTransclusion(self.page.title()),
+            "Removing [[%s]]%s" % (self.fileName(), why),
         )
 
-        if old_cand_text == new_cand_text:
-            out(
-                "Skipping remove in moveToLog for '%s', no change." % self.cleanTitle(),
-                color="lightred",
-            )
-        else:
-            self.commit(
-                old_cand_text,
-                new_cand_text,
-                candidate_page,
-                "Removing [[%s]]%s" % (self.fileName(), why),
-            )
+    def logTitle(self):
+        """The log of the candidates closed in the current month."""
+        return "Commons:Featured media candidates/Log/%s %s" % (
+            self.ctx.today.strftime("%B"),
+            self.ctx.today.year,
+        )
 
     def park(self):
         """
@@ -1167,7 +1520,7 @@ class Candidate:
 
         # First look for verified results
         text = self.page.get(get_redirect=True)
-        results = re.findall(self._VerifiedR, text)
+        results = self.verifiedResults()
 
         if not results:
             out("%s: (ignoring, no verified results)" % self.cutTitle())
@@ -1186,7 +1539,7 @@ class Candidate:
             return
 
         # Check if the media page exist, if not we ignore this candidate
-        if not pywikibot.Page(SITE, self.fileName()).exists():
+        if not self.ctx.Page(self.fileName()).exists():
             out("%s: (WARNING: ignoring, can't find media page)" % self.cutTitle())
             return
 
@@ -1194,9 +1547,9 @@ class Candidate:
         vres = results[0]
 
         # If the suffix to the title has not been added, add it now
-        new_text = self.fixHeader(text, vres[3])
-        if new_text != text:
-            self.commit(text, new_text, self.page, "Fixed header")
+        fixHeader = FixHeader(self.headerStatus(vres[3]), self._proString, self._conString)
+        if fixHeader.apply(text) != text:
+            self.ctx.commitTransformation(self.page, fixHeader, "Fixed header", old_text=text)
 
         if vres[3] == "yes":
             self.handlePassedCandidate(vres)
@@ -1214,63 +1567,26 @@ class Candidate:
         """Must be implemented by subclass (do the park procedure for passing candidate)."""
         raise NotImplementedException()
 
-    @staticmethod
-    def commit(old_text, new_text, page, comment):
-        """
-        This will commit new_text to the page
-        and unless running in automatic mode it
-        will show you the diff and ask you to accept it.
-
-        @param old_text Used to show the diff
-        @param new_text Text to be submitted as the new page
-        @param page Page to submit the new text to
-        @param comment The edit comment
-        """
-
-        out("\n About to commit changes to: '%s'" % page.title())
-
-        # Show the diff
-        pywikibot.showDiff(
-            old_text,
-            new_text,
-            )
-
-        if G_Dry:
-            choice = "n"
-        elif G_Auto:
-            choice = "y"
-        else:
-            choice = pywikibot.bot.input_choice(
-                "Do you want to accept these changes to '%s' with comment '%s' ?"
-                % (page.title(), comment),
-                [('yes', 'y'), ('no', 'n'), ('quit', 'q')],
-            )
-
-        if choice == "y":
-            page.put(new_text, comment=comment, watchArticle=True, minorEdit=False)
-        elif choice == "q":
-            out("Aborting.")
-            sys.exit(0)
-        else:
-            out("Changes to '%s' ignored" % page.title())
-
 
 class FMCandidate(Candidate):
     """A candidate up for promotion."""
 
-    def __init__(self, page):
+    # The results templates added by the bot and by the reviewer
+    countedTemplate = "FMC-results-unreviewed"
+    reviewedTemplate = "FMC-results-reviewed"
+    resultKeys = ("support", "oppose", "neutral", "featured", "gallery", "alternative")
+
+    def __init__(self, page, ctx):
         """Constructor."""
         Candidate.__init__(
             self,
             page,
-            SupportR,
-            OpposeR,
-            NeutralR,
+            ctx,
+            SupportNameR,
+            OpposeNameR,
+            NeutralNameR,
             "featured",
             "not featured",
-            ReviewedTemplateR,
-            CountedTemplateR,
-            VerifiedResultR,
         )
         self._listPageName = "Commons:Featured media candidates/candidate list"
 
@@ -1304,7 +1620,7 @@ class FMCandidate(Candidate):
         # Check if we have an alternative for a multi media
         if self.mediaCount() > 1:
             if len(results) > 5 and len(results[5]):
-                if not pywikibot.Page(SITE, results[5]).exists():
+                if not self.ctx.Page(results[5]).exists():
                     out("%s: (ignoring, specified alternative not found)" % results[5])
                 else:
                     self._alternative = results[5]
@@ -1316,33 +1632,78 @@ class FMCandidate(Candidate):
         if not len(fgallery):
             out("%s: (ignoring, gallery not defined)" % self.cutTitle())
             return
-        self.addToFeaturedList(re.search(r"(.*?)(?:/|$)", fgallery).group(1))
-        self.addToCategorizedFeaturedList(gallery_without_removing_section)
-        self.makecategorynominator()
-        self.makecategoryuploader()
-        self.addAssessments()
-        self.addToCurrentMonth()
-        self.notifyNominator()
-        self.notifyUploader()
-        self.createMotdPage()
-        self.moveToLog(self._proString)
+
+        self.prefetchPark(fgallery)
+        try:
+            self.addToFeaturedList(re.search(r"(.*?)(?:/|$)", fgallery).group(1))
+            self.addToCategorizedFeaturedList(gallery_without_removing_section)
+            self.makecategorynominator()
+            self.makecategoryuploader()
+            self.addAssessments()
+            self.addToCurrentMonth()
+            self.notifyNominator()
+            self.notifyUploader()
+            self.createMotdPage()
+            self.moveToLog(self._proString)
+        finally:
+            # A step failing before createMotdPage() must not leave a gap in the MOTD schedule
+            slot, self._motdSlot = self._motdSlot, None
+            if slot:
+                self.ctx.motdScheduler().release(slot)
+
+    def prefetchPark(self, fgallery):
+        """
+        Load what the parking steps read with a few batched queries, such
+        that the steps mostly just make their edits: the texts of the
+        gallery page, the file page, the chronological list, the candidate
+        list, the missing user categories and the MOTD slot, and whether
+        the notifications and the log entry are already there.
+        """
+        registry = self.ctx.categoryRegistry()
+        titles = [
+            "Commons:Featured media/" + fgallery,
+            self.fileName(),
+            "Commons:Featured_media/chronological/%s %s"
+            % (self.ctx.today.strftime("%B"), self.ctx.today.year),
+            self._listPageName,
+        ]
+        titles.extend(
+            category
+            for category in (
+                "Category:Featured media nominated by %s" % self.nominator(link=False),
+                "Category:Featured media by %s" % uploader(self.ctx, self.fileName(), link=False),
+            )
+            if not registry.contains(category)
+        )
+        self._motdSlot = self.find_empty_motd_date()
+        if self._motdSlot:
+            titles.extend(self._motdSlot[:2])
+        appends = [
+            (talk_link, file)
+            for talk_link, notification, file in [self.nominatorNotification()]
+            + self.uploaderNotifications()
+        ]
+        appends.append((self.logTitle(), self.page.title()))
+        self.ctx.prefetch(titles, appends)
 
 
 class DelistCandidate(Candidate):
     """A delisting candidate."""
 
-    def __init__(self, page):
+    countedTemplate = "FMC-delist-results-unreviewed"
+    reviewedTemplate = "FMC-delist-results-reviewed"
+    resultKeys = ("delist", "keep", "neutral", "delisted")
+
+    def __init__(self, page, ctx):
         Candidate.__init__(
             self,
             page,
-            DelistR,
-            KeepR,
-            NeutralR,
+            ctx,
+            DelistNameR,
+            KeepNameR,
+            NeutralNameR,
             "delisted",
             "not delisted",
-            DelistReviewedTemplateR,
-            DelistCountedTemplateR,
-            VerifiedDelistResultR,
         )
         self._listPageName = "Commons:Featured media candidates/candidate list"
 
@@ -1362,66 +1723,2012 @@ class DelistCandidate(Candidate):
 
     def handlePassedCandidate(self, results):
         # Delistings does not care about the gallery
-        self.removeFromFeaturedLists(results)
+        titles = self.featuredPages()
+        # Load the pages of the steps below with a few batched queries
+        self.ctx.prefetch(
+            titles + [self.fileName(), self._listPageName],
+            [(self.logTitle(), self.page.title())],
+        )
+        self.removeFromFeaturedLists(results, titles)
         self.removeAssessments()
         self.moveToLog(self._proString)
 
-    def removeFromFeaturedLists(self, results):
-        """Remove a candidate from all featured lists."""
+    def featuredPages(self):
+        """
+        The titles of the featured media pages listing the file, looked
+        up in the featured index if -reindex built it. Otherwise, or if
+        the index does not know the file, the server is asked for the
+        pages using the file.
+        """
+        listed = self.ctx.featuredIndex().pagesWith(self.fileName())
+        if listed:
+            return list(
+                dict.fromkeys(
+                    title
+                    for title, section in listed
+                    if title.startswith("Commons:Featured media/")
+                )
+            )
+        return [
+            ref.title()
+            for ref in self.getFilePage().getReferences(withTemplateInclusion=False)
+            if ref.title().startswith("Commons:Featured media/")
+        ]
+
+    def removeFromFeaturedLists(self, results, titles=None):
+        """
+        Remove a candidate from all featured lists.
+
+        @param titles The titles of the featured media pages listing the file if already known
+        """
         # We skip checking the page with the 4 newest medias
         # the chance that we are there is very small and even
         # if we are we will soon be rotated away anyway.
         # So just check and remove the candidate from any gallery pages
 
-        references = self.getFilePage().getReferences(withTemplateInclusion=False)
-        for ref in references:
+        if titles is None:
+            titles = self.featuredPages()
+        for ref in map(self.ctx.Page, titles):
             if ref.title().startswith("Commons:Featured media/"):
                 if ref.title().startswith("Commons:Featured media/chronological"):
                     out("Adding delist note to %s" % ref.title())
-                    old_text = ref.get(get_redirect=True)
-                    now = today
-                    new_text = re.sub(
-                        r"(([Ff]ile|[Ii]mage):%s.*)\n"
-                        % wikipattern(self.cleanTitle(keepExtension=True)),
-                        r"\1 '''Delisted %d-%02d-%02d (%s-%s)'''\n"
-                        % (now.year, now.month, now.day, results[1], results[0]),
-                        old_text,
-                    )
-                    self.commit(
-                        old_text, new_text, ref, "Delisted [[%s]]" % self.fileName()
+                    now = self.ctx.today
+                    self.ctx.commitTransformation(
+                        ref,
+                        AddDelistNote(
+                            self.cleanTitle(keepExtension=True),
+                            "Delisted %d-%02d-%02d (%s-%s)"
+                            % (now.year, now.month, now.day, results[1], results[0]),
+                        ),
+                        "Delisted [[%s]]" % self.fileName(),
                     )
                 else:
-                    old_text = ref.get(get_redirect=True)
-                    new_text = re.sub(
-                        r"(\[\[)?([Ff]ile|[Ii]mage):%s.*\n"
-                        % wikipattern(self.cleanTitle(keepExtension=True)),
-                        "",
-                        old_text,
-                    )
-                    self.commit(
-                        old_text, new_text, ref, "Removing [[%s]]" % self.fileName()
+                    self.ctx.commitTransformation(
+                        ref,
+                        RemoveFile(self.cleanTitle(keepExtension=True)),
+                        "Removing [[%s]]" % self.fileName(),
                     )
 
-    def removeAssessments(self):
-        """Remove FM status from an media."""
-        mediaPage = self.getFilePage()
-        old_text = mediaPage.get(get_redirect=True)
+    def removeAssessments(self):
+        """Remove FM status from an media."""
+        mediaPage = self.getFilePage()
+        self.ctx.commitTransformation(mediaPage, DelistAssessments(), "Delisted")
+
+TRANSFORMATIONS = {}
+
+
+def transformation(cls):
+    """Class decorator registering a Transformation under its class name."""
+    TRANSFORMATIONS[cls.__name__] = cls
+    return cls
+
+
+class Transformation:
+    """
+    A change of a page text that can be applied again
+
+    Instead of a precomputed new text the steps hand a transformation
+    to commitTransformation(), which can then apply it once more to
+    the current text if the page changed in the meantime.
+
+    A transformation is fully described by its class name and its
+    arguments, which must be plain strings, numbers or transformations,
+    such that it can be stored and recreated using toDict()/fromDict().
+    apply() must return the text unchanged if the change is already
+    there, such that applying a transformation twice is harmless.
+    """
+
+    def __init__(self, *args):
+        self.args = args
+
+    def apply(self, text):
+        """Must be implemented by the subclasses (return the changed text)."""
+        raise NotImplementedException()
+
+    def toDict(self):
+        return {
+            "transformation": self.__class__.__name__,
+            "args": [
+                arg.toDict() if isinstance(arg, Transformation) else arg
+                for arg in self.args
+            ],
+        }
+
+    @staticmethod
+    def fromDict(data):
+        return TRANSFORMATIONS[data["transformation"]](
+            *[
+                Transformation.fromDict(arg)
+                if isinstance(arg, dict) and "transformation" in arg
+                else arg
+                for arg in data["args"]
+            ]
+        )
+
+
+@transformation
+class Chain(Transformation):
+    """Apply several transformations after each other."""
+
+    def apply(self, text):
+        for step in self.args:
+            text = step.apply(text)
+        return text
+
+
+@transformation
+class AppendText(Transformation):
+    """Append a text, unless the page already matches the optional regexp."""
+
+    def __init__(self, appended, unless=None):
+        Transformation.__init__(self, appended, unless)
+
+    def apply(self, text):
+        appended, unless = self.args
+        if unless and re.search(unless, text):
+            return text
+        return text + appended
+
+
+@transformation
+class AppendUnlessCalled(Transformation):
+    """Append a text, unless the page already calls one of the templates."""
+
+    def apply(self, text):
+        document = NominationDocument(text)
+        if any(document.hasTemplate(name) for name in self.args[1:]):
+            return text
+        return text + self.args[0]
+
+
+@transformation
+class CreatePage(Transformation):
+    """Set the text of a page that is still empty."""
+
+    def apply(self, text):
+        return text if text else self.args[0]
+
+
+@transformation
+class SetText(Transformation):
+    """
+    Replace the text of a page by the new text, but only if it still
+    is the old text. A page that already has the new text is left as it
+    is, a page that was changed since raises StaleEdit, like -apply
+    skips changed pages.
+    """
+
+    def apply(self, text):
+        old_text, new_text = self.args
+        if text not in (old_text, new_text):
+            raise StaleEdit("the page was changed since the changes were made")
+        return new_text
+
+
+@transformation
+class RemoveTransclusion(Transformation):
+    """Remove the transclusion of a page, like a candidate from the candidate list."""
+
+    def apply(self, text):
+        return re.sub(r"{{\s*%s\s*}}.*?\n?" % wikipattern(self.args[0]), "", text)
+
+
+@transformation
+class FixHeader(Transformation):
+    """Append the status, like ', featured', to the header of a candidate."""
+
+    def apply(self, text):
+        status, proString, conString = self.args
+
+        # Check if they are alredy there
+        if re.match(r"===.*(%s|%s)===" % (proString, conString), text):
+            return text
+
+        return re.sub(r"(===.*)(===)", r"\1%s\2" % status, text, 1)
+
+
+@transformation
+class UpdateFeaturedList(Transformation):
+    """
+    Add files first in the galleries of 'Commons:Featured media, list'
+    and remove the oldest ones, the argument is a list of [gallery, file].
+    """
+
+    def apply(self, text):
+        featuredList = FeaturedListPage(text)
+        for gallery, file in self.args[0]:
+            featuredList.promote(gallery, file)
+        return featuredList.render()
+
+
+@transformation
+class InsertIntoGallery(Transformation):
+    """
+    Add a file to the end of the gallery of a section of a featured
+    media gallery page, or to the last gallery of the page if the
+    section is not found.
+    """
+
+    def apply(self, text):
+        file, section = self.args
+
+        # First check if we are already on the page,
+        # in that case skip. Can happen if the process
+        # have been previously interrupted.
+        if re.search(wikipattern(file), text):
+            return text
+
+        return GalleryPage(text).insert(file, section)
+
+
+@transformation
+class AddAssessment(Transformation):
+    """Add the FM promoted template and the user categories to a file description page."""
+
+    def apply(self, text):
+        comnom, nomuser, upuser = self.args
+
+        AssR = re.compile(r"{{\s*FM[\s_]promoted\s*\|(.*)}}")
+
+        # First check if there already is an FV_promoted template on the page
+        params = re.search(AssR, text)
+        if params:
+            # Make sure to remove any existing com/features or subpage params
+            # TODO: 'com' will be obsolete in the future and can then be removed
+            # TODO: 'subpage' is the old name of com-nom. Can be removed later.
+            params = re.sub(r"\|\s*(?:featured|com)\s*=\s*\d+", "", params.group(1))
+            params = re.sub(r"\|\s*(?:subpage|com-nom)\s*=\s*[^{}|]+", "", params)
+            params += "|featured=1"
+            params += comnom
+            if params.find("|") != 0:
+                params = "|" + params
+            new_ass = "{{FM promoted%s}}" % params
+            return re.sub(AssR, lambda m: new_ass, text)
+
+        # There is no FV_promoted template so just add it
+        end = findEndOfTemplate(text, "[Ii]nformation")
+        return (
+            text[:end]
+            + "\n{{FM promoted|featured=1%s}}" % comnom
+            + text[end:]
+            + "\n[[Category:Featured media nominated by %s]]\n" % nomuser
+            + "[[Category:Featured media by %s]]" % upuser
+        )
+
+
+@transformation
+class AddToChronological(Transformation):
+    """Add a file to the gallery of a chronological month page, numbering it."""
+
+    def apply(self, text):
+        file, description, month = self.args
+
+        # First check if we are already on the page,
+        # in that case skip. Can happen if the process
+        # have been previously interrupted.
+        if re.search(wikipattern(file), text):
+            return text
+
+        # Find the number of lines in the gallery, if AttributeError set count as 1
+        m = re.search(r"(?ms)<gallery>(.*)</gallery>", text)
+        try:
+            count = m.group(0).count("\n")
+        except AttributeError:
+            count = 1
+
+        if count == 1:
+            text = "{{subst:FMArchiveChrono}}\n== %s ==\n<gallery>\n</gallery>" % month
+
+        # We just need to append to the bottom of the gallery
+        entry = "%s|%d %s\n</gallery>" % (file, count, description)
+        return re.sub("</gallery>", lambda m: entry, text)
+
+
+@transformation
+class AddDelistNote(Transformation):
+    """Add a delist note after a file in a chronological page."""
+
+    def apply(self, text):
+        name, note = self.args
+        if "'''%s'''" % note in text:
+            return text
+        return re.sub(
+            r"(([Ff]ile|[Ii]mage):%s.*)\n" % wikipattern(name),
+            lambda m: "%s '''%s'''\n" % (m.group(1), note),
+            text,
+        )
+
+
+@transformation
+class RemoveFile(Transformation):
+    """Remove the gallery line of a file."""
+
+    def apply(self, text):
+        return re.sub(
+            r"(\[\[)?([Ff]ile|[Ii]mage):%s.*\n" % wikipattern(self.args[0]), "", text
+        )
+
+
+@transformation
+class DelistAssessments(Transformation):
+    """Mark the file description page as delisted."""
+
+    def apply(self, text):
+        # First check for the old {{Featured media}} template
+        text = re.sub(r"{{[Ff]eatured[ _]media}}", "{{Delisted media}}", text)
+
+        # Then check for the assessments template
+        # The replacement string needs to use the octal value for the char '2' to
+        # not confuse python as '\12\2' would obviously not work
+        return re.sub(
+            r"({{[Aa]ssessments\s*\|.*(?:com|featured)\s*=\s*)1(.*?}})",
+            r"\1\062\2",
+            text,
+        )
+
+
+class NominationDocument:
+    """
+    The parsed text of a nomination page
+
+    The page is scanned once for headings, media links, galleries,
+    gallery links, result lines and template calls. The voting templates
+    are counted on the filtered text, see filter_content(), which is
+    scanned once for template calls the first time it is needed, and
+    the parameters of the template calls are parsed on first use.
+
+    User written pages can be anything, so every scan takes time linear
+    in the length of the text: the tokens are written such that the
+    regexp engine can not backtrack over more than the token itself,
+    and what a token needs to know about the rest of its line is looked
+    up once per line. A scan that still takes more than budget seconds
+    of CPU time raises PathologicalPage.
+    """
+
+    TokenR = re.compile(
+        r"^(?=={1,4}.+={1,4}[ \t\r]*$)(?P<heading>)"                    # Heading
+        r"|(?P<file>\[\[(?:[Ff]ile|[Ii]mage):)"                          # Media link
+        r"|(?P<gallery>\[\[Commons:Featured[_ ]media/)"                   # Gallery link
+        r"|(?P<galleryStart><gallery\b[^<>]*>)"                           # Gallery start
+        r"|(?P<galleryEnd></gallery>)"                                    # Gallery end
+        r"|(?P<result>'''result:''')"                                     # Old result line
+        r"|{{(?=(?P<space>\s*))(?P=space)"                                # Template call
+        r"(?=(?P<template>[^{}|\[\]\n]*))(?P=template)(?=(?P<trail>\s*))(?P=trail)(?=\||}})",
+        re.MULTILINE,
+    )
+    TemplateR = re.compile(r"{{(?=(\s*))\1(?=([^{}|\n]*))\2(?=(\s*))\3(?=\||}})")
+    GalleryLinkR = re.compile(r"\[\[Commons:Featured[_ ]media/([^\]]{1,180})")
+    CallTokenR = re.compile(r"{{|}}|\[\[|\]\]|\|")
+
+    def __init__(self, text, budget=None):
+        self.text = text
+        # The CPU seconds left for scanning the page
+        self.budget = PAGE_CPU_BUDGET if budget is None else budget
+        self.sections = 0
+        # The media links as (name, size in px or None, thumb)
+        self.files = []
+        # The file lines of the first gallery
+        self.setFiles = []
+        self.gallery = ""
+        self.description = None
+        # Template or result line -> positions of the calls
+        self._calls = {}
+        self._templates = []
+        self._filtered = None
+        self._parameters = None
+        galleries = []
+        start = None
+        # The line of the current token and of the last mention of the gallery,
+        # which is searched for up to the position of the last gallery link
+        line = 0
+        mention = -2
+        counted = searched = 0
+        # The next ] and the next line break after the last media link token
+        bracket = newline = -1
+        # Like TokenR.finditer(text), but going on after the media links
+        position = 0
+        tokens = iter(lambda: self.TokenR.search(text, position), None)
+        for m in self._withinBudget(tokens):
+            position = max(m.end(), m.start() + 1)
+            line += text.count("\n", counted, m.start())
+            counted = m.start()
+            if m.group("heading") is not None:
+                self.sections += 1
+            elif m.group("file"):
+                # The link runs to the first ], which must start a ]] on the same line
+                if bracket < m.end():
+                    bracket = text.find("]", m.end())
+                    bracket = len(text) if bracket == -1 else bracket
+                if newline < m.end():
+                    newline = text.find("\n", m.end())
+                    newline = len(text) if newline == -1 else newline
+                if bracket >= newline or not text.startswith("]]", bracket):
+                    continue
+                # Unlike the old regexp, [[File:A.jpg]] [[File:B.jpg|300px]] are two links
+                name, pipe, params = text[m.end() : bracket].partition("|")
+                if not name:
+                    continue
+                position = bracket + 2
+                params = pipe + params
+                size = FilesSizeR.search(params)
+                self.files.append(
+                    (
+                        text[m.start() + 2 : m.end()] + name,
+                        int(size.group(1)) if size else None,
+                        bool(FilesThumbR.search(params)),
+                    )
+                )
+            elif m.group("gallery"):
+                # The link must follow a mention of the gallery on the same or the previous line
+                found = text.rfind("Gallery", searched, m.start())
+                if found != -1:
+                    mention = line - text.count("\n", found, m.start())
+                searched = m.start()
+                link = self.GalleryLinkR.match(text, m.start())
+                if link and line - mention <= 1:
+                    self.gallery = link.group(1)
+            elif m.group("galleryStart"):
+                start = m.end()
+            elif m.group("galleryEnd"):
+                if start is not None:
+                    galleries.append((start, m.start()))
+                start = None
+            elif m.group("result"):
+                self._calls.setdefault("'''result:'''", []).append(m.start())
+            else:
+                # The space before the name can span lines, look for tokens in it
+                position = m.start() + 2
+                name = m.group("template").strip()
+                if not name:
+                    continue
+                self._calls.setdefault(name, []).append(m.start())
+                self._templates.append((m.start(), m.end(), name))
+                if name == "Candidatedescription" and self.description is None:
+                    end = text.find("\n", m.end())
+                    rest = text[m.end() : len(text) if end == -1 else end]
+                    if rest.startswith("}}"):
+                        self.description = rest[2:]
+        if galleries:
+            start, end = galleries[0]
+            for line in text[start:end].splitlines():
+                if line.startswith("File:"):
+                    self.setFiles.append(re.sub(r"\|.*", "", line))
+
+    def _withinBudget(self, tokens):
+        """Pass the tokens on, raising PathologicalPage once the budget is used up."""
+        start = time.thread_time()
+        try:
+            for count, token in enumerate(tokens, 1):
+                if count % 1000 == 0 and time.thread_time() - start > self.budget:
+                    raise PathologicalPage(
+                        "took more than %s seconds of CPU time to parse" % PAGE_CPU_BUDGET
+                    )
+                yield token
+        finally:
+            self.budget -= time.thread_time() - start
+
+    def mediaCount(self):
+        """
+        The number of displayed medias, if there are several the
+        thumbnails and the medias of 150px or less are not counted.
+        """
+        count = len(self.files)
+        if count >= 2:
+            for name, size, thumb in self.files:
+                if thumb or (size is not None and size <= 150):
+                    count -= 1
+        return count
+
+    def matches(self, regex, name):
+        """
+        Like regex.findall() on the text, for a regex matching at the
+        calls of the template name, or at the "'''result:'''" lines.
+        """
+        found = []
+        end = 0
+        for start in self._calls.get(name, ()):
+            m = regex.match(self.text, start) if start >= end else None
+            if m:
+                found.append(m.groups(""))
+                end = m.end()
+        return found
+
+    def parameters(self, name):
+        """
+        The parameters of every closed call of the template name, as
+        dicts of the named parameters and of the positional ones by
+        their number as a string, all values stripped.
+        """
+        if self._parameters is None:
+            self._parameters = self._parseCalls()
+        calls = []
+        for args in self._withinBudget(self._parameters.get(name, ())):
+            parameters = {}
+            for number, (start, end) in enumerate(args, 1):
+                arg = self.text[start:end]
+                key, equals, value = arg.partition("=")
+                if equals:
+                    parameters[key.strip()] = value.strip()
+                else:
+                    parameters[str(number)] = arg.strip()
+            calls.append(parameters)
+        return calls
+
+    def hasTemplate(self, name):
+        """Check for a closed call of the template name."""
+        if self._parameters is None:
+            self._parameters = self._parseCalls()
+        return name in self._parameters
+
+    def _parseCalls(self):
+        """
+        Find the template calls and their arguments in one pass, keeping
+        a stack of the open calls and links such that the pipes of nested
+        calls and links are not taken as arguments. Calls that are never
+        closed are left out, like names longer than any page title.
+        Returns name -> [(start, end) of each argument of each call].
+        """
+        text = self.text
+        calls = {}
+        # The open calls and links as [token, start of the current part, parts]
+        stack = []
+        for m in self._withinBudget(self.CallTokenR.finditer(text)):
+            token = m.group()
+            if token == "{{" or token == "[[":
+                stack.append([token, m.end(), []])
+            elif token == "|":
+                if stack and stack[-1][0] == "{{":
+                    stack[-1][2].append((stack[-1][1], m.start()))
+                    stack[-1][1] = m.end()
+            elif token == "]]":
+                if stack and stack[-1][0] == "[[":
+                    stack.pop()
+            else:
+                while stack and stack[-1][0] == "[[":
+                    stack.pop()
+                if stack:
+                    token, start, parts = stack.pop()
+                    parts.append((start, m.start()))
+                    start, end = parts[0]
+                    if end - start <= 255:
+                        calls.setdefault(text[start:end].strip(), []).append(parts[1:])
+        return calls
+
+    def countTemplates(self, nameR, filtered=True):
+        """
+        Count the calls of the templates with names fully matching nameR,
+        by default in the filtered text. Like the voting regexes used to,
+        a call with parameters runs to the last }} of the line, any other
+        calls in it are not counted.
+        """
+        if filtered:
+            if self._filtered is None:
+                text = filter_content(self.text)
+                self._filtered = (
+                    text,
+                    [
+                        (m.start(), m.end(), m.group(2).strip())
+                        for m in self._withinBudget(self.TemplateR.finditer(text))
+                    ],
+                )
+            text, templates = self._filtered
+        else:
+            text, templates = self.text, self._templates
+        count = 0
+        skip = 0
+        # The end of the current line and the position of its last }}
+        line = last = -1
+        for start, end, name in templates:
+            if start < skip or not nameR.match(name):
+                continue
+            if text.startswith("|", end):
+                if line < end:
+                    line = text.find("\n", end)
+                    line = len(text) if line == -1 else line
+                    last = text.rfind("}}", end, line)
+                if last < end:
+                    continue
+                skip = last + 2
+            else:
+                skip = end + 2
+            count += 1
+        return count
+
+
+class FeaturedListPage:
+    """
+    The galleries of 'Commons:Featured media, list'
+
+    Each gallery, started by a heading like '== {{{1|Animals}}} ==',
+    is a queue of a fixed length with the newest file first. The page
+    is parsed in one linear scan, any number of promotions can then be
+    made before the new text is rendered in one pass.
+    """
+
+    GalleryR = re.compile(
+        r"^==[ \t]*{{{[ \t]*\d+[ \t]*\|([^{}|]*?)[ \t]*}}}[ \t]*==[ \t]*\n"
+        r"\s*<gallery[^>\n]*>[ \t]*\n"
+        r"|^</gallery>",
+        re.MULTILINE,
+    )
+
+    def __init__(self, text):
+        self.text = text
+        # Gallery key -> [start, end, files], start and end delimit the file lines
+        self.galleries = {}
+        self._changed = []
+        name = start = None
+        for m in self.GalleryR.finditer(text):
+            if m.group(1) is not None:
+                name, start = m.group(1), m.end()
+            elif name is not None:
+                files = text[start : m.start()].splitlines()
+                self.galleries.setdefault(sectionKey(name), [start, m.start(), files])
+                name = None
+        self._listed = set(
+            fileKey(line) for gallery in self.galleries.values() for line in gallery[2]
+        )
+
+    def promote(self, gallery, file):
+        """
+        Add file first in the gallery and drop the last one, unless the
+        file is already listed or the gallery is not found.
+        """
+        entry = self.galleries.get(sectionKey(gallery))
+        if entry is None:
+            out("Gallery '%s' not found in the featured list" % gallery, color="lightred")
+            return
+        if fileKey(file) in self._listed:
+            return
+        files = entry[2]
+        entry[2] = ([file] + files)[: max(len(files), 1)]
+        self._listed.add(fileKey(file))
+        if entry not in self._changed:
+            self._changed.append(entry)
+
+    def render(self):
+        """The text with all promotions made."""
+        parts = []
+        pos = 0
+        for start, end, files in sorted(self._changed):
+            parts.append(self.text[pos:start])
+            parts.append("".join(file + "\n" for file in files))
+            pos = end
+        parts.append(self.text[pos:])
+        return "".join(parts)
+
+
+def fileKey(file):
+    """Normalize a gallery line or file title for comparing files."""
+    file = file.split("|", 1)[0].strip().replace("_", " ")
+    file = re.sub(r"^(?:[Ff]ile|[Ii]mage)\s*:\s*", "File:", file)
+    return file[:5] + file[5:6].upper() + file[6:]
+
+
+def isFeaturedPage(title):
+    """Whether the page is one of the featured media pages indexed by FeaturedIndex."""
+    return title.startswith("Commons:Featured media/") or title == "Commons:Featured media, list"
+
+
+def keepsLater(ctx):
+    """
+    Whether the edits left to the end of the run are kept in the journal
+    until they are made, such that the next run makes them if this one
+    is stopped before. Not when the edits are only shown or planned.
+    """
+    return ctx.editPlan is None and not ctx.dry
+
+
+def addToFeaturedListLater(ctx, gallery, file):
+    """Remember a promotion to be added by flushFeaturedList()."""
+    with ctx._lock:
+        ctx._featuredListPromotions.append([gallery, file])
+    if keepsLater(ctx):
+        ctx.journal().addLater("featuredlist", file, [gallery, file])
+
+
+def flushFeaturedList(ctx):
+    """
+    Add all the promotions collected during the run, and those left by
+    earlier runs, to the featured list in one edit.
+    """
+    with ctx._lock:
+        promotions = list(ctx._featuredListPromotions)
+        del ctx._featuredListPromotions[:]
+    if keepsLater(ctx):
+        for gallery, file in ctx.journal().later("featuredlist"):
+            if file not in [promotion[1] for promotion in promotions]:
+                promotions.append([gallery, file])
+    page = ctx.Page("Commons:Featured media, list")
+    if not keepsLater(ctx):
+        _flushFeaturedList(ctx, page, promotions)
+    # Other workers flush the promotions kept in the journal as well
+    elif promotions and not ctx.leased(page.title(), _flushFeaturedList, ctx, page, promotions):
+        out(
+            "'%s' is updated by another worker, leaving the promotions to the next run"
+            % page.title(),
+            color="lightyellow",
+        )
+
+
+def _flushFeaturedList(ctx, page, promotions):
+    """Add the promotions to the featured list, see flushFeaturedList()."""
+    done = [promotion for promotion in promotions if ctx.listsFile(page, promotion[1])]
+    promotions = [promotion for promotion in promotions if promotion not in done]
+    if promotions and ctx.commitTransformation(
+        page,
+        UpdateFeaturedList(promotions),
+        "Added %s" % ", ".join("[[%s]]" % file for gallery, file in promotions),
+    ):
+        done.extend(promotions)
+    if keepsLater(ctx):
+        for gallery, file in done:
+            ctx.journal().removeLater("featuredlist", file)
+
+
+def notifyLater(ctx, talk_link, notification, file, step):
+    """Remember a notification to be posted by flushNotifications()."""
+    title = ctx.Page(talk_link).title()
+    with ctx._lock:
+        notifications = ctx._notifications.setdefault(title, [])
+        if file in [entry[1] for entry in notifications]:
+            return
+        notifications.append((notification, file, step))
+    if keepsLater(ctx):
+        ctx.journal().addLater(
+            "notification", "%s|%s" % (title, file), [title, notification.toDict(), file, step]
+        )
+
+
+def flushNotifications(ctx):
+    """
+    Post all the notifications collected during the run, with one edit
+    per user talk page for all the promotions of that user.
+
+    Missing and locked talk pages are reported but ignored,
+    since it is just the user notification. The notifications left
+    by earlier runs are posted as well.
+    """
+    with ctx._lock:
+        notifications = dict(ctx._notifications)
+        ctx._notifications.clear()
+    if keepsLater(ctx):
+        for title, notification, file, step in ctx.journal().later("notification"):
+            entries = notifications.setdefault(title, [])
+            if file not in [entry[1] for entry in entries]:
+                entries.append((Transformation.fromDict(notification), file, step))
+    # Whether the talk pages exist and already have the notifications, in a few
+    # queries for those not already looked up while parking
+    with ctx._lock:
+        unknown = [
+            (talk_link, file)
+            for talk_link, entries in notifications.items()
+            for notification, file, step in entries
+            if (talk_link, file) not in ctx._uses
+        ]
+    if unknown:
+        ctx.prefetch([], unknown)
+    for talk_link, entries in notifications.items():
+        if not keepsLater(ctx):
+            _flushNotifications(ctx, talk_link, entries)
+        # Other workers post the notifications kept in the journal as well,
+        # with the lease the journal is checked after the last one posted
+        elif not ctx.leased(talk_link, _flushNotifications, ctx, talk_link, entries):
+            out(
+                "'%s' is edited by another worker, leaving the notifications to the next run"
+                % talk_link,
+                color="lightyellow",
+            )
+
+
+def _flushNotifications(ctx, talk_link, entries):
+    """Post the notifications of one talk page, see flushNotifications()."""
+    try:
+        done = ctx.commitAppends(
+            ctx.Page(talk_link),
+            [(notification, file) for notification, file, step in entries],
+            "FMC promotion of %s"
+            % ", ".join("[[%s]]" % file for notification, file, step in entries),
+        )
+    except pywikibot.NoPage:
+        out(
+            "%s: No such page '%s' but ignoring..." % (entries[0][2], talk_link),
+            color="lightred",
+        )
+        done = True
+    except pywikibot.LockedPage as error:
+        out(
+            "Page is locked '%s', but ignoring since it's just the user notification."
+            % error,
+            color="lightyellow",
+        )
+        done = True
+    if done and keepsLater(ctx):
+        for notification, file, step in entries:
+            ctx.journal().removeLater("notification", "%s|%s" % (talk_link, file))
+
+
+class GalleryPage:
+    """
+    Index of the sections and galleries of a featured media gallery page
+
+    The page is scanned once for headings, anchors and <gallery> tags.
+    Every heading and anchor is indexed by its normalized key, see
+    sectionKey(), and points to the first gallery following it.
+    """
+
+    TokenR = re.compile(
+        r"^(=+)[ \t]*(.+?)[ \t]*\1[ \t]*$"      # Heading (1, 2)
+        r"|{{\s*[Aa]nchors?\s*\|([^{}]*)}}"      # Anchor template (3)
+        r"|\bid\s*=\s*\"([^\"]*)\""               # Html anchor (4)
+        r"|(<gallery\b[^>]*>)"                   # Gallery start (5)
+        r"|(</gallery>)",                        # Gallery end (6)
+        re.MULTILINE,
+    )
+
+    def __init__(self, text):
+        self.text = text
+        # The galleries as (start, end) offsets, end is the position of </gallery>
+        self.galleries = []
+        self.sections = {}
+        pending = []
+        start = None
+        for m in self.TokenR.finditer(text):
+            if m.group(2):
+                pending.append(m.group(2))
+            elif m.group(3):
+                pending.extend(m.group(3).split("|"))
+            elif m.group(4):
+                pending.append(m.group(4))
+            elif m.group(5):
+                start = m.end()
+            elif m.group(6) and start is not None:
+                self.galleries.append((start, m.start()))
+                for name in pending:
+                    self.sections.setdefault(sectionKey(name), len(self.galleries) - 1)
+                pending = []
+                start = None
+
+    def gallery(self, section=None):
+        """
+        The (start, end) of the gallery of the section,
+        or of the last gallery if the section is not found.
+        None if the page has no galleries.
+        """
+        if section is not None:
+            index = self.sections.get(sectionKey(section))
+            if index is not None:
+                return self.galleries[index]
+        return self.galleries[-1] if self.galleries else None
+
+    def insert(self, file, section=None):
+        """Return the text with file added to the end of the gallery of the section."""
+        gallery = self.gallery(section)
+        if not gallery:
+            return self.text
+        end = gallery[1]
+        # Keep </gallery> on a line of its own
+        line = file + "\n" if self.text[end - 1 : end] == "\n" else "\n" + file + "\n"
+        return self.text[:end] + line + self.text[end:]
+
+
+def sectionKey(name):
+    """
+    Normalize a section name or anchor such that the different ways
+    users write them compare equal, like linked words, underscores
+    from copied urls and differences in case or spacing.
+    """
+    name = re.sub(r"\[\[(?:[^|\]]*\|)?([^\]]*)\]\]", r"\1", name)
+    name = re.sub(r"'{2,}", "", name)
+    if " " not in name:
+        # Copied from an url, like Birds_.28Owls.29 or Birds_%28Owls%29
+        name = urllib.parse.unquote(re.sub(r"\.([0-9A-F]{2})", r"%\1", name))
+    return " ".join(name.replace("_", " ").split()).casefold()
+
+
+class EditPlan:
+    """
+    All the edits of a run, computed up front to be reviewed and applied later
+
+    Instead of being saved the edits are collected here, together with
+    the revision id each page had when it was read and a diff for the
+    reviewer. Later steps see the planned texts, such that the plan
+    contains everything the run would have done.
+    """
+
+    def __init__(self, edits=None):
+        self.edits = edits or []
+        self._texts = {}
+        self._lock = threading.Lock()
+
+    def text(self, page):
+        """The planned text of the page, None if no edits are planned for it."""
+        return self._texts.get(page.title())
+
+    def add(self, page, old_text, new_text, comment, transformation=None):
+        """Add an edit to the plan."""
+        title = page.title()
+        with self._lock:
+            if title in self._texts:
+                revid = [edit["revid"] for edit in self.edits if edit["title"] == title][0]
+            else:
+                try:
+                    revid = page.latest_revision_id
+                except pywikibot.NoPage:
+                    revid = None
+            self._texts[title] = new_text
+            self.edits.append(
+                {
+                    "title": title,
+                    "revid": revid,
+                    "comment": comment,
+                    "diff": diffText(old_text, new_text),
+                    "transformation": transformation.toDict() if transformation else None,
+                    "text": new_text,
+                }
+            )
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({"edits": self.edits}, f, indent=1, ensure_ascii=False)
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            return EditPlan(json.load(f)["edits"])
+
+    def apply(self, ctx):
+        """
+        Make the edits of the plan using the run context ctx
+
+        All edits of a page are saved as one edit and the pages are
+        handled in parallel. If all the edits of a page have
+        transformations they are applied to the current text, which
+        also covers pages that changed since the plan was made. Other
+        pages are only saved if they still have the revision id the
+        plan was made against.
+        """
+        pages = {}
+        for edit in self.edits:
+            pages.setdefault(edit["title"], []).append(edit)
+
+        threads = []
+        for title, edits in pages.items():
+            while threading.activeCount() >= config.max_external_links:
+                time.sleep(0.1)
+            thread = threading.Thread(target=self._applyPage, args=(ctx, title, edits))
+            thread.start()
+            threads.append(thread)
+            if ctx.abort:
+                break
+        for thread in threads:
+            thread.join()
+
+    @staticmethod
+    def _applyPage(ctx, title, edits):
+        page = ctx.Page(title)
+        ctx.forgetText(page)
+        comments = []
+        for edit in edits:
+            if edit["comment"] not in comments:
+                comments.append(edit["comment"])
+
+        try:
+            old_text = ctx.getText(page)
+            revid = ctx.baseRevid(page, old_text)
+        except pywikibot.NoPage:
+            old_text = ""
+            revid = None
+
+        transformation = None
+        if all(edit["transformation"] for edit in edits):
+            if revid != edits[0]["revid"]:
+                out(
+                    "'%s' changed since the plan was made, applying the changes to the current text"
+                    % title,
+                    color="lightyellow",
+                )
+            transformation = Chain(
+                *[Transformation.fromDict(edit["transformation"]) for edit in edits]
+            )
+            new_text = transformation.apply(old_text)
+        elif revid == edits[0]["revid"]:
+            new_text = edits[-1]["text"]
+        else:
+            out(
+                "Skipping '%s', it changed since the plan was made (revision %s, planned against %s)"
+                % (title, revid, edits[0]["revid"]),
+                color="lightred",
+            )
+            return
+
+        if new_text == old_text:
+            out("Skipping '%s', already done." % title, color="lightred")
+            return
+        try:
+            if transformation:
+                # Edit conflicts are rebased on the current text
+                ctx.commitTransformation(
+                    page, transformation, "; ".join(comments), old_text, create=not old_text
+                )
+            else:
+                ctx.commit(old_text, new_text, page, "; ".join(comments))
+        except (pywikibot.EditConflict, pywikibot.LockedPage) as error:
+            out("Could not save '%s' '%s'" % (title, error), color="lightred")
+
+
+class ReviewPipeline:
+    """
+    Interactive review that does not wait for the server between questions
+
+    A background thread runs the check on the upcoming candidates using
+    planning copies of the run context, see RunContext.planningContext(),
+    and queues the edits and the output of each candidate. The operator
+    reviews the queued edits of one candidate while the next ones are
+    computed. Accepted edits are made like -apply makes them, applying
+    their transformations again to the current text of each page. The
+    operator is only asked once more if someone else changed the page
+    since it was planned.
+    """
+
+    def __init__(self, ctx, check, candidates, lookahead=3):
+        self.ctx = ctx
+        self.check = check
+        self.candidates = candidates
+        self._queue = queue.Queue(maxsize=lookahead)
+        # Title -> revision id of the pages saved during the review
+        self._saved = {}
+
+    def _plan(self):
+        """Plan the candidates in order and queue (candidate, context, output, error)."""
+        for candidate in self.candidates:
+            if self.ctx.abort:
+                break
+            planning = self.ctx.planningContext()
+            candidate.ctx = planning
+            _output.lines = lines = []
+            error = None
+            try:
+                self.check(candidate)
+            except pywikibot.NoPage as e:
+                out("No such page '%s'" % e, color="lightred")
+            except pywikibot.LockedPage as e:
+                out("Page is locked '%s'" % e, color="lightred")
+            except PathologicalPage as e:
+                candidate.skipPathological(e)
+            except Exception as e:
+                error = e
+            finally:
+                _output.lines = None
+                candidate.ctx = self.ctx
+            self._queue.put((candidate, planning, lines, error))
+            if error:
+                return
+        self._queue.put(None)
+
+    def run(self):
+        """Review the edits of all candidates."""
+        thread = threading.Thread(target=self._plan, daemon=True)
+        thread.start()
+        i = 1
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            candidate, planning, lines, error = item
+            out(
+                "(%03d) " % i,
+                newline=False,
+                date=None if self.ctx.noTime else self.ctx.today,
+            )
+            for line in lines:
+                out(*line)
+            if error:
+                raise error
+            try:
+                self.review(candidate, planning)
+            finally:
+                candidate.release()
+            i += 1
+            if self.ctx.abort:
+                break
+
+    def review(self, candidate, planning):
+        """Ask about the planned edits of the candidate, holding its lease."""
+        for gallery, file in planning._featuredListPromotions:
+            addToFeaturedListLater(self.ctx, gallery, file)
+        for talk_link, entries in planning._notifications.items():
+            for notification, file, step in entries:
+                notifyLater(self.ctx, talk_link, notification, file, step)
+        if not planning.editPlan.edits:
+            return
+        title = candidate.page.title()
+        if not self.ctx.leaseStore().acquire(title):
+            out('"%s" is handled by another worker, skipping' % candidate.cutTitle())
+            return
+        self.ctx._lease.title = title
+        try:
+            pages = {}
+            for edit in planning.editPlan.edits:
+                pages.setdefault(edit["title"], []).append(edit)
+            for pageTitle, edits in pages.items():
+                try:
+                    self.reviewPage(pageTitle, edits)
+                except (pywikibot.EditConflict, pywikibot.LockedPage) as error:
+                    out("Could not save '%s' '%s'" % (pageTitle, error), color="lightred")
+        finally:
+            self.ctx._lease.title = None
+            self.ctx.leaseStore().release(title)
+
+    def reviewPage(self, title, edits):
+        """Show the planned diffs of a page, and make the edits if accepted."""
+        ctx = self.ctx
+        comment = "; ".join(dict.fromkeys(edit["comment"] for edit in edits))
+        out("\n About to commit changes to: '%s'" % title)
+        for edit in edits:
+            for line in edit["diff"].splitlines():
+                if line[:3] in ("---", "+++"):
+                    out(line)
+                else:
+                    out(line, color={"+": "lightgreen", "-": "lightred"}.get(line[:1]))
+        page = ctx.Page(title)
+        if not ctx.confirm(page, comment):
+            return
+
+        ctx.forgetText(page)
+        try:
+            old_text = ctx.getText(page)
+            revid = ctx.baseRevid(page, old_text)
+        except pywikibot.NoPage:
+            old_text = ""
+            revid = None
+        # Our own saves of the page do not need another look
+        unchanged = revid == edits[0]["revid"] or (
+            title in self._saved and revid == self._saved[title]
+        )
+
+        transformation = None
+        if all(edit["transformation"] for edit in edits):
+            transformation = Chain(
+                *[Transformation.fromDict(edit["transformation"]) for edit in edits]
+            )
+            new_text = transformation.apply(old_text)
+        elif unchanged:
+            new_text = edits[-1]["text"]
+        else:
+            out(
+                "Skipping '%s', it changed since the changes were made (revision %s, made against %s)"
+                % (title, revid, edits[0]["revid"]),
+                color="lightred",
+            )
+            return
+
+        if new_text == old_text:
+            out("Skipping '%s', already done." % title, color="lightred")
+            return
+        if unchanged:
+            ctx.save(page, old_text, new_text, comment, transformation)
+        else:
+            out(
+                "'%s' was changed by someone else, the changes applied to the current text:"
+                % title,
+                color="lightyellow",
+            )
+            if not ctx.commit(old_text, new_text, page, comment, transformation):
+                return
+        revid = ctx.baseRevid(page, new_text)
+        if revid:
+            self._saved[title] = revid
+
+
+class MotdScheduler:
+    """
+    Hands out free 'Template:Motd/<date>' slots
+
+    All existing Motd pages within the window are found using one
+    prefix listing starting at the first date, instead of probing
+    every date with a separate exists() call. Free dates are then
+    reserved in order, such that several promotions in the same run
+    never get the same date.
+    """
+
+    def __init__(self, site, start=None, days=90):
+        start = start or datetime.utcnow()
+        dates = [(start + timedelta(num)).strftime("%Y-%m-%d") for num in range(days)]
+        taken = set()
+        for page in site.allpages(start="Motd/%s" % dates[0], prefix="Motd/", namespace=10):
+            date = page.title(with_ns=False)[len("Motd/"):]
+            if date[:10] > dates[-1]:
+                break
+            taken.add(date)
+        self._free = [date for date in dates if date not in taken]
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Reserve the next free date.
+
+        Returns (motd page, english description page, template date)
+        or None if all dates in the window are taken.
+        """
+        with self._lock:
+            if self._next >= len(self._free):
+                return None
+            date = self._free[self._next]
+            self._next += 1
+        return (
+            "Template:Motd/%s" % date,
+            "Template:Motd/%s_(en)" % date,
+            date.replace("-", "|"),
+        )
+
+    def release(self, slot):
+        """Give back an unused slot from reserve(), it is handed out again first."""
+        date = slot[0][len("Template:Motd/") :]
+        with self._lock:
+            # The reserved dates are the first ones, and all before the free ones
+            self._free.remove(date)
+            self._next -= 1
+            self._free.insert(self._next, date)
+
+
+class PageCache:
+    """
+    Disk backed cache of page texts shared between bot runs
+
+    Page texts are stored together with their revision id in an SQLite
+    database, such that several bot processes on the same host can
+    share it safely. Before a cached text is used the latest revision
+    id is checked, preferably for many pages in one batched query
+    using validate(), and the full text is only downloaded if the
+    page actually changed. Looked up revision ids are trusted for
+    maxAge seconds, pages found missing are remembered as well. The
+    least recently used texts are evicted when the cache grows beyond
+    maxBytes, which is checked each time another EVICT_SHARE of
+    maxBytes was stored.
+    """
+
+    # The part of maxBytes stored between two checks of the cache size
+    EVICT_SHARE = 1 / 64
+
+    # The revision id remembered for pages that do not exist
+    MISSING = 0
+
+    def __init__(self, path, site, maxBytes=200 * 1024 * 1024, maxAge=300):
+        self._path = path
+        self._site = site
+        self._maxBytes = maxBytes
+        self._maxAge = maxAge
+        self._local = threading.local()
+        self._revids = {}
+        # The bytes stored since the size of the cache was last checked
+        self._stored = 0
+        self._storedLock = threading.Lock()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS pages ("
+                "title TEXT PRIMARY KEY, revid INTEGER, text TEXT,"
+                "size INTEGER, used REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS pages_used ON pages (used)")
+
+    def _connection(self):
+        """One connection per thread, sqlite handles the locking between processes."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def validate(self, pages):
+        """
+        Look up the latest revision ids of several pages in batched queries.
+
+        Only the revision metadata is loaded, not the page texts.
+        """
+        pages = [page for page in pages if self._knownRevid(page) is None]
+        if not pages:
+            return
+        for page in self._site.preloadpages(pages, content=False):
+            revid = page.latest_revision_id if page.exists() else self.MISSING
+            self._revids[page.title()] = (revid, time.time())
+
+    def preload(self, pages):
+        """
+        Like validate(), and then download the texts of the pages that
+        are not cached at their latest revision in batched queries.
+        """
+        self.validate(pages)
+        conn = self._connection()
+        stale = [
+            page
+            for page in pages
+            if self._knownRevid(page) != self.MISSING
+            and not conn.execute(
+                "SELECT 1 FROM pages WHERE title = ? AND revid = ?",
+                (page.title(), self._knownRevid(page)),
+            ).fetchone()
+        ]
+        if stale:
+            for page in self._site.preloadpages(stale):
+                if page.exists():
+                    self.store(page, page.get(get_redirect=True))
+
+    def exists(self, page):
+        """Whether the page exists if it was looked up recently, else None."""
+        revid = self._knownRevid(page)
+        return None if revid is None else revid != self.MISSING
+
+    def text(self, page):
+        """
+        Return the text of the page, from the cache if it is still current.
+
+        Raises pywikibot.NoPage just like page.get() does.
+        """
+        return self.read(page)[0]
+
+    def read(self, page):
+        """Like text(), but return the text together with the revision id it is the text of."""
+        title = page.title()
+        revid = self._knownRevid(page)
+        if revid is None:
+            revid = page.latest_revision_id
+        elif revid == self.MISSING:
+            raise pywikibot.NoPage(page)
+        row = self._connection().execute(
+            "SELECT text FROM pages WHERE title = ? AND revid = ?", (title, revid)
+        ).fetchone()
+        if row:
+            with self._connection() as conn:
+                conn.execute(
+                    "UPDATE pages SET used = ? WHERE title = ?", (time.time(), title)
+                )
+            return row[0], revid
+        text = page.get(get_redirect=True)
+        return text, self.store(page, text)
+
+    def revid(self, page):
+        """The latest revision id if it was looked up recently, MISSING if the page does not exist, else None."""
+        return self._knownRevid(page)
+
+    def _knownRevid(self, page):
+        """The latest revision id if it was looked up recently, else None."""
+        revid, checked = self._revids.get(page.title(), (None, 0))
+        return revid if time.time() - checked < self._maxAge else None
+
+    def forget(self, page):
+        """Forget the known revision id of the page, such that it is checked again."""
+        self._revids.pop(page.title(), None)
+
+    def store(self, page, text):
+        """Store the text of the latest revision of the page, returns its revision id."""
+        title = page.title()
+        revid = page.latest_revision_id
+        self._revids[title] = (revid, time.time())
+        size = len(text.encode("utf-8"))
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)",
+                (title, revid, text, size, time.time()),
+            )
+        # Summing up the sizes of the whole cache on every store is slow for a large cache
+        with self._storedLock:
+            self._stored += size
+            check = self._stored >= self._maxBytes * self.EVICT_SHARE
+            if check:
+                self._stored = 0
+        if check:
+            self.evict()
+        return revid
+
+    def evict(self):
+        """Drop the least recently used texts until the cache fits in maxBytes."""
+        with self._connection() as conn:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+            if total <= self._maxBytes:
+                return
+            for title, size in conn.execute(
+                "SELECT title, size FROM pages ORDER BY used"
+            ).fetchall():
+                conn.execute("DELETE FROM pages WHERE title = ?", (title,))
+                total -= size
+                if total <= self._maxBytes:
+                    break
+
+
+class Journal:
+    """
+    Journal of the texts the bot appended to pages
+
+    Used to know that a notification or log entry was already added
+    without downloading the page it was added to. It also keeps the
+    edits left to the end of a run, see flushFeaturedList() and
+    flushNotifications(), until they are made.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS appended ("
+                "title TEXT, target TEXT, added REAL, PRIMARY KEY (title, target))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS later ("
+                "kind TEXT, key TEXT, data TEXT, PRIMARY KEY (kind, key))"
+            )
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=60)
+            self._local.conn = conn
+        return conn
+
+    def contains(self, title, target):
+        return (
+            self._connection()
+            .execute(
+                "SELECT 1 FROM appended WHERE title = ? AND target = ?", (title, target)
+            )
+            .fetchone()
+            is not None
+        )
+
+    def add(self, title, target):
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO appended VALUES (?, ?, ?)",
+                (title, target, time.time()),
+            )
+
+    def addLater(self, kind, key, data):
+        """Keep an edit of the kind left to the end of the run, data is stored as json."""
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO later VALUES (?, ?, ?)", (kind, key, json.dumps(data))
+            )
+
+    def later(self, kind):
+        """The data of the kept edits of the kind, the oldest first."""
+        return [
+            json.loads(row[0])
+            for row in self._connection().execute(
+                "SELECT data FROM later WHERE kind = ? ORDER BY rowid", (kind,)
+            )
+        ]
+
+    def removeLater(self, kind, key):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM later WHERE kind = ? AND key = ?", (kind, key))
+
+
+class FeaturedIndex:
+    """
+    Index of the files listed on the featured media pages
+
+    Maps the normalized title of every file, see fileKey(), to the
+    gallery pages, chronological pages and the featured list listing
+    it, and the section it is listed in. Each page is indexed at a
+    revision and only parsed again when its latest revision changes,
+    which the bot notices when it reads or saves the page, or when
+    -reindex checks the revisions of all the pages.
+    """
+
+    LineR = re.compile(
+        r"^(=+)[ \t]*(.+?)[ \t]*\1[ \t]*$"                             # Heading (1, 2)
+        r"|^[ \t]*(?:\[\[)?[ \t]*((?:[Ff]ile|[Ii]mage)[ \t]*:[^|\]\n]+)",  # Gallery line or link (3)
+        re.MULTILINE,
+    )
+
+    def __init__(self, path):
+        self._path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS files (file TEXT, title TEXT, section TEXT)")
+            conn.execute("CREATE INDEX IF NOT EXISTS files_file ON files (file)")
+            conn.execute("CREATE INDEX IF NOT EXISTS files_title ON files (title)")
+            conn.execute("CREATE TABLE IF NOT EXISTS pages (title TEXT PRIMARY KEY, revid INTEGER)")
+            conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value REAL)")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=60)
+            self._local.conn = conn
+        return conn
+
+    def revid(self, title):
+        """The revision the page was indexed at, or None."""
+        row = self._connection().execute(
+            "SELECT revid FROM pages WHERE title = ?", (title,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def update(self, title, revid, text):
+        """Index the files listed in the text of the revision revid of the page, unless it already is."""
+        if self.revid(title) == revid:
+            return
+        rows = []
+        section = ""
+        for m in self.LineR.finditer(text):
+            if m.group(2) is not None:
+                section = m.group(2)
+            else:
+                rows.append((fileKey(m.group(3)), title, section))
+        with self._connection() as conn:
+            conn.execute("DELETE FROM files WHERE title = ?", (title,))
+            conn.executemany("INSERT INTO files VALUES (?, ?, ?)", rows)
+            conn.execute("INSERT OR REPLACE INTO pages VALUES (?, ?)", (title, revid))
+
+    def contains(self, title, file, revid):
+        """Whether the page was indexed at the revision revid and lists the file."""
+        return (
+            self._connection()
+            .execute(
+                "SELECT 1 FROM pages JOIN files USING (title)"
+                " WHERE title = ? AND revid = ? AND file = ?",
+                (title, revid, fileKey(file)),
+            )
+            .fetchone()
+            is not None
+        )
+
+    def pagesWith(self, file):
+        """
+        The (title, section) of the pages listing the file, or None if
+        -reindex never ran, then pages not read by the bot are missing.
+        """
+        conn = self._connection()
+        if conn.execute("SELECT 1 FROM state WHERE key = 'refreshed'").fetchone() is None:
+            return None
+        return conn.execute(
+            "SELECT DISTINCT title, section FROM files WHERE file = ? ORDER BY title",
+            (fileKey(file),),
+        ).fetchall()
+
+    def refresh(self, ctx):
+        """
+        Index all featured media pages that changed since they were
+        indexed and forget the deleted ones. The latest revisions are
+        looked up in batched queries, only the changed texts are loaded.
+        """
+        titles = [
+            page.title()
+            for page in ctx.site.allpages(prefix="Featured media/", namespace=4, filterredir=False)
+        ]
+        titles.append("Commons:Featured media, list")
+        ctx.prefetch(titles)
+        for title in titles:
+            page = ctx.Page(title)
+            if ctx.noCache or ctx.pageCache().revid(page) != self.revid(title):
+                try:
+                    # Indexes the text
+                    ctx.getText(page)
+                except pywikibot.NoPage:
+                    pass
+        known = set(titles)
+        with self._connection() as conn:
+            for (title,) in conn.execute("SELECT title FROM pages").fetchall():
+                if title not in known:
+                    conn.execute("DELETE FROM files WHERE title = ?", (title,))
+                    conn.execute("DELETE FROM pages WHERE title = ?", (title,))
+            conn.execute(
+                "INSERT OR REPLACE INTO state VALUES ('refreshed', ?)", (time.time(),)
+            )
+        out("Indexed %d featured media pages" % len(titles))
+
+
+class WriteQueue:
+    """
+    Durable queue of the edits of -writebehind
+
+    The accepted edits are stored in an SQLite database and saved by a
+    background writer, such that the steps go on while the saves
+    complete and the edits survive a crash or restart of the bot.
+    Edits are saved by their priority class, see writePriority(), and
+    in the order they were queued within a class. The writer saves one
+    edit at a time, under the edit throttle pywikibot keeps for the site.
+
+    An edit is stored as its transformation, or as the texts to append
+    with their targets, and made on the current text of the page when
+    it is saved. Saving an edit once more after a failure that hit
+    after the save changes nothing, so failed saves are simply retried,
+    after a growing delay and up to WRITE_ATTEMPTS times. Edits given
+    up are kept in the queue, marked as failed, and reported by join().
+    """
+
+    def __init__(self, path, ctx):
+        self._path = path
+        self._local = threading.local()
+        # The writer saves in automatic mode, after the edits were accepted
+        self._ctx = RunContext(
+            ctx.site, auto=True, noTime=ctx.noTime, noCache=ctx.noCache, showDiff=ctx.showDiff
+        )
+        self._condition = threading.Condition()
+        self._thread = None
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS edits ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, priority INTEGER, title TEXT, "
+                "edit TEXT, comment TEXT, attempts INTEGER, due REAL, failed INTEGER)"
+            )
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=60)
+            self._local.conn = conn
+        return conn
+
+    def add(self, page, edit, comment):
+        """Queue an edit of the page, unless the same edit is already queued."""
+        title = page.title()
+        edit = json.dumps(edit, sort_keys=True)
+        with self._connection() as conn:
+            if not conn.execute(
+                "SELECT 1 FROM edits WHERE title = ? AND edit = ? AND failed = 0", (title, edit)
+            ).fetchone():
+                conn.execute(
+                    "INSERT INTO edits (priority, title, edit, comment, attempts, due, failed) "
+                    "VALUES (?, ?, ?, ?, 0, 0, 0)",
+                    (writePriority(title), title, edit, comment),
+                )
+        out("Queued changes to '%s'" % title)
+        self.start()
+        with self._condition:
+            self._condition.notify()
+
+    def pending(self):
+        """The number of queued edits that are not given up."""
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM edits WHERE failed = 0"
+        ).fetchone()[0]
+
+    def start(self):
+        """Start the writer, which also saves the edits left by earlier runs."""
+        with self._condition:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def join(self, ctx):
+        """
+        Wait until all queued edits are saved or given up, or the run is
+        aborted or the writer died. Edits given up stay in the queue and
+        are reported.
+        """
+        if self.pending():
+            out("Waiting for %d queued edits to be saved..." % self.pending())
+        while self.pending() and not ctx.abort:
+            if self._thread is None or not self._thread.is_alive():
+                out(
+                    "The writer stopped, %d queued edits are left for the next run" % self.pending(),
+                    color="lightred",
+                )
+                break
+            with self._condition:
+                self._condition.wait(1)
+        failed = self._connection().execute("SELECT title FROM edits WHERE failed = 1").fetchall()
+        if failed:
+            out(
+                "Gave up saving %d queued edits, of: %s"
+                % (len(failed), ", ".join(sorted(set(title for title, in failed)))),
+                color="lightred",
+            )
+
+    def _run(self):
+        while True:
+            # Holding the condition, such that an edit queued meanwhile is not missed
+            with self._condition:
+                row = self._connection().execute(
+                    "SELECT id, title, edit, comment, attempts, due FROM edits "
+                    "WHERE failed = 0 ORDER BY due > ?, priority, id LIMIT 1",
+                    (time.time(),),
+                ).fetchone()
+                if row is None or row[5] > time.time():
+                    self._condition.wait(row[5] - time.time() if row else None)
+                    continue
+            self._save(*row[:5])
+            with self._condition:
+                self._condition.notify_all()
+
+    def _save(self, id, title, edit, comment, attempts):
+        """Save one queued edit, then remove it from the queue or schedule a retry."""
+        ctx = self._ctx
+        edit = json.loads(edit)
+        page = ctx.Page(title)
+        try:
+            if "appends" in edit:
+                saved = ctx.commitAppends(
+                    page,
+                    [(AppendText(text), target) for text, target in edit["appends"]],
+                    comment,
+                    edit["create"],
+                )
+            else:
+                saved = ctx.commitTransformation(
+                    page,
+                    Transformation.fromDict(edit["transformation"]),
+                    comment,
+                    create=edit["create"],
+                )
+            if not saved:
+                raise pywikibot.Error("the changes were not saved")
+        except pywikibot.NoPage:
+            out("Dropping queued changes to '%s', no such page" % title, color="lightred")
+        except pywikibot.LockedPage as error:
+            out("Dropping queued changes to '%s', page is locked '%s'" % (title, error), color="lightred")
+        except StaleEdit as error:
+            # Retrying does not help, keep the edit for the operator
+            out("Could not save '%s' '%s', giving up" % (title, error), color="lightred")
+            with self._connection() as conn:
+                conn.execute("UPDATE edits SET failed = 1 WHERE id = ?", (id,))
+            return
+        except Exception as error:
+            # Any failure only fails this edit, the writer goes on with the others
+            attempts += 1
+            failed = attempts >= WRITE_ATTEMPTS
+            out(
+                "Could not save '%s' '%s', %s"
+                % (title, error, "giving up" if failed else "will retry"),
+                color="lightred",
+            )
+            ctx.forgetText(page)
+            with self._connection() as conn:
+                conn.execute(
+                    "UPDATE edits SET attempts = ?, due = ?, failed = ? WHERE id = ?",
+                    (attempts, time.time() + WRITE_RETRY * 2 ** attempts, failed, id),
+                )
+            return
+        with self._connection() as conn:
+            conn.execute("DELETE FROM edits WHERE id = ?", (id,))
+
+
+def writePriority(title):
+    """
+    The priority class of a queued edit of the page, lower is saved first:
+    the candidates, their lists and logs and the featured list, then
+    galleries, files and categories, then notifications and MOTD pages.
+    """
+    if title.startswith(("User talk:", "Template:Motd/")):
+        return 2
+    if title.startswith(candPrefix) or title == "Commons:Featured media, list":
+        return 0
+    return 1
+
+
+def pageUses(site, page, target):
+    """
+    Ask the server whether the page links to, embeds or transcludes target,
+    see pagesUsing().
+
+    This only needs one small query instead of downloading the page.
+    """
+    return (page.title(), target) in pagesUsing(site, [(page.title(), target)])
+
+
+def isNotification(title, target):
+    """Whether (title, target) is the FM promotion notification of a file on a user talk page."""
+    return titleKey(title).startswith("User talk:") and titleKey(target).startswith("File:")
+
+
+def pagesUsing(site, pairs):
+    """
+    Like pageUses() for many (title, target) pairs, asking about up to
+    50 pairs in each query. Returns the set of the pairs whose page
+    links to, embeds or transcludes the target.
+
+    A user talk page only counts as using a file if it also transcludes
+    one of NOTIFICATION_TEMPLATES, other notices like deletion requests
+    and other promotions show the file as well.
+    """
+    used = set()
+    for i in range(0, len(pairs), 50):
+        group = pairs[i : i + 50]
+        targets = set(target for title, target in group)
+        if any(isNotification(title, target) for title, target in group):
+            targets.update(NOTIFICATION_TEMPLATES)
+        targets = "|".join(sorted(targets))
+        data = site.simple_request(
+            action="query",
+            titles="|".join(sorted(set(title for title, target in group))),
+            prop="links|images|templates",
+            pltitles=targets,
+            imimages=targets,
+            tltemplates=targets,
+            pllimit="max",
+            imlimit="max",
+            tllimit="max",
+        ).submit()
+        uses = {}
+        for info in data.get("query", {}).get("pages", {}).values():
+            uses[titleKey(info["title"])] = set(
+                titleKey(item["title"])
+                for kind in ("links", "images", "templates")
+                for item in info.get(kind, ())
+            )
+        for title, target in group:
+            found = uses.get(titleKey(title), ())
+            if titleKey(target) in found and (
+                not isNotification(title, target)
+                or any(template in found for template in NOTIFICATION_TEMPLATES)
+            ):
+                used.add((title, target))
+    return used
+
+
+def titleKey(title):
+    """Normalize a title like the server does, for comparing it to the titles it returns."""
+    title = " ".join(title.replace("_", " ").split())
+    namespace, colon, name = title.partition(":")
+    if not colon:
+        return title[:1].upper() + title[1:]
+    name = name.strip()
+    return "%s:%s" % (namespace.strip(), name[:1].upper() + name[1:])
+
+
+class CategoryRegistry:
+    """
+    The nominator and uploader categories known to be in place
+
+    A category is in place when it exists with its FMcatNominator or
+    FMcatUploader template. Known categories are stored persistently,
+    the others are looked up for a whole run with resolve(), asking
+    the server about many categories in each query.
+    """
+
+    Templates = ("Template:FMcatNominator", "Template:FMcatUploader")
+
+    def __init__(self, path, site):
+        self._path = path
+        self._site = site
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS categories (title TEXT PRIMARY KEY)")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=60)
+            self._local.conn = conn
+        return conn
+
+    def contains(self, title):
+        return (
+            self._connection()
+            .execute("SELECT 1 FROM categories WHERE title = ?", (title,))
+            .fetchone()
+            is not None
+        )
+
+    def add(self, title):
+        with self._connection() as conn:
+            conn.execute("INSERT OR IGNORE INTO categories VALUES (?)", (title,))
+
+    def resolve(self, titles):
+        """Look up the categories not known yet, 50 in each query."""
+        unknown = sorted(set(title for title in titles if not self.contains(title)))
+        for i in range(0, len(unknown), 50):
+            data = self._site.simple_request(
+                action="query",
+                titles="|".join(unknown[i : i + 50]),
+                prop="templates",
+                tltemplates="|".join(self.Templates),
+            ).submit()
+            for info in data.get("query", {}).get("pages", {}).values():
+                if "missing" not in info and info.get("templates"):
+                    self.add(info["title"])
+
+
+def prefetchCategories(ctx, candidates):
+    """
+    Look up the nominator and uploader categories of all candidates
+    that are going to be featured, in batched queries.
+    """
+    titles = []
+    for candidate in candidates:
+        try:
+            results = candidate.verifiedResults()
+        except (pywikibot.NoPage, PathologicalPage):
+            continue
+        if isinstance(candidate, FMCandidate) and len(results) == 1 and results[0][3] == "yes":
+            titles.append("Category:Featured media nominated by %s" % candidate.nominator(link=False))
+            titles.append("Category:Featured media by %s" % uploader(ctx, candidate.fileName(), link=False))
+    ctx.categoryRegistry().resolve(titles)
+
+
+def changedSpan(old_text, new_text):
+    """
+    Find the part of the texts that differs
+
+    Returns (start, old_end, new_end) such that old_text[start:old_end]
+    was replaced by new_text[start:new_end]. The common prefix and
+    suffix are found by binary search on slice comparisons, which is
+    much cheaper than a line diff of a large page.
+    """
+    shortest = min(len(old_text), len(new_text))
+
+    lo, hi = 0, shortest
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if old_text[:mid] == new_text[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    prefix = lo
+
+    lo, hi = 0, shortest - prefix
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if old_text[len(old_text) - mid :] == new_text[len(new_text) - mid :]:
+            lo = mid
+        else:
+            hi = mid - 1
+    suffix = lo
+
+    return prefix, len(old_text) - suffix, len(new_text) - suffix
 
-        # First check for the old {{Featured media}} template
-        new_text = re.sub(
-            r"{{[Ff]eatured[ _]media}}", "{{Delisted media}}", old_text
-        )
 
-        # Then check for the assessments template
-        # The replacement string needs to use the octal value for the char '2' to
-        # not confuse python as '\12\2' would obviously not work
-        new_text = re.sub(
-            r"({{[Aa]ssessments\s*\|.*(?:com|featured)\s*=\s*)1(.*?}})",
-            r"\1\062\2",
-            new_text,
-        )
+def diffExcerpt(old_text, new_text, context=3):
+    """
+    Cut out the changed part of two texts with a few lines of context
+
+    Edits made by the bot are small compared to the pages, so instead
+    of diffing the full texts only the changed span, extended to
+    context whole lines on both sides, needs to be diffed.
+    Returns (first line, old excerpt, new excerpt), or None if the
+    texts are equal.
+    """
+    start, old_end, new_end = changedSpan(old_text, new_text)
+    if start == old_end == new_end:
+        return None
+
+    for _ in range(context + 1):
+        start = max(old_text.rfind("\n", 0, start), 0)
+    for line in range(context + 1):
+        if old_end < len(old_text):
+            old_end = old_text.find("\n", old_end + min(line, 1)) % (len(old_text) + 1)
+            new_end = new_text.find("\n", new_end + min(line, 1)) % (len(new_text) + 1)
+    if start:
+        start += 1
+    return (
+        old_text.count("\n", 0, start) + 1,
+        old_text[start:old_end],
+        new_text[start:new_end],
+    )
+
 
-        self.commit(old_text, new_text, mediaPage, "Delisted")
+def showDiff(old_text, new_text, context=3):
+    """Show the diff of only the changed part with a few lines of context."""
+    excerpt = diffExcerpt(old_text, new_text, context)
+    if not excerpt:
+        out("(no changes)")
+        return
+    line, old_part, new_part = excerpt
+    if line > 1:
+        out("(diff starting at line %d)" % line)
+    pywikibot.showDiff(old_part, new_part)
+
+
+def diffText(old_text, new_text, context=3):
+    """The diff of only the changed part as unified diff text."""
+    excerpt = diffExcerpt(old_text, new_text, context)
+    if not excerpt:
+        return ""
+    line, old_part, new_part = excerpt
+    return "\n".join(
+        difflib.unified_diff(
+            old_part.splitlines(),
+            new_part.splitlines(),
+            "line %d" % line,
+            "line %d" % line,
+            lineterm="",
+        )
+    )
 
 
 def wikipattern(s):
@@ -1436,78 +3743,401 @@ def wikipattern(s):
     return re.sub(r"[ _()*+=?!^-]", rep, s)
 
 
-def out(text, newline=True, date=False, color=None):
-    """Just output some text to the consoloe or log."""
+def out(text, newline=True, date=None, color=None):
+    """
+    Just output some text to the consoloe or log.
+
+    @param date A time to show before the text, if any
+    """
+    # Collected while a ReviewPipeline plans in the background
+    lines = getattr(_output, "lines", None)
+    if lines is not None:
+        lines.append((text, newline, date, color))
+        return
     if color:
         text = "\03{%s}%s\03{default}" % (color, text)
-    dstr = (
-        "%s: " % today.strftime("%Y-%m-%d %H:%M:%S")
-        if date and not G_LogNoTime
-        else ""
-    )
+    dstr = "%s: " % date.strftime("%Y-%m-%d %H:%M:%S") if date else ""
     pywikibot.stdout("%s%s" % (dstr, text), newline=newline)
 
 
-def findCandidates(page_url, delist):
-    """Finds all candidates on the main FMC page."""
-    page = pywikibot.Page(SITE, page_url)
-    candidates = []
+# The output of the current thread is collected in lines when set, see out()
+_output = threading.local()
+
+
+def findCandidates(ctx, page_url, delist, match=""):
+    """
+    Finds all candidates on the main FMC page, they are yielded
+    one after the other as the titles come in.
+
+    @param match Only candidates whose title contains this (ignoring case)
+    """
+    page = ctx.Page(page_url)
     templates = page.templates()
     for template in templates:
         title = template.title()
+        if match and match.lower() not in re.sub(
+            r"\.\w{1,3}$\s*", "", re.sub(PrefixR, "", title)
+        ).lower():
+            continue
         if title.startswith(candPrefix):
             # out("Adding '%s' (delist=%s)" % (title,delist))
             if delist and "/removal/" in title:
-                candidates.append(DelistCandidate(template))
+                yield DelistCandidate(template, ctx)
             elif not delist and "/removal/" not in title:
-                candidates.append(FMCandidate(template))
+                yield FMCandidate(template, ctx)
         else:
             pass
             # out("Skipping '%s'" % title)
-    return candidates
 
 
-def checkCandidates(check, page, delist):
+def prepareCandidates(ctx, check, candidates):
+    """
+    Yield the candidates check is run on, taking them CANDIDATE_BATCH
+    at a time: for -close only the candidates that can be closed
+    according to their metadata are fetched, for -park the user
+    categories of the batch are looked up at once.
+    """
+    batch = []
+    for candidate in candidates:
+        batch.append(candidate)
+        if len(batch) < CANDIDATE_BATCH:
+            continue
+        for candidate in prepareBatch(ctx, check, batch):
+            yield candidate
+        batch = []
+        if ctx.abort:
+            return
+    for candidate in prepareBatch(ctx, check, batch):
+        yield candidate
+
+
+def prepareBatch(ctx, check, batch):
+    """The candidates of one batch of prepareCandidates() to run check on."""
+    if not batch or ctx.abort:
+        return []
+    if check is Candidate.closePage:
+        batch = selectActionable(ctx, batch)
+    if check is Candidate.park:
+        prefetchCategories(ctx, batch)
+    return batch
+
+
+def checkCandidates(ctx, check, page, delist, title=None):
     """
     Calls a function on each candidate found on the specified page
 
+    @param ctx    The RunContext of the run
     @param check  A function in Candidate to call on each candidate
     @param page   A page containing all candidates
     @param delist Boolean, telling whether this is delistings of fmcs
+    @param title  Only the candidate with this title if given
     """
-    if not SITE.logged_in():
-        SITE.login()
+    ctx.login()
+
+    # The candidates are found, filtered, fetched and checked as a stream,
+    # such that only the texts of the current batch are kept in memory
+    candidates = findCandidates(ctx, page, delist, ctx.match)
 
-    candidates = findCandidates(page, delist)
+    if title is not None:
+        candidates = (candidate for candidate in candidates if candidate.page.title() == title)
 
-    def containsPattern(candidate):
-        return candidate.cleanTitle().lower().find(G_MatchPattern.lower()) != -1
+    if ctx.shardCount > 1:
+        candidates = (
+            candidate
+            for candidate in candidates
+            if shardOf(candidate.page.title(), ctx.shardCount) == ctx.shard
+        )
+
+    candidates = prepareCandidates(ctx, check, candidates)
+
+    # Review the edits in interactive mode while the next ones are computed
+    if (
+        ctx.pipeline
+        and check in EDITING_CHECKS
+        and not (ctx.auto or ctx.dry or ctx.threads)
+        and ctx.editPlan is None
+    ):
+        ReviewPipeline(ctx, check, candidates).run()
+        if not ctx.abort:
+            flushFeaturedList(ctx)
+            flushNotifications(ctx)
+        return
 
-    candidates = list(filter(containsPattern, candidates))
+    # Several workers may run at once, so only edit while holding the lease
+    editing = check in EDITING_CHECKS
+    if editing and not ctx.dry and ctx.editPlan is None:
+        check = functools.partial(ctx.checkLeased, check)
+
+    # Measure each candidate if asked to, like the load test does
+    if ctx.latencies is not None:
+        check = functools.partial(ctx.checkTimed, check)
 
-    tot = len(candidates)
     i = 1
+    threads = []
+    try:
+        for candidate in candidates:
+
+            if not ctx.threads:
+                out(
+                    "(%03d) " % i,
+                    newline=False,
+                    date=None if ctx.noTime else ctx.today,
+                )
+
+            try:
+                if ctx.threads:
+                    while threading.activeCount() >= config.max_external_links:
+                        time.sleep(0.1)
+                    thread = ThreadCheckCandidate(candidate, check)
+                    thread.start()
+                    # Only keep the running threads, and with them their candidates
+                    threads = [thread for thread in threads if thread.is_alive()]
+                    threads.append(thread)
+                else:
+                    check(candidate)
+            except pywikibot.NoPage as error:
+                out("No such page '%s'" % error, color="lightred")
+            except pywikibot.LockedPage as error:
+                out("Page is locked '%s'" % error, color="lightred")
+            except PathologicalPage as error:
+                candidate.skipPathological(error)
+            finally:
+                if not ctx.threads:
+                    candidate.release()
+
+            i += 1
+            if ctx.abort:
+                break
+    finally:
+        for thread in threads:
+            thread.join()
+    # When stopped the journal keeps these for the next run
+    if editing and not ctx.abort:
+        flushFeaturedList(ctx)
+        flushNotifications(ctx)
+
+
+class CandidateIndex:
+    """
+    What is known about candidates from earlier runs
+
+    The creation time of a candidate never changes, so it is only
+    looked up once. When closePage() finds nothing to close it stores
+    the revision it looked at, inert, with the deadline when the
+    candidate can next be closed: its ninth day, its 27th day or a day
+    after it was withdrawn. Until the deadline the candidate is waiting
+    and is skipped without fetching it, unless it is edited. The
+    deadlines are indexed, which makes the table a priority queue of
+    the candidates in the order they become due.
+    """
+
+    # Deadline of candidates that wait for an edit
+    NEVER = float("inf")
+
+    def __init__(self, path):
+        self._path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS candidates ("
+                "title TEXT PRIMARY KEY, created REAL, inert INTEGER, due REAL)"
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(candidates)")]
+            if "due" not in columns:
+                conn.execute("ALTER TABLE candidates ADD COLUMN due REAL")
+            conn.execute("CREATE INDEX IF NOT EXISTS candidates_due ON candidates (due)")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=60)
+            self._local.conn = conn
+        return conn
+
+    def _row(self, title):
+        return self._connection().execute(
+            "SELECT created, inert, due FROM candidates WHERE title = ?", (title,)
+        ).fetchone() or (None, None, None)
+
+    def created(self, title):
+        """The stored creation time of the candidate, or None."""
+        created = self._row(title)[0]
+        return datetime.utcfromtimestamp(created) if created is not None else None
+
+    def setCreated(self, title, created):
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO candidates (title) VALUES (?)", (title,)
+            )
+            conn.execute(
+                "UPDATE candidates SET created = ? WHERE title = ?",
+                (calendar.timegm(created.timetuple()), title),
+            )
+
+    def isWaiting(self, title, revid, now):
+        """True if the candidate was not edited since revid and its deadline is after now."""
+        created, inert, due = self._row(title)
+        return (
+            revid is not None
+            and inert == revid
+            and due is not None
+            and calendar.timegm(now.timetuple()) < due
+        )
+
+    def setDeadline(self, title, revid, due):
+        """Store that the candidate waits at revid until the datetime due, or for an edit if None."""
+        due = calendar.timegm(due.timetuple()) if due else self.NEVER
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO candidates (title) VALUES (?)", (title,)
+            )
+            conn.execute(
+                "UPDATE candidates SET inert = ?, due = ? WHERE title = ?",
+                (revid, due, title),
+            )
+
+    def dueTitles(self, now):
+        """The titles of the candidates whose deadline passed, the earliest first."""
+        return [
+            row[0]
+            for row in self._connection().execute(
+                "SELECT title FROM candidates WHERE due <= ? ORDER BY due",
+                (calendar.timegm(now.timetuple()),),
+            )
+        ]
+
+
+def loadMetadata(ctx, candidates):
+    """
+    Load the latest revision and the creation time of the candidates
+
+    The latest revisions are looked up for 50 candidates in each query,
+    the creation times come from the candidate index if they are known.
+    """
+    byTitle = dict((candidate.page.title(), candidate) for candidate in candidates)
+    titles = list(byTitle)
+    for i in range(0, len(titles), 50):
+        data = ctx.site.simple_request(
+            action="query",
+            titles="|".join(titles[i : i + 50]),
+            prop="revisions",
+            rvprop="ids|timestamp",
+        ).submit()
+        for info in data.get("query", {}).get("pages", {}).values():
+            candidate = byTitle.get(info["title"])
+            if candidate is None or not info.get("revisions"):
+                continue
+            revision = info["revisions"][0]
+            candidate._lastRevid = revision["revid"]
+            lastEdit = datetime.strptime(revision["timestamp"], "%Y-%m-%dT%H:%M:%SZ")
+            candidate._lastEdit = lastEdit
+            candidate._daysSinceLastEdit = (ctx.today - lastEdit).days
+
+    for title, candidate in byTitle.items():
+        if candidate._lastRevid is None:
+            continue
+        created = ctx.candidateIndex().created(title)
+        if created is None:
+            created = candidate.creationTime()
+            ctx.candidateIndex().setCreated(title, created)
+        candidate._creationTime = created
+
+
+def selectActionable(ctx, candidates):
+    """
+    The first, cheap phase of closing candidates
+
+    Using only the metadata from loadMetadata() and the deadlines in the
+    candidate index it drops the candidates that can not be closed now:
+    those waiting for their deadline that were not edited since, and
+    those too young for the rules of the ninth day that were edited
+    today (withdrawn nominations wait a day). The remaining candidates
+    have their text fetched, those whose deadline passed first.
+    """
+    loadMetadata(ctx, candidates)
+    index = ctx.candidateIndex()
+    actionable = []
     for candidate in candidates:
+        if candidate._lastRevid is not None:
+            if candidate.daysOld() < 9 and candidate._daysSinceLastEdit == 0:
+                continue
+            if index.isWaiting(candidate.page.title(), candidate._lastRevid, ctx.today):
+                continue
+        actionable.append(candidate)
+
+    order = dict((title, i) for i, title in enumerate(index.dueTitles(ctx.today)))
+    actionable.sort(key=lambda candidate: order.get(candidate.page.title(), len(order)))
+
+    if len(actionable) < len(candidates):
+        out(
+            "Skipping %d candidates that can not be closed yet"
+            % (len(candidates) - len(actionable))
+        )
+    return actionable
+
+
+class LeaseStore:
+    """
+    Renewable leases on candidates shared by several workers
 
-        if not G_Threads:
-            out("(%03d/%03d) " % (i, tot), newline=False, date=True)
+    A worker must hold the lease of a candidate before editing
+    anything for it. Leases expire after duration seconds unless
+    renewed, such that candidates of a crashed worker are picked up
+    by the others. The leases are kept in an SQLite database, which
+    works for workers on the same host or sharing the file.
+    """
+
+    def __init__(self, path, duration=900):
+        self._path = path
+        self._duration = duration
+        self._owner = "%s:%d" % (socket.gethostname(), os.getpid())
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS leases ("
+                "title TEXT PRIMARY KEY, owner TEXT, expires REAL)"
+            )
 
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=60, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def acquire(self, title):
+        """Take or renew the lease on title, returns False if another worker holds it."""
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
         try:
-            if G_Threads:
-                while threading.activeCount() >= config.max_external_links:
-                    time.sleep(0.1)
-                thread = ThreadCheckCandidate(candidate, check)
-                thread.start()
-            else:
-                check(candidate)
-        except pywikibot.NoPage as error:
-            out("No such page '%s'" % error, color="lightred")
-        except pywikibot.LockedPage as error:
-            out("Page is locked '%s'" % error, color="lightred")
+            row = conn.execute(
+                "SELECT owner, expires FROM leases WHERE title = ?", (title,)
+            ).fetchone()
+            if row and row[0] != self._owner and row[1] > now:
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO leases VALUES (?, ?, ?)",
+                (title, self._owner, now + self._duration),
+            )
+            return True
+        finally:
+            conn.execute("COMMIT")
 
-        i += 1
-        if G_Abort:
-            break
+    def renew(self, title):
+        """Extend our lease on title, returns False if it was lost."""
+        return self.acquire(title)
+
+    def release(self, title):
+        """Give up our lease on title."""
+        self._connection().execute(
+            "DELETE FROM leases WHERE title = ? AND owner = ?", (title, self._owner)
+        )
+
+
+def shardOf(title, count):
+    """Stable shard number of a candidate title, the same in every process."""
+    return int(hashlib.md5(title.encode("utf-8")).hexdigest(), 16) % count
 
 
 def filter_content(text):
@@ -1523,30 +4153,74 @@ def filter_content(text):
     """
     text = strip_tag(text, "[Ss]")
     text = strip_tag(text, "nowiki")
-    text = re.sub(
-        r"(?s){{\s*[Ii]mageNote\s*\|.*?}}.*{{\s*[iI]mageNoteEnd.*?}}", "", text
-    )
-    text = re.sub(r"(?s)<!--.*?-->", "", text)
+    text = strip_image_notes(text)
+    text = strip_spans(text, "<!--", "-->")
     return text
 
 
 def strip_tag(text, tag):
     """Will simply take a tag and remove a specified tag."""
-    return re.sub(r"(?s)<%s>.*?</%s>" % (tag, tag), "", text)
+    return strip_spans(text, "<%s>" % tag, "</%s>" % tag)
+
+
+def strip_spans(text, start, end):
+    """
+    Remove the text from each match of the start regexp to the first
+    match of the end regexp after it, like re.sub(start + ".*?" + end)
+    with re.DOTALL but searching on from where the last search ended.
+    """
+    start, end = re.compile(start), re.compile(end)
+    kept = []
+    position = 0
+    while True:
+        first = start.search(text, position)
+        last = first and end.search(text, first.end())
+        if not last:
+            break
+        kept.append(text[position : first.start()])
+        position = last.end()
+    kept.append(text[position:])
+    return "".join(kept)
 
-def uploader(file, link=True):
+
+def strip_image_notes(text):
+    """
+    Remove the file notes, from the first {{ImageNote|...}} to the
+    last {{ImageNoteEnd...}}, like the regexp
+    {{\s*[Ii]mageNote\s*\|.*?}}.*{{\s*[iI]mageNoteEnd.*?}} with re.DOTALL.
+    """
+    first = ImageNoteR.search(text)
+    close = first and text.find("}}", first.end())
+    if not first or close == -1:
+        return text
+    # The last ImageNoteEnd that is followed by a }}
+    last = None
+    for m in ImageNoteEndR.finditer(text, close + 2, text.rfind("}}")):
+        last = m
+    if not last:
+        return text
+    return text[: first.start()] + text[text.find("}}", last.end()) + 2 :]
+
+def uploader(ctx, file, link=True):
     """Return the link to the user that uploaded the nominated media."""
-    page = pywikibot.Page(SITE, file)
-    history = page.revisions(reverse=True, total=1)
-    for data in history:
-        username = (data.user)
-    if not history:
-        return "Unknown"
+    key = (ctx.site.family.name, ctx.site.code, file)
+    if key not in _uploaders:
+        page = ctx.Page(file)
+        history = page.revisions(reverse=True, total=1)
+        for data in history:
+            _uploaders[key] = (data.user)
+        if not history:
+            return "Unknown"
+    username = _uploaders[key]
     if link:
         return "[[User:%s|%s]]" % (username, username)
     else:
         return username
 
+# The uploaders already looked up, by site and file, shared by all runs
+_uploaders = {}
+
+
 def converttostr(input_list, seperator):
    """Make string from list."""
    resultant_string = seperator.join(input_list)
@@ -1715,116 +4389,436 @@ PreviousResultR = re.compile(
     re.MULTILINE,
 )
 
-# Looks for verified results
-VerifiedResultR = re.compile(
-    r"""
-                              {{\s*FMC-results-reviewed\s*\|        # Template start
-                              \s*support\s*=\s*(\d+)\s*\|           # Support votes (1)
-                              \s*oppose\s*=\s*(\d+)\s*\|            # Oppose Votes  (2)
-                              \s*neutral\s*=\s*(\d+)\s*\|           # Neutral votes (3)
-                              \s*featured\s*=\s*(\w+)\s*\|          # Featured, should be yes or no, but is not verified at this point (4)
-                              \s*gallery\s*=\s*([^|]*)              # A gallery page if the media was featured (5)
-                              (?:\|\s*alternative\s*=\s*([^|]*))?   # For candidate with alternatives this specifies the winning media (6)
-                              .*}}                                  # END
-                              """,
-    re.MULTILINE | re.VERBOSE,
-)
-
-VerifiedDelistResultR = re.compile(
-    r"{{\s*FMC-delist-results-reviewed\s*\|\s*delist\s*=\s*(\d+)\s*\|\s*keep\s*=\s*(\d+)\s*\|\s*neutral\s*=\s*(\d+)\s*\|\s*delisted\s*=\s*(\w+).*?}}",
-    re.MULTILINE,
-)
-
-# Matches the entire line including newline so they can be stripped away
-CountedTemplateR = re.compile(
-    r"^.*{{\s*FMC-results-unreviewed.*}}.*$\n?", re.MULTILINE
-)
-DelistCountedTemplateR = re.compile(
-    r"^.*{{\s*FMC-delist-results-unreviewed.*}}.*$\n?", re.MULTILINE
-)
-ReviewedTemplateR = re.compile(r"^.*{{\s*FMC-results-reviewed.*}}.*$\n?", re.MULTILINE)
-DelistReviewedTemplateR = re.compile(
-    r"^.*{{\s*FMC-delist-results-reviewed.*}}.*$\n?", re.MULTILINE
-)
-
-# Is whitespace allowed at the end ?
-SectionR = re.compile(r"^={1,4}.+={1,4}\s*$", re.MULTILINE)
-# Voting templates
-SupportR = re.compile(
-    r"{{\s*(?:%s)(\|.*)?\s*}}" % "|".join(support_templates), re.MULTILINE
-)
-OpposeR = re.compile(
-    r"{{\s*(?:%s)(\|.*)?\s*}}" % "|".join(oppose_templates), re.MULTILINE
-)
-NeutralR = re.compile(
-    r"{{\s*(?:%s)(\|.*)?\s*}}" % "|".join(neutral_templates), re.MULTILINE
-)
-DelistR = re.compile(
-    r"{{\s*(?:%s)(\|.*)?\s*}}" % "|".join(delist_templates), re.MULTILINE
-)
-KeepR = re.compile(r"{{\s*(?:%s)(\|.*)?\s*}}" % "|".join(keep_templates), re.MULTILINE)
-# Finds if a withdraw template is used
-# This template has an optional string which we
-# must be able to detect after the pipe symbol
-WithdrawnR = re.compile(r"{{\s*(?:[wW]ithdrawn?|[fF]PD)\s*(\|.*)?}}", re.MULTILINE)
-# Nomination that contain the fmx template
-FmxR = re.compile(r"{{\s*FMX(\|.*)?}}", re.MULTILINE)
-# Counts the number of displayed medias
-FilesR = re.compile(r"\[\[((?:[Ff]ile|[Ii]mage):[^|]+).*?\]\]")
+# The names of the voting templates, see NominationDocument.countTemplates()
+SupportNameR = re.compile(r"(?:%s)$" % "|".join(support_templates))
+OpposeNameR = re.compile(r"(?:%s)$" % "|".join(oppose_templates))
+NeutralNameR = re.compile(r"(?:%s)$" % "|".join(neutral_templates))
+DelistNameR = re.compile(r"(?:%s)$" % "|".join(delist_templates))
+KeepNameR = re.compile(r"(?:%s)$" % "|".join(keep_templates))
+# The names of the withdraw templates, these have an optional
+# string after the pipe symbol
+WithdrawnNameR = re.compile(r"(?:[wW]ithdrawn?|[fF]PD)$")
+# The name of the fmx template
+FmxNameR = re.compile(r"FMX$")
 # Look for a size specification of the media link
-FilesSizeR = re.compile(r"\|.*?(\d+)\s*px")
+FilesSizeR = re.compile(r"\|.*?(?<!\d)(\d+)\s*px")
 # Find if there is a thumb parameter specified
 FilesThumbR = re.compile(r"\|\s*thumb\b")
-# Finds the last media link on a page
-LastFileR = re.compile(
-    r"(?s)(\[\[(?:[Ff]ile|[Ii]mage):[^\n]*\]\])(?!.*\[\[(?:[Ff]ile|[Ii]mage):)"
+# The start of the file notes, see strip_image_notes()
+ImageNoteR = re.compile(r"{{(?=(\s*))\1[Ii]mageNote(?=(\s*))\2\|")
+ImageNoteEndR = re.compile(r"{{(?=(\s*))\1[iI]mageNoteEnd")
+
+# The page listing the current candidates, and the old log used by -test
+CANDIDATES_PAGE = "Commons:Featured media candidates/candidate_list"
+TEST_LOG = "Commons:Featured_media_candidates/Log/January_2009"
+# Default seconds between the daemon cycles of each action
+DAEMON_INTERVALS = {"-info": 3600, "-close": 600, "-park": 900, "-reindex": 3600}
+# The columns of the -stats dataset and their numpy types
+STATS_COLUMNS = (
+    ("support", "i4"),
+    ("oppose", "i4"),
+    ("neutral", "i4"),
+    ("featured", "i1"),
+    ("withdrawn", "?"),
+    ("daysToClose", "i4"),
+    ("gallery", "U"),
+    ("nominator", "U"),
+    ("uploader", "U"),
+)
+# Seconds of CPU time a nomination page may take to parse, see NominationDocument
+PAGE_CPU_BUDGET = 5
+# The candidates looked up together by prepareCandidates(), like the API queries
+CANDIDATE_BATCH = 50
+# How many times a queued edit is tried, the delay before a retry doubles from WRITE_RETRY seconds
+WRITE_ATTEMPTS = 5
+WRITE_RETRY = 10
+# How many times a transformation is applied again after edit conflicts
+MAX_REBASES = 3
+
+# The templates of the notifications of nominators and uploaders
+NOTIFICATION_TEMPLATES = (
+    "Template:FMpromotion",
+    "Template:FMpromotionSet",
+    "Template:FMpromotedUploader",
 )
 
-# Auto reply yes to all questions
-G_Auto = False
-# Auto answer no
-G_Dry = False
-# Use threads
-G_Threads = False
-# Avoid timestamps in output
-G_LogNoTime = False
-# Pattern to match
-G_MatchPattern = ""
-# Flag that will be set to True if CTRL-C was pressed
-G_Abort = False
+# The checks that edit, these are only run while holding the candidate lease
+EDITING_CHECKS = (Candidate.closePage, Candidate.park)
 
 
-def main(*args):
-    global G_Auto
-    global G_Dry
-    global G_Threads
-    global G_LogNoTime
-    global G_MatchPattern
-    global SITE
+def statsRow(candidate):
+    """
+    The statistics of one archived candidate
+
+    Returns (support, oppose, neutral, featured, withdrawn, days to close,
+    gallery, nominator, uploader) where featured is 1, 0 or -1 if unknown.
+    """
+    verified = candidate.verifiedResults()
+    withdrawn = candidate.isWithdrawn()
+    if verified:
+        support, oppose, neutral = [int(votes) for votes in verified[-1][:3]]
+        featured = {"yes": 1, "no": 0}.get(verified[-1][3], -1)
+        gallery = re.sub(r"#.*", "", verified[-1][4]).strip()
+    else:
+        existing = candidate.existingResult()
+        if existing:
+            support, oppose, neutral = [int(votes) for votes in existing[-1][:3]]
+            featured = 1 if existing[-1][3] == "featured" else 0
+        else:
+            candidate.countVotes()
+            support, oppose, neutral = candidate._pro, candidate._con, candidate._neu
+            featured = -1
+        gallery = candidate.findGalleryOfFile()
+    try:
+        lastEdit = datetime.strptime(str(candidate.page.editTime()), "%Y-%m-%dT%H:%M:%SZ")
+        daysToClose = (lastEdit - candidate.creationTime()).days
+    except (ValueError, TypeError):
+        daysToClose = -1
+    try:
+        upuser = uploader(candidate.ctx, candidate.fileName(), link=False)
+    except pywikibot.Error:
+        upuser = "Unknown"
+    return (
+        support,
+        oppose,
+        neutral,
+        featured,
+        withdrawn,
+        daysToClose,
+        re.sub(r"/.*", "", gallery),
+        candidate.nominator(link=False),
+        upuser,
+    )
+
+
+def statsMonth(ctx, np, month, rebuild):
+    """
+    The statistics of all candidates in the log of a month as columns
+
+    Finished months are stored below the pywikibot base directory
+    and only built once. Returns None if there is no log for the month.
+    """
+    directory = storePath(ctx.site, "fmc-stats")
+    path = os.path.join(directory, "%s.npz" % month.strftime("%Y-%m"))
+    if os.path.exists(path) and not rebuild:
+        with np.load(path) as data:
+            return dict(data)
+
+    log = "Commons:Featured media candidates/Log/%s %s" % (month.strftime("%B"), month.year)
+    if not ctx.Page(log).exists():
+        return None
+
+    out("Reading '%s'..." % log)
+    rows = []
+    for candidate in findCandidates(ctx, log, False):
+        try:
+            rows.append(statsRow(candidate))
+        except pywikibot.NoPage:
+            pass
+        if ctx.abort:
+            return None
+
+    columns = list(zip(*rows)) or [()] * len(STATS_COLUMNS)
+    data = dict(
+        (name, np.array(values, dtype=dtype))
+        for (name, dtype), values in zip(STATS_COLUMNS, columns)
+    )
+    data["month"] = np.full(len(rows), month.year * 100 + month.month, dtype=np.int32)
+
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    np.savez_compressed(path, **data)
+    return data
+
+
+def printStats(ctx):
+    """Print pass rates, vote distributions, leaderboards and closing times of all archived candidates."""
+    try:
+        # Can be installed using "pip install numpy"
+        import numpy as np
+    except ImportError:
+        out("Warning - '-stats' needs numpy, aborting.", color="lightred")
+        return
+
+    # The last two months may still change, the others are stored once built.
+    # Go back in time until a month without log is found.
+    months = []
+    month = datetime(ctx.today.year, ctx.today.month, 1)
+    recent = 2
+    while True:
+        data = statsMonth(ctx, np, month, rebuild=recent > 0)
+        if data is not None:
+            months.append(data)
+        elif recent <= 0 or ctx.abort:
+            break
+        recent -= 1
+        month = (month - timedelta(days=1)).replace(day=1)
+
+    if not months:
+        out("No archived candidates found.")
+        return
+
+    data = dict(
+        (name, np.concatenate([month[name] for month in months]))
+        for name in list(dict(STATS_COLUMNS)) + ["month"]
+    )
+    total = len(data["featured"])
+    decided = (data["featured"] >= 0) & ~data["withdrawn"]
+    featured = data["featured"] == 1
+
+    out("Candidates: %d in %d months" % (total, len(months)))
+    out("Withdrawn:  %d" % data["withdrawn"].sum())
+    if decided.any():
+        out("Pass rate:  %.1f%%" % (100.0 * featured[decided].mean()))
+
+    out("\nVotes        mean  median  90%")
+    for name in ("support", "oppose", "neutral"):
+        votes = data[name][decided]
+        if len(votes):
+            out(
+                "%-10s %6.1f %7.1f %4d"
+                % (name, votes.mean(), np.median(votes), np.percentile(votes, 90))
+            )
+
+    galleries, index = np.unique(data["gallery"][decided], return_inverse=True)
+    nominated = np.bincount(index, minlength=len(galleries))
+    passed = np.bincount(index, weights=featured[decided], minlength=len(galleries))
+    closing = data["daysToClose"][decided]
+    known = closing >= 0
+    days = np.bincount(index[known], weights=closing[known], minlength=len(galleries))
+    counted = np.bincount(index[known], minlength=len(galleries))
+    out("\nGallery                          cands  pass%  days to close")
+    for i in np.argsort(-nominated):
+        out(
+            "%-32s %5d %6.1f %8.1f"
+            % (
+                galleries[i][:32] or "(none)",
+                nominated[i],
+                100.0 * passed[i] / nominated[i],
+                days[i] / counted[i] if counted[i] else -1,
+            )
+        )
+
+    for name, title in (("nominator", "Nominators"), ("uploader", "Uploaders")):
+        users, index = np.unique(data[name], return_inverse=True)
+        promoted = np.bincount(index, weights=featured, minlength=len(users))
+        out("\n%s by featured media" % title)
+        for i in np.argsort(-promoted)[:10]:
+            if promoted[i]:
+                out("%5d %s" % (promoted[i], users[i]))
+
+
+class ChangeFeed:
+    """
+    Feed of edited page titles for the daemon
+
+    This is the local stand-in, titles are put() into it by the caller.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def put(self, title):
+        """Report that a page was edited."""
+        self._queue.put(title)
+
+    def get(self, timeout):
+        """Wait at most timeout seconds for an edited title, None if nothing happened."""
+        try:
+            return self._queue.get(timeout=max(timeout, 0))
+        except queue.Empty:
+            return None
+
+
+class EventStreamFeed(ChangeFeed):
+    """Feed of candidate edits by other users read from the EventStreams recent changes."""
+
+    def __init__(self, site):
+        ChangeFeed.__init__(self)
+        # Needs the sseclient package
+        from pywikibot.comms.eventstreams import EventStreams
+
+        self._stream = EventStreams(streams="recentchange")
+        self._stream.register_filter(server_name=site.hostname(), type="edit")
+        self._stream.register_filter(
+            lambda data: data["title"].startswith(candPrefix)
+            and data["user"] != site.username()
+        )
+        thread = threading.Thread(target=self._read)
+        thread.daemon = True
+        thread.start()
+
+    def _read(self):
+        for change in self._stream:
+            self.put(change["title"])
+
+
+def closeChangedCandidate(ctx, title, candidates_page, delist=True, fmc=True):
+    """
+    Try to close a single candidate that was just edited, if it is still
+    listed. It is selected like -close selects candidates, so -match, the
+    shard, its deadline and the lease are respected.
+    """
+    isDelist = "/removal/" in title
+    if not (delist if isDelist else fmc):
+        return
+    out("Edit of '%s' seen, checking it..." % title, date=None if ctx.noTime else ctx.today)
+    checkCandidates(ctx, Candidate.closePage, candidates_page, isDelist, title=ctx.Page(title).title())
+
+
+def runDaemon(ctx, actions, candidates_page, testLog, delist, fmc, feed):
+    """
+    Keep running the actions on an internal schedule until aborted
+
+    The login session and the caches stay warm between the cycles,
+    while the clock and the per run state are refreshed every cycle.
+    Edits of candidates reported by the feed are checked for closing
+    right away instead of waiting for the next -close cycle.
+    """
+    ctx.login()
+
+    due = dict((action, 0) for action in actions)
+    while not ctx.abort:
+        for action in actions:
+            if due[action] > time.time():
+                continue
+            ctx.refreshClock()
+            try:
+                runAction(ctx, action, candidates_page, testLog, delist, fmc)
+            except pywikibot.Error as error:
+                out("Error during %s '%s'" % (action, error), color="lightred")
+            due[action] = time.time() + (ctx.every or DAEMON_INTERVALS[action])
+            if ctx.abort:
+                return
+
+        title = feed.get(min(due.values()) - time.time())
+        if title and "-close" in actions:
+            ctx.refreshClock()
+            try:
+                closeChangedCandidate(ctx, title, candidates_page, delist, fmc)
+            except pywikibot.Error as error:
+                out("Error while checking '%s' '%s'" % (title, error), color="lightred")
+
+
+def runAction(ctx, arg, candidates_page, testLog, delist, fmc):
+    """
+    Run one of the actions -test, -close, -info, -stats, -reindex or -park
+
+    @param ctx             The RunContext of the run
+    @param arg             The action argument
+    @param candidates_page The page listing the current candidates
+    @param testLog         The old log used by -test
+    @param delist          Handle the delisting candidates
+    @param fmc             Handle the featured candidates
+    """
+    if arg == "-test":
+        if delist:
+            out("-test not supported for delisting candidates")
+        if fmc:
+            checkCandidates(ctx, Candidate.compareResultToCount, testLog, delist=False)
+    elif arg == "-close":
+        if delist:
+            out("Closing delist candidates...", color="lightblue")
+            checkCandidates(ctx, Candidate.closePage, candidates_page, delist=True)
+        if fmc:
+            out("Closing fmc candidates...", color="lightblue")
+            checkCandidates(ctx, Candidate.closePage, candidates_page, delist=False)
+    elif arg == "-info":
+        if delist:
+            out("Gathering info about delist candidates...", color="lightblue")
+            checkCandidates(ctx, Candidate.printAllInfo, candidates_page, delist=True)
+        if fmc:
+            out("Gathering info about fmc candidates...", color="lightblue")
+            checkCandidates(ctx, Candidate.printAllInfo, candidates_page, delist=False)
+    elif arg == "-stats":
+        out("Gathering statistics about archived fmc candidates...", color="lightblue")
+        printStats(ctx)
+    elif arg == "-reindex":
+        out("Indexing the featured media pages...", color="lightblue")
+        ctx.featuredIndex().refresh(ctx)
+    elif arg == "-park":
+        if ctx.threads and ctx.auto:
+            out(
+                "Auto parking using threads is disabled for now...",
+                color="lightyellow",
+            )
+            sys.exit(0)
+        if delist:
+            out("Parking delist candidates...", color="lightblue")
+            checkCandidates(ctx, Candidate.park, candidates_page, delist=True)
+        if fmc:
+            out("Parking fmc candidates...", color="lightblue")
+            checkCandidates(ctx, Candidate.park, candidates_page, delist=False)
+
 
+def run(ctx, actions, delist=True, fmc=True, candidates_page=CANDIDATES_PAGE, testLog=TEST_LOG):
+    """
+    Run the actions, like ["-close", "-park"], with the run context ctx
+
+    @param delist Handle the delisting candidates
+    @param fmc    Handle the featured candidates
+    """
+    for action in actions:
+        runAction(ctx, action, candidates_page, testLog, delist, fmc)
+        if ctx.abort:
+            break
+
+
+def startRun(ctx, actions, delist=True, fmc=True, candidates_page=CANDIDATES_PAGE):
+    """
+    Start run() in a new thread and return the thread
+
+    Several runs can be made at the same time in one process, runs on
+    the same site share the login session, the caches and the limit of
+    config.max_external_links threads. For example closing the fmc and
+    the delist candidates in parallel:
+
+        runs = [
+            startRun(RunContext(auto=True), ["-close"], delist=False),
+            startRun(RunContext(auto=True), ["-close"], fmc=False),
+        ]
+        for thread in runs:
+            thread.join()
+    """
+    thread = threading.Thread(
+        target=run,
+        args=(ctx, actions),
+        kwargs={"delist": delist, "fmc": fmc, "candidates_page": candidates_page},
+    )
+    thread.start()
+    return thread
+
+
+def main(*args):
     # Will sys.exit(-1) if another instance is running
 #     me = singleton.SingleInstance()
 
-    candidates_page = "Commons:Featured media candidates/candidate_list"
-    testLog = "Commons:Featured_media_candidates/Log/January_2009"
+    candidates_page = CANDIDATES_PAGE
+    testLog = TEST_LOG
 
     worked = False
     delist = False
     fmc = False
+    daemon = False
+    feed = False
+    planFile = None
+    applyFile = None
+    # The options of the RunContext
+    options = {}
 
     # First look for arguments that should be set for all operations
     i = 1
     for arg in sys.argv[1:]:
         if arg == "-auto":
-            G_Auto = True
+            options["auto"] = True
             sys.argv.remove(arg)
             continue
         elif arg == "-dry":
-            G_Dry = True
+            options["dry"] = True
             sys.argv.remove(arg)
             continue
         elif arg == "-threads":
-            G_Threads = True
+            options["threads"] = True
             sys.argv.remove(arg)
             continue
         elif arg == "-delist":
@@ -1836,12 +4830,66 @@ def main(*args):
             sys.argv.remove(arg)
             continue
         elif arg == "-notime":
-            G_LogNoTime = True
+            options["noTime"] = True
+            sys.argv.remove(arg)
+            continue
+        elif arg == "-nocache":
+            options["noCache"] = True
+            sys.argv.remove(arg)
+            continue
+        elif arg == "-daemon":
+            daemon = True
             sys.argv.remove(arg)
             continue
+        elif arg == "-showdiff":
+            options["showDiff"] = True
+            sys.argv.remove(arg)
+            continue
+        elif arg == "-pipeline":
+            options["pipeline"] = True
+            sys.argv.remove(arg)
+            continue
+        elif arg == "-writebehind":
+            options["writeBehind"] = True
+            sys.argv.remove(arg)
+            continue
+        elif arg == "-plan" or arg == "-apply":
+            if i + 1 < len(sys.argv):
+                if arg == "-plan":
+                    planFile = sys.argv.pop(i + 1)
+                else:
+                    applyFile = sys.argv.pop(i + 1)
+                sys.argv.remove(arg)
+                continue
+            else:
+                out("Warning - '%s' need a file name, aborting." % arg, color="lightred")
+                sys.exit(0)
+        elif arg == "-feed":
+            feed = True
+            sys.argv.remove(arg)
+            continue
+        elif arg == "-shard":
+            m = re.match(r"(\d+)/(\d+)$", sys.argv[i + 1]) if i + 1 < len(sys.argv) else None
+            if m and int(m.group(1)) < int(m.group(2)):
+                options["shard"] = int(m.group(1))
+                options["shardCount"] = int(m.group(2))
+                sys.argv.pop(i + 1)
+                sys.argv.remove(arg)
+                continue
+            else:
+                out("Warning - '-shard' need k/n with k < n, aborting.", color="lightred")
+                sys.exit(0)
+        elif arg == "-every":
+            if i + 1 < len(sys.argv) and sys.argv[i + 1].isdigit():
+                options["every"] = int(sys.argv.pop(i + 1))
+                sys.argv.remove(arg)
+                continue
+            else:
+                out("Warning - '-every' need a number of seconds, aborting.", color="lightred")
+                sys.exit(0)
         elif arg == "-match":
             if i + 1 < len(sys.argv):
-                G_MatchPattern = sys.argv.pop(i + 1)
+                options["match"] = sys.argv.pop(i + 1)
                 sys.argv.remove(arg)
                 continue
             else:
@@ -1853,13 +4901,16 @@ def main(*args):
         delist = True
         fmc = True
 
+    auto = options.get("auto", False)
+    dry = options.get("dry", False)
+
     # Can not use interactive mode with threads
-    if G_Threads and (not G_Dry and not G_Auto):
+    if options.get("threads") and (not dry and not auto and not planFile):
         out("Warning - '-threads' must be run with '-dry' or '-auto'", color="lightred")
         sys.exit(0)
 
     args = pywikibot.handle_args(*args)
-    SITE = pywikibot.Site()
+    ctx = RunContext(pywikibot.Site(), plan=bool(planFile), **options)
 
     # Abort on unknown arguments
     for arg in args:
@@ -1868,6 +4919,8 @@ def main(*args):
             "-close",
             "-info",
             "-park",
+            "-stats",
+            "-reindex",
             "-threads",
             "-fmc",
             "-delist",
@@ -1882,49 +4935,52 @@ def main(*args):
             )
             sys.exit(0)
 
+    if ctx.writeBehind and not planFile:
+        ctx.login()
+        ctx.writeQueue().start()
+
+    if applyFile:
+        # The plan was reviewed, and the pages are saved in parallel where prompts would mix
+        ctx.auto = True
+        ctx.login()
+        plan = EditPlan.load(applyFile)
+        out("Applying %d planned edits..." % len(plan.edits), color="lightblue")
+        plan.apply(ctx)
+        if ctx.writeBehind:
+            ctx.writeQueue().join(ctx)
+        return
+
+    if daemon:
+        if not auto and not dry:
+            out("Warning - '-daemon' must be run with '-dry' or '-auto'", color="lightred")
+            sys.exit(0)
+        actions = [arg for arg in args if arg in DAEMON_INTERVALS]
+        if not actions:
+            out("Warning - '-daemon' needs -info, -close, -park or -reindex.", color="lightred")
+            sys.exit(0)
+        feed = EventStreamFeed(ctx.site) if feed else ChangeFeed()
+        runDaemon(ctx, actions, candidates_page, testLog, delist, fmc, feed)
+        return
+
     for arg in args:
         worked = True
-        if arg == "-test":
-            if delist:
-                out("-test not supported for delisting candidates")
-            if fmc:
-                checkCandidates(Candidate.compareResultToCount, testLog, delist=False)
-        elif arg == "-close":
-            if delist:
-                out("Closing delist candidates...", color="lightblue")
-                checkCandidates(Candidate.closePage, candidates_page, delist=True)
-            if fmc:
-                out("Closing fmc candidates...", color="lightblue")
-                checkCandidates(Candidate.closePage, candidates_page, delist=False)
-        elif arg == "-info":
-            if delist:
-                out("Gathering info about delist candidates...", color="lightblue")
-                checkCandidates(Candidate.printAllInfo, candidates_page, delist=True)
-            if fmc:
-                out("Gathering info about fmc candidates...", color="lightblue")
-                checkCandidates(Candidate.printAllInfo, candidates_page, delist=False)
-        elif arg == "-park":
-            if G_Threads and G_Auto:
-                out(
-                    "Auto parking using threads is disabled for now...",
-                    color="lightyellow",
-                )
-                sys.exit(0)
-            if delist:
-                out("Parking delist candidates...", color="lightblue")
-                checkCandidates(Candidate.park, candidates_page, delist=True)
-            if fmc:
-                out("Parking fmc candidates...", color="lightblue")
-                checkCandidates(Candidate.park, candidates_page, delist=False)
+        runAction(ctx, arg, candidates_page, testLog, delist, fmc)
+
+    if ctx.writeBehind and not planFile:
+        ctx.writeQueue().join(ctx)
+
+    if ctx.editPlan is not None:
+        ctx.editPlan.save(planFile)
+        out("Wrote %d planned edits to '%s'" % (len(ctx.editPlan.edits), planFile))
 
     if not worked:
         out("Warning - you need to specify an argument, see -help.", color="lightred")
 
 
 def signal_handler(signal, frame):
-    global G_Abort
     print("\n\nReceived SIGINT, will abort...\n")
-    G_Abort = True
+    for ctx in list(_contexts):
+        ctx.abort = True
 
 
 signal.signal(signal.SIGINT, signal_handler)
@@ -0,0 +1,804 @@
+# -*- coding: utf-8 -*-
+"""
+Load test of fmc.py against a synthetic wiki
+
+It builds an in-memory wiki with thousands of candidates, large
+gallery pages, sets, alternatives, delistings and busy talk pages
+in the formats the bot parses, and runs -info, -close and -park
+against it at several concurrency levels. For each action and level
+the throughput, the latency percentiles of the candidates and the
+number of API reads, writes and bytes are reported.
+
+Nothing is read from or written to a real wiki, the stores of the bot
+are kept in a temporary directory.
+
+It adds the following commandline arguments:
+
+-candidates n     Number of candidates in the synthetic wiki (default 2000)
+-levels a,b,c     The numbers of parallel threads to test (default 1,4,16)
+-latency ms       Simulated time of each API call in milliseconds (default 5)
+-seed n           Seed of the generator (default 1)
+-verbose          Show the output of the bot
+-budget           Instead check the API calls of each action on single candidates
+                  against BUDGETS, exits with status 1 if any budget is exceeded
+-record           Like -budget but print the measured calls as new BUDGETS
+-pathological     Instead time the parsing of the PATHOLOGICAL nomination pages,
+                  exits with status 1 if any takes more than PATHOLOGICAL_LIMIT
+"""
+
+import os, sys, re, io, time, random, tempfile, threading, contextlib, types
+
+# The synthetic wiki needs no account
+os.environ.setdefault("PYWIKIBOT_NO_USER_CONFIG", "2")
+
+import pywikibot
+from pywikibot import config
+from datetime import datetime, timedelta
+
+import fmc
+
+
+class FakeRevision(dict):
+    """A revision, like pywikibot it can be read as dict or by attributes."""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FakeSite:
+    """
+    An in-memory wiki standing in for pywikibot.Site
+
+    Only what fmc.py uses is implemented. Every method that would make
+    an API request counts it as a read or a write, with the bytes
+    transferred, and waits latency seconds like a real request would.
+    """
+
+    def __init__(self, code="load", latency=0.0):
+        self.family = types.SimpleNamespace(name="fmc-loadtest")
+        self.code = code
+        self.latency = latency
+        # Title -> list of revisions, the oldest first
+        self.pages = {}
+        # File title -> titles of the pages showing it
+        self.references = {}
+        self.calls = {"read": 0, "write": 0, "bytes": 0}
+        self._logged_in = False
+        self._revid = 0
+        self._lock = threading.Lock()
+
+    def call(self, kind, size=0):
+        """Count an API request."""
+        with self._lock:
+            self.calls[kind] += 1
+            self.calls["bytes"] += size
+        if self.latency:
+            time.sleep(self.latency)
+
+    def resetCalls(self):
+        with self._lock:
+            self.calls = {"read": 0, "write": 0, "bytes": 0}
+
+    def add(self, title, text, user="FMCBot", when=None):
+        """Add a revision to a page, creating it if needed, without counting a request."""
+        title = normalize(title)
+        with self._lock:
+            self._revid += 1
+            self.pages.setdefault(title, []).append(
+                FakeRevision(
+                    revid=self._revid,
+                    user=user,
+                    timestamp=when or datetime.utcnow(),
+                    text=text,
+                )
+            )
+
+    def latest(self, title):
+        revisions = self.pages.get(normalize(title))
+        return revisions[-1] if revisions else None
+
+    def logged_in(self):
+        return self._logged_in
+
+    def login(self):
+        self.call("read")
+        self._logged_in = True
+
+    def hostname(self):
+        return "loadtest.invalid"
+
+    def username(self):
+        return "FMCBot"
+
+    def allpages(self, start="!", prefix="", namespace=0, **kwargs):
+        self.call("read")
+        ns = {4: "Commons:", 10: "Template:"}.get(namespace, "")
+        for title in sorted(self.pages):
+            if title.startswith(ns + prefix) and title[len(ns) :] >= start:
+                yield FakePage(self, title)
+
+    def preloadpages(self, pages, groupsize=50, content=True, **kwargs):
+        pages = list(pages)
+        for i in range(0, len(pages), groupsize):
+            group = pages[i : i + groupsize]
+            size = 0
+            for page in group:
+                page._loaded = True
+                page._revid = self.latest(page.title())["revid"] if page.exists() else None
+                if content and page.exists():
+                    page._text = self.latest(page.title())["text"]
+                    size += len(page._text)
+            self.call("read", size)
+            for page in group:
+                yield page
+
+    def editpage(self, page, summary=None, minor=False, appendtext="", **kwargs):
+        self.call("write", len(appendtext))
+        latest = self.latest(page.title())
+        self.add(page.title(), (latest["text"] if latest else "") + appendtext)
+        page._loaded = False
+        page._text = None
+        return True
+
+    def simple_request(self, **params):
+        return FakeRequest(self, params)
+
+
+class FakeRequest:
+    """The queries fmc.py makes with site.simple_request()."""
+
+    def __init__(self, site, params):
+        self.site = site
+        self.params = params
+
+    def submit(self):
+        params = self.params
+        wanted = [
+            title
+            for key in ("pltitles", "imimages", "tltemplates")
+            for title in (params.get(key) or "").split("|")
+            if title
+        ]
+        pages = {}
+        for i, title in enumerate(params.get("titles", "").split("|")):
+            title = normalize(title)
+            info = {"title": title}
+            latest = self.site.latest(title)
+            if latest is None:
+                info["missing"] = ""
+            else:
+                if "revisions" in params.get("prop", ""):
+                    info["revisions"] = [
+                        {
+                            "revid": latest["revid"],
+                            "timestamp": latest["timestamp"].strftime("%Y-%m-%dT%H:%M:%SZ"),
+                        }
+                    ]
+                text = latest["text"].replace("_", " ")
+                for want in wanted:
+                    name = normalize(want)
+                    if name in text or "{{" + name.split(":", 1)[-1] in text:
+                        info.setdefault("templates", []).append({"title": want})
+            pages[str(-1 - i)] = info
+        data = {"query": {"pages": pages}}
+        self.site.call("read", len(repr(data)))
+        return data
+
+
+class FakePage:
+    """
+    A page of a FakeSite standing in for pywikibot.Page
+
+    Like pywikibot the page object keeps the metadata and the text
+    once they are loaded, new objects of the same page load them again.
+    Saving the page is an edit conflict if it changed since the revision
+    the object loaded, or since the baserevid passed to put().
+    """
+
+    def __init__(self, site, title):
+        self.site = site
+        self._title = normalize(title)
+        self._loaded = False
+        self._text = None
+        self._revid = None
+
+    def title(self, with_ns=True, as_link=False, **kwargs):
+        title = self._title
+        if not with_ns and ":" in title:
+            title = title.split(":", 1)[1]
+        return "[[%s]]" % title if as_link else title
+
+    def _latest(self):
+        if not self._loaded:
+            self.site.call("read")
+            self._loaded = True
+            latest = self.site.latest(self._title)
+            self._revid = latest["revid"] if latest else None
+        return self.site.latest(self._title)
+
+    def exists(self):
+        return self._latest() is not None
+
+    def get(self, get_redirect=False, force=False):
+        if self._text is None or force:
+            latest = self.site.latest(self._title)
+            self.site.call("read", len(latest["text"]) if latest else 0)
+            self._loaded = True
+            if latest is None:
+                raise pywikibot.NoPage(self)
+            self._text = latest["text"]
+            self._revid = latest["revid"]
+        return self._text
+
+    @property
+    def latest_revision_id(self):
+        latest = self._latest()
+        if latest is None:
+            raise pywikibot.NoPage(self)
+        return latest["revid"]
+
+    def editTime(self):
+        latest = self._latest()
+        if latest is None:
+            raise pywikibot.NoPage(self)
+        return latest["timestamp"].strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    def revisions(self, reverse=False, total=None, content=False):
+        self.site.call("read")
+        revisions = list(self.site.pages.get(self._title, []))
+        if not reverse:
+            revisions.reverse()
+        return iter(revisions[:total] if total else revisions)
+
+    def put(self, text, comment=None, **kwargs):
+        self.site.call("write", len(text))
+        latest = self.site.latest(self._title)
+        base = kwargs.get("baserevid", self._revid)
+        if latest and base is not None and base != latest["revid"]:
+            raise pywikibot.EditConflict(self)
+        self.site.add(self._title, text)
+        self._revid = self.site.latest(self._title)["revid"]
+        # Like pywikibot the new revision id comes with the response
+        self._loaded = True
+        self._text = text
+
+    save = put
+
+    def isRedirectPage(self):
+        return False
+
+    def getRedirectTarget(self):
+        return self
+
+    def templates(self):
+        text = self.get()
+        return [
+            FakePage(self.site, name if ":" in name else "Template:" + name)
+            for name in re.findall(r"{{\s*([^|{}]+?)\s*(?:\|[^{}]*)?}}", text)
+        ]
+
+    def getReferences(self, **kwargs):
+        self.site.call("read")
+        return [
+            FakePage(self.site, title)
+            for title in sorted(self.site.references.get(self._title, ()))
+        ]
+
+    def __eq__(self, other):
+        return isinstance(other, FakePage) and other._title == self._title
+
+    def __hash__(self):
+        return hash(self._title)
+
+    def __repr__(self):
+        return "FakePage(%r)" % self._title
+
+
+def normalize(title):
+    """Normalize a title like MediaWiki does."""
+    title = " ".join(title.replace("_", " ").split())
+    if ":" in title:
+        ns, name = title.split(":", 1)
+        return "%s:%s" % (ns, name[:1].upper() + name[1:])
+    return title[:1].upper() + title[1:]
+
+
+class LoadContext(fmc.RunContext):
+    """A run context whose pages are the pages of a FakeSite."""
+
+    def Page(self, title):
+        return FakePage(self.site, title)
+
+
+GALLERIES = (
+    "Animals", "Places", "Objects", "People", "Nature", "Events",
+    "Sports", "Science", "History", "Food", "Vehicles", "Arts",
+)
+SECTIONS = 15
+SUPPORTS = ("Support", "Pro", "Strong support", "Weak support")
+OPPOSES = ("Oppose", "Contra", "Weak oppose")
+NEUTRALS = ("Neutral",)
+
+
+class SyntheticWiki:
+    """
+    Fills a FakeSite with candidates and the pages parking them needs
+
+    The shared pages, like the featured list, the gallery pages and
+    the talk pages, are made first. Candidates are then added one by
+    one with addCandidate() and the pages listing them are written
+    by finish().
+    """
+
+    def __init__(self, site, rng, users=20, now=None):
+        self.site = site
+        self.rng = rng
+        self.now = now or datetime.utcnow()
+        self.month = "%s %s" % (self.now.strftime("%B"), self.now.year)
+        self.chronoTitle = "Commons:Featured_media/chronological/%s" % self.month
+        self.nominators = ["Nominator %d" % i for i in range(max(users, 5))]
+        self.uploaders = ["Uploader %d" % i for i in range(max(users * 10 // 7, 5))]
+        self.listed = []
+
+        # The featured list, four files in every gallery
+        site.add(
+            "Commons:Featured media, list",
+            "".join(
+                "== {{{%d|%s}}} ==\n<gallery>\n%s</gallery>\n"
+                % (i, gallery, "".join("File:%s list %d.webm\n" % (gallery, k) for k in range(4)))
+                for i, gallery in enumerate(GALLERIES)
+            ),
+        )
+        # Large gallery pages with many sections, written by finish()
+        self.galleryTexts = {}
+        for gallery in GALLERIES:
+            self.galleryTexts[gallery] = [
+                "== Section %d ==\n<gallery>\n%s"
+                % (s, "".join("File:%s %d %d.webm|An old featured media\n" % (gallery, s, k) for k in range(100)))
+                for s in range(SECTIONS)
+            ]
+        self.chronological = ["{{FMArchiveChrono}}\n== %s ==\n<gallery>\n" % self.month] + [
+            "File:Earlier %d.webm|%d '''Earlier''' <br> uploaded by someone\n" % (k, k + 1)
+            for k in range(300)
+        ]
+
+        # Busy talk pages and some existing user categories
+        for user in self.nominators + self.uploaders:
+            site.add(
+                "User talk:%s" % user,
+                "".join(
+                    "\n== Message %d ==\n%s --~~~~\n" % (k, "Lorem ipsum dolor sit amet. " * 15)
+                    for k in range(rng.randint(20, 200))
+                ),
+                user=user,
+                when=self.now - timedelta(days=400),
+            )
+        for user in self.nominators:
+            if rng.random() < 0.5:
+                site.add(
+                    "Category:Featured media nominated by %s" % user,
+                    "\n{{FMcatNominator|username=%s}}\n__HIDDENCAT__" % user,
+                )
+        for user in self.uploaders:
+            if rng.random() < 0.5:
+                site.add(
+                    "Category:Featured media by %s" % user,
+                    "\n{{FMcatUploader|username=%s}}\n__HIDDENCAT__" % user,
+                )
+        for day in range(0, 60, 3):
+            date = (self.now + timedelta(days=day)).strftime("%Y-%m-%d")
+            site.add("Template:Motd/%s" % date, "{{Motd filename|Taken.webm|%s}}" % date.replace("-", "|"))
+
+    def addCandidate(self, kind, age, state, supports, opposes, neutrals):
+        """
+        Add a candidate, returns its title
+
+        @param kind  "single", "set", "alternative" or "delist"
+        @param age   Days since it was nominated
+        @param state "open", "withdrawn", "counted" or "reviewed"
+        """
+        rng = self.rng
+        site = self.site
+        i = len(self.listed)
+        created = self.now - timedelta(days=age)
+        edited = created + timedelta(days=rng.uniform(0, age))
+        nominator = rng.choice(self.nominators)
+        gallery = rng.choice(GALLERIES)
+        section = rng.randrange(SECTIONS)
+
+        if kind == "set":
+            title = "Commons:Featured media candidates/Set/Synthetic set %d" % i
+            files = ["File:Set %d part %d.webm" % (i, k) for k in range(rng.randint(3, 6))]
+            media = "<gallery>\n%s</gallery>\n" % "".join("%s|Part\n" % file for file in files)
+        elif kind == "delist":
+            title = "Commons:Featured media candidates/removal/File:Featured %d.webm" % i
+            files = ["File:Featured %d.webm" % i]
+            media = "[[%s|thumb|400px]]\n" % files[0]
+        else:
+            title = "Commons:Featured media candidates/File:Candidate %d.webm" % i
+            files = ["File:Candidate %d.webm" % i]
+            if kind == "alternative":
+                files.append("File:Candidate %d alt.webm" % i)
+            media = "".join("[[%s|400px]]\n" % file for file in files)
+
+        for file in files:
+            uploader = rng.choice(self.uploaders)
+            text = "=={{int:filedesc}}==\n{{Information|description=Synthetic media %d|date=2020|source={{own}}|author=[[User:%s]]}}\n" % (i, uploader)
+            if kind == "delist":
+                text += "{{Assessments|featured=1}}\n"
+                self.galleryTexts[gallery][section] += "%s|A featured media\n" % file
+                self.chronological.append(
+                    "%s|%d '''Featured''' <br> uploaded by %s\n" % (file, len(self.chronological), uploader)
+                )
+                site.references[normalize(file)] = set(
+                    [normalize("Commons:Featured media/%s" % gallery), normalize(self.chronoTitle)]
+                )
+            site.add(file, text, user=uploader, when=created - timedelta(days=30))
+
+        if kind == "delist":
+            votes = [("Delist", supports), ("Keep", opposes), ("Neutral", neutrals)]
+        else:
+            votes = [
+                (rng.choice(SUPPORTS), supports),
+                (rng.choice(OPPOSES), opposes),
+                (rng.choice(NEUTRALS), neutrals),
+            ]
+        lines = []
+        for template, n in votes:
+            for k in range(n):
+                lines.append("* {{%s}} Looks fine to me. --[[User:Voter %d]] ~~~~\n" % (template, rng.randrange(500)))
+        rng.shuffle(lines)
+
+        text = (
+            "=== [[:%s]] ===\n%s" % (files[0], media)
+            + "* '''Info''' created and uploaded by someone, nominated by [[User:%s]]\n" % nominator
+            + "* Gallery: [[Commons:Featured media/%s#Section %d]]\n" % (gallery, section)
+            + "{{Candidatedescription}} A synthetic nomination number %d\n" % i
+            + "".join(lines)
+        )
+        featured = "yes" if supports >= 5 and supports >= 2 * opposes else "no"
+        if state == "withdrawn":
+            text += "{{Withdrawn}} --[[User:%s]]\n" % nominator
+        elif state == "reviewed" and kind == "delist":
+            text += (
+                "\n{{FMC-delist-results-reviewed|delist=%d|keep=%d|neutral=%d|delisted=%s|sig=~~~~}}\n"
+                % (supports, opposes, neutrals, featured)
+            )
+        elif state == "reviewed":
+            text += (
+                "\n{{FMC-results-reviewed|support=%d|oppose=%d|neutral=%d|featured=%s|gallery=%s#Section %d%s|sig=~~~~}}\n"
+                % (
+                    supports,
+                    opposes,
+                    neutrals,
+                    featured,
+                    gallery,
+                    section,
+                    "|alternative=%s" % files[1] if kind == "alternative" else "",
+                )
+            )
+        elif state == "counted":
+            text += (
+                "\n{{FMC-results-unreviewed|support=%d|oppose=%d|neutral=%d|featured=%s|gallery=|sig=~~~~}}\n"
+                % (supports, opposes, neutrals, featured)
+            )
+        site.add(title, text, user=nominator, when=created)
+        if edited > created:
+            site.add(title, text + "* {{Comment}} A late remark ~~~~\n", user="Voter", when=edited)
+        self.listed.append(title)
+        return title
+
+    def finish(self):
+        """Write the gallery pages, the chronological list, the log and the candidate list."""
+        for gallery in GALLERIES:
+            self.site.add(
+                "Commons:Featured media/%s" % gallery,
+                "{{Featured media gallery header}}\n"
+                + "".join(part + "</gallery>\n" for part in self.galleryTexts[gallery]),
+            )
+        self.site.add(self.chronoTitle, "".join(self.chronological) + "</gallery>\n")
+        self.site.add(
+            "Commons:Featured media candidates/Log/%s" % self.month,
+            "".join("{{Commons:Featured media candidates/File:Closed %d.webm}}\n" % k for k in range(200)),
+        )
+        self.site.add(
+            fmc.CANDIDATES_PAGE,
+            "{{Commons:Featured media candidates/candidate list header}}\n"
+            + "".join("{{%s}}\n" % title for title in self.listed),
+        )
+
+
+def buildWiki(site, count, rng, now=None):
+    """
+    Fill site with count candidates and the pages parking them needs
+
+    About one in ten candidates is a delisting, one in ten a set and
+    one in twenty has alternatives. Candidates are up to 35 days old,
+    half of those older than nine days have reviewed results and can
+    be parked, others are counted or still open.
+    """
+    wiki = SyntheticWiki(site, rng, users=count // 10, now=now)
+    for i in range(count):
+        roll = rng.random()
+        kind = "delist" if roll < 0.1 else "set" if roll < 0.2 else "alternative" if roll < 0.25 else "single"
+        age = rng.uniform(0, 35)
+        supports = rng.randint(0, 12)
+        opposes = rng.randint(0, 6)
+        neutrals = rng.randint(0, 2)
+        roll = rng.random()
+        if roll < 0.05:
+            state = "withdrawn"
+        elif age < 9:
+            state = "open"
+        else:
+            state = "reviewed" if roll < 0.5 else "counted" if roll < 0.7 else "open"
+        wiki.addCandidate(kind, age, state, supports, opposes, neutrals)
+    wiki.finish()
+
+
+# The action arguments and the checks they run
+ACTIONS = (
+    ("-info", fmc.Candidate.printAllInfo),
+    ("-close", fmc.Candidate.closePage),
+    ("-park", fmc.Candidate.park),
+)
+
+
+def percentile(values, p):
+    """The p:th percentile of values, 0 if there are none."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def runAction(site, check, level, verbose):
+    """
+    Run one check on all fmc and delist candidates of site using level
+    threads. Returns (candidates, seconds, latencies, api calls).
+    """
+    ctx = LoadContext(site, auto=True, threads=level > 1, noTime=True)
+    ctx.latencies = []
+    # checkCandidates() starts a new thread while fewer than this are running
+    config.max_external_links = threading.active_count() + level
+    site.resetCalls()
+    start = time.time()
+    with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+        for delist in (False, True):
+            fmc.checkCandidates(ctx, check, fmc.CANDIDATES_PAGE, delist)
+    return len(ctx.latencies), time.time() - start, ctx.latencies, dict(site.calls)
+
+
+def loadTest(count, levels, latency, seed, verbose):
+    """Run all actions at every level against a new synthetic wiki and print the results."""
+    pywikibot.stdout("%-7s %6s %6s %8s %8s %8s %8s %7s %6s %9s" % (
+        "action", "level", "cands", "cands/s", "p50 ms", "p90 ms", "p99 ms", "reads", "writes", "MB"))
+    for level in levels:
+        site = FakeSite("load%d" % level, latency)
+        buildWiki(site, count, random.Random(seed))
+        for name, check in ACTIONS:
+            candidates, seconds, latencies, calls = runAction(site, check, level, verbose)
+            pywikibot.stdout(
+                "%-7s %6d %6d %8.1f %8.1f %8.1f %8.1f %7d %6d %9.2f"
+                % (
+                    name,
+                    level,
+                    candidates,
+                    candidates / seconds if seconds else 0,
+                    1000 * percentile(latencies, 50),
+                    1000 * percentile(latencies, 90),
+                    1000 * percentile(latencies, 99),
+                    calls["read"],
+                    calls["write"],
+                    calls["bytes"] / 1e6,
+                )
+            )
+
+
+# The candidates the API calls are checked for with -budget,
+# as (action, kind, age in days, state)
+BUDGET_CASES = (
+    ("-info", "single", 30, "open"),
+    ("-close", "single", 30, "open"),
+    ("-close", "alternative", 30, "open"),
+    ("-close", "delist", 30, "open"),
+    ("-park", "single", 30, "reviewed"),
+    ("-park", "set", 30, "reviewed"),
+    ("-park", "alternative", 30, "reviewed"),
+    ("-park", "delist", 30, "reviewed"),
+)
+# The (reads, writes, bytes) each case may use, including finding the
+# candidate, recorded with -record. The bytes may be BYTES_SLACK larger,
+# as the sizes of the pages change a little with the date.
+BUDGETS = {
+    ("-info", "single"): (6, 0, 1157),
+    ("-close", "single"): (8, 1, 2445),
+    ("-close", "alternative"): (8, 1, 2558),
+    ("-close", "delist"): (9, 1, 2362),
+    ("-park", "single"): (16, 11, 179611),
+    ("-park", "set"): (20, 18, 382223),
+    ("-park", "alternative"): (18, 12, 179840),
+    ("-park", "delist"): (11, 6, 175573),
+}
+BYTES_SLACK = 0.05
+
+
+def measureCase(action, kind, age, state):
+    """The API calls of action on a new wiki with only one candidate of kind."""
+    site = FakeSite("budget-%s-%s" % (action.strip("-"), kind))
+    wiki = SyntheticWiki(site, random.Random(1), users=5)
+    wiki.addCandidate(kind, age, state, 8, 1, 1)
+    wiki.finish()
+    return runAction(site, dict(ACTIONS)[action], 1, False)[3]
+
+
+def checkBudgets(record):
+    """
+    Measure all BUDGET_CASES and compare them to BUDGETS, or print
+    them as new BUDGETS if record is True. Returns False if any case
+    exceeded its budget.
+    """
+    passed = True
+    measured = []
+    for action, kind, age, state in BUDGET_CASES:
+        calls = measureCase(action, kind, age, state)
+        key = (action, kind)
+        measured.append((key, (calls["read"], calls["write"], calls["bytes"])))
+        if record:
+            continue
+        budget = BUDGETS.get(key)
+        if budget is None:
+            status = "NO BUDGET"
+        elif (
+            calls["read"] > budget[0]
+            or calls["write"] > budget[1]
+            or calls["bytes"] > budget[2] * (1 + BYTES_SLACK)
+        ):
+            status = "OVER BUDGET"
+        else:
+            status = "ok"
+        passed = passed and status == "ok"
+        budget = budget or (0, 0, 0)
+        pywikibot.stdout(
+            "%-7s %-12s reads %4d/%-4d writes %3d/%-3d bytes %8d/%-8d %s"
+            % (
+                action,
+                kind,
+                calls["read"],
+                budget[0],
+                calls["write"],
+                budget[1],
+                calls["bytes"],
+                budget[2],
+                status,
+            )
+        )
+    if record:
+        pywikibot.stdout("BUDGETS = {")
+        for key, values in measured:
+            pywikibot.stdout("    %r: %r," % (key, values))
+        pywikibot.stdout("}")
+    return passed
+
+
+# Nomination pages that made the old regexps backtrack for minutes or
+# more, as (name, text). They are kept as a benchmark, parsing any of
+# them must take time linear in its length.
+PATHOLOGICAL_SIZE = 200000
+PATHOLOGICAL = (
+    ("unclosed votes", "{{Support|" * (PATHOLOGICAL_SIZE // 10)),
+    ("unclosed vote", "{{Support|" + "x" * PATHOLOGICAL_SIZE),
+    ("nested votes", "{{Support|" * (PATHOLOGICAL_SIZE // 20) + "}}" * (PATHOLOGICAL_SIZE // 20)),
+    ("votes on one line", "{{Support|a}} " * (PATHOLOGICAL_SIZE // 14)),
+    (
+        "unclosed results",
+        "{{FMC-results-reviewed|support=1|oppose=0|neutral=0|featured=yes|gallery="
+        + "a " * (PATHOLOGICAL_SIZE // 2),
+    ),
+    ("unclosed results lines", "{{FMC-results-unreviewed|\n" * (PATHOLOGICAL_SIZE // 26)),
+    ("open braces", "{{" * (PATHOLOGICAL_SIZE // 2)),
+    ("spaces in a template", "{{a" + " " * PATHOLOGICAL_SIZE + "x"),
+    ("unclosed file notes", "{{ImageNote|id=1}}{{ImageNoteEnd" * (PATHOLOGICAL_SIZE // 32)),
+    ("unclosed strikes", "<s>{{Oppose}}" * (PATHOLOGICAL_SIZE // 13)),
+    ("unclosed comments", "<!--{{Oppose}}" * (PATHOLOGICAL_SIZE // 14)),
+    ("unclosed media links", "[[File:A.jpg|" * (PATHOLOGICAL_SIZE // 13)),
+    ("media link size", "[[File:A.jpg|" + "1" * PATHOLOGICAL_SIZE + "]]"),
+    ("media links", "[[File:A.jpg|thumb|100px]]" * (PATHOLOGICAL_SIZE // 26)),
+    ("gallery links", "Gallery [[Commons:Featured media/Animals" * (PATHOLOGICAL_SIZE // 40)),
+    ("heading", "=a=" + " " * PATHOLOGICAL_SIZE + "x"),
+)
+# Seconds the parsing of each PATHOLOGICAL page may take
+PATHOLOGICAL_LIMIT = 1.0
+
+
+def parseNomination(text):
+    """Everything the bot looks up on a nomination page."""
+    document = fmc.NominationDocument(text)
+    for nameR in (fmc.SupportNameR, fmc.OpposeNameR, fmc.NeutralNameR, fmc.WithdrawnNameR):
+        document.countTemplates(nameR)
+    document.countTemplates(fmc.FmxNameR, filtered=False)
+    document.matches(fmc.PreviousResultR, "'''result:'''")
+    document.parameters(fmc.FMCandidate.reviewedTemplate)
+    document.hasTemplate(fmc.FMCandidate.countedTemplate)
+    document.mediaCount()
+
+
+def checkPathological():
+    """
+    Time the parsing of the PATHOLOGICAL pages, returns False if any
+    took more than PATHOLOGICAL_LIMIT seconds.
+    """
+    passed = True
+    for name, text in PATHOLOGICAL:
+        start = time.thread_time()
+        try:
+            parseNomination(text)
+            status = "ok"
+        except fmc.PathologicalPage:
+            status = "OVER CPU BUDGET"
+        seconds = time.thread_time() - start
+        if seconds > PATHOLOGICAL_LIMIT:
+            status = "TOO SLOW"
+        passed = passed and status == "ok"
+        pywikibot.stdout("%-24s %8d chars %7.3fs %s" % (name, len(text), seconds, status))
+    return passed
+
+
+def main(*args):
+    count = 2000
+    levels = [1, 4, 16]
+    latency = 5
+    seed = 1
+    verbose = False
+    budget = False
+    record = False
+    pathological = False
+
+    args = list(args or sys.argv[1:])
+    while args:
+        arg = args.pop(0)
+        try:
+            if arg == "-candidates":
+                count = int(args.pop(0))
+            elif arg == "-levels":
+                levels = [int(level) for level in args.pop(0).split(",")]
+            elif arg == "-latency":
+                latency = float(args.pop(0))
+            elif arg == "-seed":
+                seed = int(args.pop(0))
+            elif arg == "-verbose":
+                verbose = True
+            elif arg == "-budget":
+                budget = True
+            elif arg == "-record":
+                record = True
+            elif arg == "-pathological":
+                pathological = True
+            else:
+                fmc.out("Warning - unknown argument '%s' aborting, see -help." % arg, color="lightred")
+                sys.exit(0)
+        except (IndexError, ValueError):
+            fmc.out("Warning - '%s' needs a number, aborting." % arg, color="lightred")
+            sys.exit(0)
+
+    # Keep the stores of the bot away from the real ones
+    config.base_dir = tempfile.mkdtemp(prefix="fmc-loadtest-")
+    if not verbose:
+        # Only show the results
+        fmc.out = lambda *args, **kwargs: None
+    if pathological:
+        if not checkPathological():
+            sys.exit(1)
+        return
+    if budget or record:
+        if not checkBudgets(record):
+            sys.exit(1)
+        return
+    loadTest(count, levels, latency / 1000.0, seed, verbose)
+
+
+if __name__ == "__main__":
+    main()